@@ -0,0 +1,68 @@
+"""
+Measures how fast a cache joining late warms up. A peer is filled by a
+Zipf-distributed (s=0.9) read trace, then a new cache joins, either cold
+or bootstrapping from the peer over its neighbour server. The first reads
+of the new cache are replayed, each miss setting the key.
+
+Reports the time the new cache took to be ready (registered, and caught up
+if it bootstraps), the items it fetched, and its hit ratio over those reads.
+
+"""
+
+import os
+import time
+import random
+import tempfile
+import itertools
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import DatabaseTransport
+
+
+CAPACITY = 50000
+KEYS = 500000
+WARMUP_READS = 250000
+READS_AFTER_JOIN = 20000
+
+
+def replay(cache, reads):
+    hits = 0
+    for key in reads:
+        if cache.get(key) is None:
+            cache.set(key, f'value-{key}')
+        else:
+            hits += 1
+
+    return hits / len(reads)
+
+
+if __name__ == '__main__':
+    generator = random.Random(0)
+    weights = list(itertools.accumulate(1 / rank ** 0.9 for rank in range(1, KEYS + 1)))
+    reads = generator.choices(range(KEYS), cum_weights=weights, k=WARMUP_READS + READS_AFTER_JOIN)
+
+    print(f"{'joiner':>10} {'ready (s)':>10} {'items':>7} {'hit ratio':>10}")
+
+    for bootstrap in (False, True):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        db_url = 'sqlite:///' + path
+
+        peer = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=DatabaseTransport(),
+                           max_size=CAPACITY, expires_in=3600, neighbour_address=('127.0.0.1', 0))
+        replay(peer, reads[:WARMUP_READS])
+
+        start = time.perf_counter()
+        joiner = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=DatabaseTransport(),
+                             max_size=CAPACITY, expires_in=3600, bootstrap=bootstrap)
+        joiner.bootstrapped.wait()
+        ready = time.perf_counter() - start
+        items = joiner.size()
+
+        # The joiner's misses are set and propagated to the peer as usual
+        hit_ratio = replay(joiner, reads[WARMUP_READS:])
+
+        print(f"{'bootstrap' if bootstrap else 'cold':>10} {ready:>10.3f} {items:>7} {hit_ratio:>10.3f}")
+
+        joiner.close()
+        peer.close()
@@ -0,0 +1,45 @@
+"""
+Measures the coalescing of superseded writes in the datastore table. A cache
+with the DatabaseTransport sets hot keys over and over, addressed to peers
+registered directly in the database that never consume. Every write to a
+key deletes the rows an earlier write to it left pending.
+
+Reports the rows left pending, against the rows one row per write and per
+peer would have left, and the time a set() takes.
+
+"""
+
+import os
+import time
+import tempfile
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.models import CacheGeolocation, CacheDataStore
+
+
+PEERS = 10
+SETS = 1000
+HOT_KEYS = (1, 10, 100)
+
+
+if __name__ == '__main__':
+    print(f"{'hot keys':>9} {'rows uncoalesced':>17} {'rows pending':>13} {'set (ms)':>9}")
+
+    for hot_keys in HOT_KEYS:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+        cache = GeoLRUCache((45.5016889, -73.567256), db_url='sqlite:///' + path)
+        cache.session.add_all(CacheGeolocation(latitude=40 + i, longitude=-80 + i) for i in range(PEERS))
+        cache.session.commit()
+        cache.refresh_peers()
+
+        start = time.perf_counter()
+        for i in range(SETS):
+            cache.set(f'key-{i % hot_keys}', i)
+        elapsed = time.perf_counter() - start
+
+        pending = cache.session.query(CacheDataStore).count()
+        print(f"{hot_keys:>9} {SETS * PEERS:>17} {pending:>13} {elapsed / SETS * 1e3:>9.3f}")
+
+        cache.close()
@@ -0,0 +1,64 @@
+
+"""
+Measures the throughput of one cache shared by several threads, each
+running a mix of 90% reads and 10% writes over a key space larger than
+the cache, with the cache split into 1 and into 16 shards.
+
+The cache has no peers, so writes cost nothing beyond the local write.
+Under CPython's global interpreter lock, striping mostly removes lock
+contention rather than making reads run in parallel.
+
+"""
+
+import os
+import time
+import random
+import tempfile
+import threading
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import InProcessTransport
+
+
+THREADS = (1, 4, 8)
+SHARDS = (1, 16)
+OPERATIONS = 20000
+KEYS = 20000
+
+
+def measure(shards, threads):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    cache = GeoLRUCache((45.5016889, -73.567256), db_url='sqlite:///' + path, transport=InProcessTransport(),
+                        max_size=KEYS // 2, shards=shards)
+    for key in range(KEYS // 2):
+        cache.set(key, key)
+
+    def work(seed):
+        generator = random.Random(seed)
+        for _ in range(OPERATIONS):
+            key = generator.randrange(KEYS)
+            if generator.random() < 0.1:
+                cache.set(key, key)
+            else:
+                cache.get(key)
+
+    workers = [threading.Thread(target=work, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    cache.close()
+    os.remove(path)
+
+    return threads * OPERATIONS / elapsed
+
+
+if __name__ == '__main__':
+    print(f"{'threads':>8}" + ''.join(f"{f'{shards} shard(s) (ops/s)':>22}" for shards in SHARDS))
+    for threads in THREADS:
+        print(f"{threads:>8}" + ''.join(f"{measure(shards, threads):>22.0f}" for shards in SHARDS))
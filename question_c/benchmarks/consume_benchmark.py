@@ -0,0 +1,86 @@
+
+"""
+Measures how fast a cache drains the rows addressed to it in the datastore
+table, e.g. after coming back from a network partition:
+
+- per-row: the original approach, one query, delete and commit per row
+- batched: DatabaseTransport.consume, one query and one bulk DELETE per batch
+
+Runs against a temporary SQLite database.
+
+"""
+
+import os
+import time
+import tempfile
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from lrucache.models import Base, CacheDataStore
+from lrucache.transports import DatabaseTransport
+
+
+ROWS = (1000, 5000)
+COORDINATES = (45.5016889, -73.567256)
+
+
+class Receiver:
+    """
+    Stands in for a cache, counting the items it receives
+    """
+    coordinates = COORDINATES
+
+    def __init__(self):
+        self.received = 0
+
+    def receive(self, items):
+        self.received += len(items)
+
+
+def consume_per_row(cache, session):
+    while True:
+        new_item = session.query(CacheDataStore).filter(CacheDataStore.latitude == cache.coordinates[0]).\
+                           filter(CacheDataStore.longitude == cache.coordinates[1]).first()
+
+        if new_item is None:
+            break
+
+        cache.receive([(new_item.key, new_item.value)])
+        session.delete(new_item)
+        session.commit()
+
+
+def measure(consume, rows):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    session.bulk_insert_mappings(CacheDataStore, [
+        {'latitude': COORDINATES[0], 'longitude': COORDINATES[1], 'key': f'key{i}', 'value': 'value'}
+        for i in range(rows)
+    ])
+    session.commit()
+
+    receiver = Receiver()
+    start = time.perf_counter()
+    consume(receiver, session)
+    elapsed = time.perf_counter() - start
+
+    assert receiver.received == rows
+    session.close()
+    engine.dispose()
+    os.remove(path)
+
+    return rows / elapsed
+
+
+if __name__ == '__main__':
+    print(f"{'rows':>8} {'per-row (rows/s)':>17} {'batched (rows/s)':>17} {'speedup':>8}")
+    for rows in ROWS:
+        per_row = measure(consume_per_row, rows)
+        batched = measure(DatabaseTransport().consume, rows)
+        print(f"{rows:>8} {per_row:>17.0f} {batched:>17.0f} {batched / per_row:>7.1f}x")
@@ -0,0 +1,42 @@
+
+"""
+Measures the time it takes to rank every registered cache by its
+distance to one cache:
+
+- loop:       one get_distance call per cache, then a sort
+- vectorized: sort_by_distance, which uses one NumPy operation for the
+              distances and another for the ranking (when NumPy is installed)
+
+"""
+
+import random
+import time
+
+from lrucache import utils
+
+
+SIZES = (1000, 10000, 100000)
+ORIGIN = (45.5016889, -73.567256)
+
+
+def loop(origin, locations):
+    return sorted(((location, utils.get_distance(origin, location)) for location in locations), key=lambda i: i[1])
+
+
+def measure(rank, locations):
+    start = time.perf_counter()
+    rank(ORIGIN, locations)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    if utils.load_numpy() is None:
+        print("NumPy is not installed: the vectorized column uses the pure-Python fallback")
+
+    random.seed(0)
+    print(f"{'caches':>8} {'loop (ms)':>10} {'vectorized (ms)':>16} {'speedup':>8}")
+    for size in SIZES:
+        locations = [(random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(size)]
+        looped = measure(loop, locations)
+        vectorized = measure(utils.sort_by_distance, locations)
+        print(f"{size:>8} {looped * 1e3:>10.2f} {vectorized * 1e3:>16.2f} {looped / vectorized:>7.1f}x")
@@ -0,0 +1,72 @@
+
+"""
+Compares the cost of the expiry step of `clean_up` before and after the
+expiry index was introduced:
+
+- scan: the original approach, which walks every item's time-to-live on
+        every cache operation
+- heap: the ExpiryHeap, which only touches the items that have expired
+
+Each simulated operation advances the clock, expires whatever is due and
+then sets one new item, so the number of live items stays at `size`.
+
+"""
+
+import time
+
+from collections import OrderedDict
+
+from lrucache.expiry import ExpiryHeap
+
+
+OPERATIONS = 2000
+EXPIRES_IN = 60
+
+
+def scan_clean_up(times_to_live, now):
+    keys_to_delete = []
+
+    for key in times_to_live:
+        if times_to_live[key] < now:
+            keys_to_delete.append(key)
+
+    for key in keys_to_delete:
+        del times_to_live[key]
+
+
+def heap_clean_up(times_to_live, index, now):
+    for key in index.pop_expired(now):
+        del times_to_live[key]
+
+
+def run(size, use_heap):
+    times_to_live = OrderedDict()
+    index = ExpiryHeap(times_to_live)
+
+    # Spread the deadlines of the initial items evenly over one TTL
+    step = EXPIRES_IN / size
+    for i in range(size):
+        times_to_live[i] = i * step
+        index.push(i, i * step)
+
+    start = time.perf_counter()
+    for op in range(OPERATIONS):
+        now = op * step
+        if use_heap:
+            heap_clean_up(times_to_live, index, now)
+        else:
+            scan_clean_up(times_to_live, now)
+
+        key = size + op
+        times_to_live[key] = now + EXPIRES_IN
+        index.push(key, now + EXPIRES_IN)
+
+    return (time.perf_counter() - start) / OPERATIONS
+
+
+if __name__ == '__main__':
+    print(f"{'items':>10} {'scan (us/op)':>15} {'heap (us/op)':>15} {'speedup':>10}")
+    for size in (1024, 16384, 131072):
+        scan = run(size, use_heap=False)
+        heap = run(size, use_heap=True)
+        print(f"{size:>10} {scan * 1e6:>15.2f} {heap * 1e6:>15.2f} {scan / heap:>9.1f}x")
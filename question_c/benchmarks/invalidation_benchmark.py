@@ -0,0 +1,102 @@
+"""
+Measures what replicated invalidations cost, and how fast they take a
+stale value out of the peers, compared to waiting for its TTL.
+
+- staleness: the time between a cache deleting an item and a peer cache no
+  longer serving it, per transport. Relying on TTLs alone, a peer serves
+  an updated item for half its TTL on average.
+- sweep: the time an invalidate_prefix() and an invalidate_tag() removing 1%
+  of the items take on a cache of growing size, as every item is looked at.
+
+"""
+
+import os
+import time
+import tempfile
+import statistics
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import DatabaseTransport, InProcessTransport
+
+
+DELETES = 20
+
+# Gap between deletions, so that every deletion finds the peer idle
+INTERVAL = 0.1
+
+SIZES = (10000, 100000)
+
+
+def make_db_url():
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    return 'sqlite:///' + path
+
+
+def measure_staleness(transport):
+    db_url = make_db_url()
+
+    origin = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport, expires_in=3600)
+    peer = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport, expires_in=3600)
+
+    # Wait for both caches to register themselves
+    while not origin.sort_distances(refresh=True):
+        time.sleep(0.01)
+
+    origin.set_many({f'key{i}': 'value' for i in range(DELETES)})
+    while peer.size() < DELETES:
+        time.sleep(0.01)
+
+    latencies = []
+    for i in range(DELETES):
+        start = time.perf_counter()
+        origin.delete(f'key{i}')
+        while peer.get(f'key{i}') is not None:
+            time.sleep(0.0005)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(INTERVAL)
+
+    for cache in (origin, peer):
+        cache.close()
+
+    return latencies
+
+
+def measure_sweep(size):
+    cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url(), transport=InProcessTransport(),
+                        max_size=size, expires_in=3600)
+
+    # 1% of the items are under the 'hot:' prefix, and tagged 'hot'
+    for i in range(size):
+        hot = i % 100 == 0
+        cache.set(f'hot:{i}' if hot else f'key:{i}', i, tags=['hot'] if hot else None)
+
+    start = time.perf_counter()
+    removed = cache.invalidate_prefix('hot:')
+    prefix_time = time.perf_counter() - start
+
+    # The invalidated items are set again, for the tag to have something to remove
+    for i in range(0, size, 100):
+        cache.set(f'hot:{i}', i, tags=['hot'])
+
+    start = time.perf_counter()
+    cache.invalidate_tag('hot')
+    tag_time = time.perf_counter() - start
+
+    cache.close()
+
+    return removed, prefix_time, tag_time
+
+
+if __name__ == '__main__':
+    print(f"{'transport':>12} {'median (ms)':>12} {'max (ms)':>10}")
+    for name, transport in (('database', DatabaseTransport()), ('in-process', InProcessTransport())):
+        latencies = measure_staleness(transport)
+        print(f"{name:>12} {statistics.median(latencies) * 1e3:>12.2f} {max(latencies) * 1e3:>10.2f}")
+
+    print()
+    print(f"{'items':>7} {'removed':>8} {'prefix (ms)':>12} {'tag (ms)':>9}")
+    for size in SIZES:
+        removed, prefix_time, tag_time = measure_sweep(size)
+        print(f"{size:>7} {removed:>8} {prefix_time * 1e3:>12.1f} {tag_time * 1e3:>9.1f}")
@@ -0,0 +1,68 @@
+
+"""
+Compares the memory held per item by the cache's local storage:
+
+- parallel: the original layout, a dict of values plus two OrderedDicts
+            of access times and times to live
+- store:    the LRUStore, one dict of __slots__ CacheEntry objects that
+            are linked into a recency list and held by the expiry heap
+
+Keys and values are shared between both layouts and created before
+measuring, so only the bookkeeping overhead of each layout is counted.
+
+"""
+
+import sys
+import time
+import tracemalloc
+
+from collections import OrderedDict
+
+from lrucache.store import LRUStore
+
+
+EXPIRES_IN = 60
+
+
+def fill_parallel(keys, now):
+    values, access_times, times_to_live = dict(), OrderedDict(), OrderedDict()
+
+    for key in keys:
+        values[key] = key
+        access_times[key] = now
+        times_to_live[key] = now + EXPIRES_IN
+
+    return values, access_times, times_to_live
+
+
+def fill_store(keys, now):
+    store = LRUStore()
+
+    for key in keys:
+        store.set(key, key, now, now + EXPIRES_IN)
+
+    return store
+
+
+def measure(fill, keys):
+    now = time.time()
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    structure = fill(keys, now)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    del structure
+    return used / len(keys)
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    keys = [f'key{i}' for i in range(size)]
+
+    parallel = measure(fill_parallel, keys)
+    store = measure(fill_store, keys)
+
+    print(f"{'items':>10} {'parallel (B/item)':>18} {'store (B/item)':>15} {'ratio':>7}")
+    print(f"{size:>10} {parallel:>18.1f} {store:>15.1f} {store / parallel:>7.2f}")
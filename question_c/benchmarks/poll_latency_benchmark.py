@@ -0,0 +1,106 @@
+"""
+Measures the time a listener's poll of the datastore table takes, against
+the number of rows the table holds for other caches (e.g. rows addressed
+to slow or departed caches, not yet compacted).
+
+- before: the rows of the polling cache are found by its coordinates,
+  which no index covers, so every poll scans the whole table.
+- after: the rows are found by node id, past the cache's cursor, through
+  the (target_node, id) index.
+
+Each is timed for an empty poll, and for a poll finding a batch of new rows.
+
+"""
+
+import os
+import time
+import random
+import tempfile
+import statistics
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from lrucache.models import Base, CacheDataStore
+
+
+SIZES = (10000, 100000, 1000000)
+
+# The rows addressed to the polling cache, in the second poll
+NEW_ROWS = 100
+
+POLLS = 50
+
+BATCH_SIZE = 5000
+
+# The polling cache
+COORDINATES = (45.5016889, -73.567256)
+NODE_ID = 1
+
+
+def make_session(size):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+
+    # The rows of 100 other caches
+    peers = [(random.getrandbits(62) + 2, 40 + i / 10, -80 + i / 10) for i in range(100)]
+
+    with engine.begin() as connection:
+        for start in range(0, size, 50000):
+            rows = []
+            for i in range(start, min(start + 50000, size)):
+                node_id, latitude, longitude = peers[i % len(peers)]
+                rows.append({'target_node': node_id, 'latitude': latitude, 'longitude': longitude,
+                             'key': f'key-{i}'.encode(), 'value': b'value'})
+            connection.execute(insert(CacheDataStore), rows)
+
+    return sessionmaker(bind=engine)()
+
+
+def poll_before(session):
+    return session.query(CacheDataStore.id, CacheDataStore.key, CacheDataStore.value).\
+                   filter(CacheDataStore.latitude == COORDINATES[0]).\
+                   filter(CacheDataStore.longitude == COORDINATES[1]).\
+                   order_by(CacheDataStore.id).limit(BATCH_SIZE).all()
+
+
+def poll_after(session, cursor):
+    return session.query(CacheDataStore.id, CacheDataStore.key, CacheDataStore.value).\
+                   filter(CacheDataStore.target_node == NODE_ID).\
+                   filter(CacheDataStore.id > cursor).\
+                   order_by(CacheDataStore.id).limit(BATCH_SIZE).all()
+
+
+def time_polls(poll):
+    timings = []
+    for _ in range(POLLS):
+        start = time.perf_counter()
+        poll()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    print(f"{'rows':>8} {'poll':>6} {'before (ms)':>12} {'after (ms)':>11}")
+
+    for size in SIZES:
+        session = make_session(size)
+        cursor = size
+
+        empty = (time_polls(lambda: poll_before(session)), time_polls(lambda: poll_after(session, cursor)))
+
+        session.add_all(CacheDataStore(target_node=NODE_ID, latitude=COORDINATES[0], longitude=COORDINATES[1],
+                                       key=f'new-{i}'.encode(), value=b'value') for i in range(NEW_ROWS))
+        session.commit()
+
+        assert len(poll_before(session)) == len(poll_after(session, cursor)) == NEW_ROWS
+        new = (time_polls(lambda: poll_before(session)), time_polls(lambda: poll_after(session, cursor)))
+
+        for name, (before, after) in (('empty', empty), ('new', new)):
+            print(f"{size:>8} {name:>6} {before * 1e3:>12.3f} {after * 1e3:>11.3f}")
+
+        session.close()
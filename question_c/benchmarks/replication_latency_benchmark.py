@@ -0,0 +1,58 @@
+
+"""
+Measures replication latency: the time between a cache setting an item
+and a peer cache seeing it, for each transport that can run locally.
+
+- database:   the polling DatabaseTransport, over a temporary SQLite database
+- in-process: the InProcessTransport, for caches that share a process
+
+"""
+
+import os
+import time
+import tempfile
+import statistics
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import DatabaseTransport, InProcessTransport
+
+
+WRITES = 20
+
+# Gap between writes, so that every write finds the peer idle
+INTERVAL = 0.1
+
+
+def measure(transport):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    db_url = 'sqlite:///' + path
+
+    origin = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport)
+    peer = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport)
+
+    # Wait for both caches to register themselves
+    while not origin.sort_distances(refresh=True):
+        time.sleep(0.01)
+
+    latencies = []
+    for i in range(WRITES):
+        start = time.perf_counter()
+        origin.set(f'key{i}', 'value')
+        while peer.get(f'key{i}') is None:
+            time.sleep(0.0005)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(INTERVAL)
+
+    for cache in (origin, peer):
+        cache.close()
+
+    os.remove(path)
+    return latencies
+
+
+if __name__ == '__main__':
+    print(f"{'transport':>12} {'median (ms)':>12} {'max (ms)':>10}")
+    for name, transport in (('database', DatabaseTransport()), ('in-process', InProcessTransport())):
+        latencies = measure(transport)
+        print(f"{name:>12} {statistics.median(latencies) * 1e3:>12.2f} {max(latencies) * 1e3:>10.2f}")
@@ -0,0 +1,68 @@
+"""
+Measures the datastore rows written, and the time taken, per set() of a
+cache with the DatabaseTransport, for each replication scope, as the
+number of registered caches grows. The other caches are registered
+directly in the database, spread over 10 regions, and never consume.
+
+- all:       AllPeers, the default: one row per registered cache
+- nearest:   NearestPeers(5)
+- within:    PeersWithin(500 km)
+- region:    SameRegion, the writer's own region
+
+"""
+
+import os
+import time
+import random
+import tempfile
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.models import CacheGeolocation, CacheDataStore
+from lrucache.scopes import AllPeers, NearestPeers, PeersWithin, SameRegion
+
+
+SIZES = (10, 100, 1000)
+REGIONS = 10
+SETS = 50
+
+
+def make_cache(peers):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    cache = GeoLRUCache((45.5016889, -73.567256), db_url='sqlite:///' + path, region='region-0')
+
+    generator = random.Random(0)
+    cache.session.add_all(CacheGeolocation(latitude=generator.uniform(-90, 90), longitude=generator.uniform(-180, 180),
+                                           region=f'region-{i % REGIONS}') for i in range(peers))
+    cache.session.commit()
+    cache.refresh_peers()
+
+    return cache
+
+
+if __name__ == '__main__':
+    scopes = (
+        ('all', AllPeers()),
+        ('nearest', NearestPeers(5)),
+        ('within', PeersWithin(500000)),
+        ('region', SameRegion()),
+    )
+
+    print(f"{'caches':>7} {'scope':>8} {'rows/set':>9} {'set (ms)':>9}")
+    for size in SIZES:
+        cache = make_cache(size)
+
+        for name, scope in scopes:
+            start = time.perf_counter()
+            for i in range(SETS):
+                cache.set(i, i, scope=scope)
+            elapsed = time.perf_counter() - start
+
+            rows = cache.session.query(CacheDataStore).count()
+            cache.session.query(CacheDataStore).delete()
+            cache.session.commit()
+
+            print(f"{size:>7} {name:>8} {rows / SETS:>9.1f} {elapsed / SETS * 1e3:>9.3f}")
+
+        cache.close()
@@ -0,0 +1,81 @@
+"""
+Measures the encoded size, and the encoding and decoding times, of a
+structured value of a few KB with each codec, uncompressed and compressed
+(msgpack and lz4 are skipped if not installed), then the time a set()
+takes to reach a peer through the datastore table with each codec.
+
+"""
+
+import os
+import time
+import tempfile
+
+from lrucache import serialization
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import DatabaseTransport
+
+
+ROUNDS = 2000
+WRITES = 200
+
+VALUE = {
+    'user': {'id': 12345, 'name': 'Jane Doe', 'email': 'jane.doe@example.com', 'active': True},
+    'orders': [{'id': i, 'sku': f'SKU-{i:05d}', 'quantity': i % 7 + 1, 'price': 19.99 + i,
+                'status': 'shipped' if i % 3 else 'pending'} for i in range(40)],
+    'notes': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20,
+}
+
+
+def available(codec, compression):
+    try:
+        return serialization.Serializer(codec, compression, compression_threshold=0)
+    except ImportError:
+        return None
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        result = function(*args)
+    return result, (time.perf_counter() - start) / ROUNDS
+
+
+def replicate(codec):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    db_url = 'sqlite:///' + path
+
+    writer = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, codec=codec, compression='zlib',
+                         transport=DatabaseTransport(poll_interval=0.01))
+    reader = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=DatabaseTransport(poll_interval=0.01))
+    writer.refresh_peers()
+
+    start = time.perf_counter()
+    for i in range(WRITES):
+        writer.set('key', dict(VALUE, version=i))
+    while (reader.get('key') or {}).get('version') != WRITES - 1:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    writer.close()
+    reader.close()
+
+    return elapsed / WRITES
+
+
+if __name__ == '__main__':
+    print(f"{'codec':>8} {'compression':>12} {'bytes':>7} {'encode (us)':>12} {'decode (us)':>12}")
+    for codec in ('pickle', 'json', 'msgpack'):
+        for compression in (None, 'zlib', 'lz4'):
+            serializer = available(codec, compression)
+            if serializer is None:
+                continue
+
+            data, encode = timed(serializer.dumps, VALUE)
+            _, decode = timed(serializer.loads, data)
+            print(f"{codec:>8} {str(compression):>12} {len(data):>7} {encode * 1e6:>12.1f} {decode * 1e6:>12.1f}")
+
+    print()
+    print(f"{'codec':>8} {'ms per replicated set (zlib)':>29}")
+    for codec in ('pickle', 'json'):
+        print(f"{codec:>8} {replicate(codec) * 1e3:>29.3f}")
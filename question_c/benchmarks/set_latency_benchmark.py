@@ -0,0 +1,51 @@
+
+"""
+Measures the latency of GeoLRUCache.set, with writes propagated
+synchronously and in write-behind mode.
+
+The cache runs against a temporary SQLite database in which PEERS
+other caches are registered, so that every synchronous set costs a
+scan of the registry and a write of one row per peer.
+
+"""
+
+import os
+import time
+import tempfile
+import statistics
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.models import CacheGeolocation
+
+
+PEERS = 50
+WRITES = 2000
+
+
+def measure(write_behind):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    cache = GeoLRUCache((45.5016889, -73.567256), db_url='sqlite:///' + path, write_behind=write_behind)
+    for i in range(PEERS):
+        cache.session.add(CacheGeolocation(latitude=40 + i / 10, longitude=-80 + i / 10))
+    cache.session.commit()
+
+    latencies = []
+    for i in range(WRITES):
+        start = time.perf_counter()
+        cache.set(f'key{i % 100}', 'value')
+        latencies.append(time.perf_counter() - start)
+
+    cache.close()
+    os.remove(path)
+
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+if __name__ == '__main__':
+    print(f"{'mode':>14} {'p50 (us)':>10} {'p99 (us)':>10}")
+    for name, write_behind in (('synchronous', False), ('write-behind', True)):
+        p50, p99 = measure(write_behind)
+        print(f"{name:>14} {p50 * 1e6:>10.1f} {p99 * 1e6:>10.1f}")
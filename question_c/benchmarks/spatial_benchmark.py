@@ -0,0 +1,52 @@
+
+"""
+Measures k-nearest and radius queries over the registered caches:
+
+- linear:  sort_by_distance over every cache, then keep the k nearest,
+           or the caches within the radius
+- indexed: the SpatialIndex (k-d tree on the unit sphere), whose
+           build time is reported separately
+
+"""
+
+import random
+import time
+
+from lrucache.spatial import SpatialIndex
+from lrucache.utils import sort_by_distance
+
+
+SIZES = (10000, 100000)
+QUERIES = 20
+K = 10
+RADIUS = 500000
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    print(f"{'caches':>8} {'build (ms)':>11} {'query':>14} {'linear (ms)':>12} {'indexed (ms)':>13} {'speedup':>8}")
+
+    for size in SIZES:
+        locations = [(random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(size)]
+        origins = [(random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(QUERIES)]
+
+        index, build = timed(SpatialIndex, locations)
+
+        queries = (
+            (f'nearest({K})', lambda origin: sort_by_distance(origin, locations)[:K],
+                             lambda origin: index.nearest(origin, K)),
+            (f'within({RADIUS // 1000}km)', lambda origin: [i for i in sort_by_distance(origin, locations) if i[1] <= RADIUS],
+                                           lambda origin: index.within(origin, RADIUS)),
+        )
+
+        for name, linear_query, indexed_query in queries:
+            linear = sum(timed(linear_query, origin)[1] for origin in origins) / QUERIES
+            indexed = sum(timed(indexed_query, origin)[1] for origin in origins) / QUERIES
+            print(f"{size:>8} {build * 1e3:>11.1f} {name:>14} {linear * 1e3:>12.3f} {indexed * 1e3:>13.3f} "
+                  f"{linear / indexed:>7.0f}x")
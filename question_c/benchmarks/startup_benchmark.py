@@ -0,0 +1,71 @@
+"""
+Measures what starting a cache costs a short-lived process (a CLI tool, a
+serverless function), each run in a fresh interpreter:
+
+- import: the time `import lrucache.geo_lrucache` takes. SQLAlchemy, NumPy
+  and asyncio are only imported once a cache needs them.
+- construct: the time `GeoLRUCache(...)` takes to return, which includes
+  creating the tables and registering a replicating cache.
+- ready: the time until the cache's listener thread has started and the
+  cache's first write is done.
+- modules: the number of modules the interpreter has loaded by then.
+
+A local cache (db_url=False) never needs a database, and is compared to a
+replicating cache on a SQLite database.
+
+"""
+
+import os
+import sys
+import json
+import tempfile
+import statistics
+import subprocess
+
+
+RUNS = 10
+
+SCRIPT = """
+import sys
+import json
+import time
+
+start = time.perf_counter()
+from lrucache.geo_lrucache import GeoLRUCache
+imported = time.perf_counter()
+
+cache = GeoLRUCache((45.5016889, -73.567256), db_url={db_url!r})
+constructed = time.perf_counter()
+
+cache.bootstrapped.wait()
+cache.set('key', 'value')
+ready = time.perf_counter()
+
+print(json.dumps({{'import': imported - start, 'construct': constructed - imported, 'ready': ready - constructed,
+                   'modules': len(sys.modules), 'sqlalchemy': 'sqlalchemy' in sys.modules}}))
+cache.close()
+"""
+
+
+def run(db_url):
+    results = []
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, '-c', SCRIPT.format(db_url=db_url)], capture_output=True,
+                                text=True, check=True, env=os.environ).stdout
+        results.append(json.loads(output))
+
+    return results
+
+
+if __name__ == '__main__':
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    print(f"{'cache':>12} {'import (ms)':>12} {'construct (ms)':>15} {'ready (ms)':>11} {'modules':>8} {'sqlalchemy':>11}")
+    for name, db_url in (('local', False), ('replicating', 'sqlite:///' + path)):
+        results = run(db_url)
+        median = {column: statistics.median(result[column] for result in results) * 1e3
+                  for column in ('import', 'construct', 'ready')}
+
+        print(f"{name:>12} {median['import']:>12.1f} {median['construct']:>15.2f} {median['ready']:>11.2f} "
+              f"{results[0]['modules']:>8} {str(results[0]['sqlalchemy']):>11}")
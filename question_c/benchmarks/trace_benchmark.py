@@ -0,0 +1,93 @@
+"""
+Replays synthetic access traces against a cache with each eviction
+policy, and reports the hit ratio and the operations per second.
+
+- zipf:       reads of Zipf-distributed (s=0.9) keys; each miss loads the
+              key and sets it on the cache
+- zipf+scan:  the same, with a scan of one-off keys every 20000 reads
+- replicated: the same reads, interleaved with writes of one-off keys
+              replicated from other caches (one for every local read)
+
+"""
+
+import os
+import time
+import random
+import tempfile
+import itertools
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import InProcessTransport
+from lrucache.policies import POLICIES
+
+
+CAPACITY = 1000
+KEYS = 50000
+READS = 200000
+SCAN_EVERY = 20000
+SCAN_LENGTH = 5000
+
+
+def zipf_reads(generator):
+    weights = list(itertools.accumulate(1 / rank ** 0.9 for rank in range(1, KEYS + 1)))
+    return generator.choices(range(KEYS), cum_weights=weights, k=READS)
+
+
+def make_traces():
+    generator = random.Random(0)
+    reads = zipf_reads(generator)
+    one_off = itertools.count(KEYS)
+
+    scans = []
+    for i, key in enumerate(reads):
+        if i % SCAN_EVERY == 0:
+            scans.extend(('read', next(one_off)) for _ in range(SCAN_LENGTH))
+        scans.append(('read', key))
+
+    replicated = []
+    for key in reads:
+        replicated.append(('read', key))
+        replicated.append(('receive', next(one_off)))
+
+    return {
+        'zipf': [('read', key) for key in reads],
+        'zipf+scan': scans,
+        'replicated': replicated,
+    }
+
+
+def replay(policy, trace):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    cache = GeoLRUCache((45.5016889, -73.567256), db_url='sqlite:///' + path, transport=InProcessTransport(),
+                        max_size=CAPACITY, expires_in=None, policy=policy)
+
+    hits = reads = 0
+    start = time.perf_counter()
+
+    for operation, key in trace:
+        if operation == 'receive':
+            cache.receive([(key, key, None)])
+            continue
+
+        reads += 1
+        if cache.get(key) is None:
+            cache.set(key, key)
+        else:
+            hits += 1
+
+    elapsed = time.perf_counter() - start
+    cache.close()
+
+    return hits / reads, len(trace) / elapsed
+
+
+if __name__ == '__main__':
+    traces = make_traces()
+
+    print(f"{'trace':>11} {'policy':>8} {'hit ratio':>10} {'ops/s':>10}")
+    for name, trace in traces.items():
+        for policy in POLICIES:
+            hit_ratio, throughput = replay(policy, trace)
+            print(f"{name:>11} {policy:>8} {hit_ratio:>10.3f} {throughput:>10.0f}")
@@ -0,0 +1,76 @@
+"""
+Measures what a snapshot buys a restarted cache. A cache is filled by a
+Zipf-distributed (s=0.9) read trace, snapshotted, then "restarted": the
+first reads after the restart are replayed on an empty (cold) cache and
+on a cache loaded from the snapshot (warm), each miss setting the key.
+
+Also reports the time taken to write and to load the snapshot, and its size.
+
+"""
+
+import os
+import time
+import random
+import tempfile
+import itertools
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache.transports import InProcessTransport
+
+
+CAPACITY = 100000
+KEYS = 1000000
+WARMUP_READS = 500000
+READS_AFTER_RESTART = 20000
+
+
+def make_cache(db_url):
+    return GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=InProcessTransport(),
+                       max_size=CAPACITY, expires_in=3600)
+
+
+def replay(cache, reads):
+    hits = 0
+    for key in reads:
+        if cache.get(key) is None:
+            cache.set(key, f'value-{key}')
+        else:
+            hits += 1
+
+    return hits / len(reads)
+
+
+if __name__ == '__main__':
+    generator = random.Random(0)
+    weights = list(itertools.accumulate(1 / rank ** 0.9 for rank in range(1, KEYS + 1)))
+    reads = generator.choices(range(KEYS), cum_weights=weights, k=WARMUP_READS + READS_AFTER_RESTART)
+
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    db_url = 'sqlite:///' + path
+    snapshot_path = path + '.snapshot'
+
+    cache = make_cache(db_url)
+    replay(cache, reads[:WARMUP_READS])
+
+    start = time.perf_counter()
+    saved = cache.snapshot(snapshot_path)
+    snapshot_time = time.perf_counter() - start
+    cache.close()
+
+    cold = make_cache(db_url)
+    cold_hit_ratio = replay(cold, reads[WARMUP_READS:])
+    cold.close()
+
+    warm = make_cache(db_url)
+    start = time.perf_counter()
+    loaded = warm.load(snapshot_path)
+    load_time = time.perf_counter() - start
+    warm_hit_ratio = replay(warm, reads[WARMUP_READS:])
+    warm.close()
+
+    print(f"{'items':>7} {'size (MB)':>10} {'snapshot (s)':>13} {'load (s)':>9} {'cold hits':>10} {'warm hits':>10}")
+    print(f"{saved:>7} {os.path.getsize(snapshot_path) / 1e6:>10.1f} {snapshot_time:>13.3f} {load_time:>9.3f} "
+          f"{cold_hit_ratio:>10.3f} {warm_hit_ratio:>10.3f}")
+
+    os.remove(snapshot_path)
@@ -0,0 +1,639 @@
+
+import os
+import time
+import asyncio
+import inspect
+import logging
+
+from functools import partial
+
+from .base import BaseGeoLRUCache
+from .publisher import WriteBehindPublisher, AsyncWriteBehindPublisher
+from .loader import AsyncSingleFlight, should_refresh_early
+from .invalidation import DELETE, INVALIDATE_PREFIX, INVALIDATE_TAG, apply_invalidation
+from .snapshot import write_snapshot, load_snapshot, load_items
+from .utils import to_deadline, run_in_thread
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGeoLRUCache(BaseGeoLRUCache):
+    """
+    The asyncio version of GeoLRUCache. Items are set and read with the
+    `aset`, `aget` and `aset_many` coroutines, and the cache replicates its
+    writes through an AsyncReplicationTransport, from tasks on the event loop
+    rather than from a thread of its own. Many caches can thus share one
+    process, and one event loop.
+
+    The cache only replicates once started, with `await cache.start()` or
+    `async with AsyncGeoLRUCache(...) as cache:`, and until closed.
+
+    Async and threaded caches that share a database see each other's
+    writes through AsyncDatabaseTransport, which is the default. With
+    `db_url=False`, the cache is purely local, as a GeoLRUCache is.
+
+    """
+
+    def __init__(self, coordinates, max_size=1024, expires_in=1*60, db_url=None, transport=None,
+                 write_behind=False, flush_interval=0.05, flush_batch_size=1000, max_pending_writes=10000,
+                 overflow_policy=WriteBehindPublisher.BLOCK, peer_refresh_interval=1,
+                 neighbour_aware=False, neighbour_request_timeout=0.5, neighbour_address=None, shards=1,
+                 max_bytes=None, sizer=None, policy='lru', replication_scope=None, region=None,
+                 codec='pickle', compression=None, compression_threshold=1024, accept_codecs=(),
+                 snapshot_path=None, snapshot_interval=None, bootstrap=False, bootstrap_timeout=5,
+                 tombstone_ttl=None, node_id=None, pool_size=5, max_overflow=10, busy_timeout=5):
+        """
+        The arguments are those of GeoLRUCache, except for:
+
+        :param transport: the AsyncReplicationTransport through which the cache sends its
+                          writes to, and receives writes from, the other caches. Defaults to
+                          an AsyncDatabaseTransport. Caches that share an event loop can share
+                          an AsyncInProcessTransport instead.
+        :param peer_refresh_interval: time, in seconds, between two checks of the database
+                                      for caches that have registered. The checks are made
+                                      by a background task, so writes never wait for them.
+        :param snapshot_path: as for GeoLRUCache, but the snapshot is loaded by `start`
+        :param snapshot_interval: time, in seconds, between two snapshots taken by a
+                                  background task, on the event loop's executor
+        :param bootstrap: as for GeoLRUCache, but the cache catches up within `start`
+
+        """
+
+        super().__init__(coordinates, max_size, expires_in, db_url, shards, max_bytes, sizer, policy,
+                         replication_scope, region, codec, compression, compression_threshold, accept_codecs,
+                         tombstone_ttl, node_id)
+
+        if self.db_url is False and (transport is not None or write_behind or neighbour_aware or
+                                     neighbour_address not in (None, False) or bootstrap):
+            raise ValueError("A cache without a database (db_url=False) can't replicate, "
+                             "nor answer or ask its neighbours")
+
+        self.peer_refresh_interval = peer_refresh_interval
+        self.__peers = []
+
+        # A local cache has nothing to replicate through
+        self.engine = self.Session = self.peer_index = self.transport = None
+        self.__engine_released = True
+
+        if self.db_url is not False:
+            self.__connect(transport, pool_size, max_overflow, busy_timeout)
+
+        # Deduplicates the concurrent loads of aget_or_set
+        self.single_flight = AsyncSingleFlight()
+
+        self.neighbour_aware = int(neighbour_aware)
+        self.neighbour_request_timeout = neighbour_request_timeout
+        self.neighbour_address = neighbour_address
+        self.address = None
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.max_pending_writes = max_pending_writes
+        self.overflow_policy = overflow_policy
+        self.publisher = None
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.__synced_at = None
+
+        self.bootstrap = bootstrap
+        self.bootstrap_timeout = bootstrap_timeout
+
+        # Only a cache given its node id can come back for its registration
+        self.keep_registration = node_id is not None
+
+        self.__listener = None
+        self.__tasks = []
+        self.__snapshotting = None
+        self.__started = False
+
+    def __connect(self, transport, pool_size, max_overflow, busy_timeout):
+        """
+        Set up what replicating takes: the database engine, the list of peers,
+        and the transport. SQLAlchemy, and the modules that depend on it, are
+        only imported here, so that local caches start fast.
+
+        """
+
+        from sqlalchemy.orm import sessionmaker, scoped_session
+
+        from .database import get_engine
+        from .peers import PeerIndex
+        from .async_transports import AsyncDatabaseTransport
+
+        # Creating the engine doesn't connect to the database yet. Blocking calls
+        # run on the executor's threads, each of which gets a session of its own.
+        self.engine = get_engine(self.db_url, pool_size=pool_size, max_overflow=max_overflow,
+                                 busy_timeout=busy_timeout)
+        self.__engine_released = False
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+
+        self.peer_index = PeerIndex(self.coordinates, refresh_interval=self.peer_refresh_interval,
+                                    node_id=self.node_id)
+
+        self.transport = transport if transport is not None else AsyncDatabaseTransport()
+
+        return
+
+    async def start(self):
+        """
+        Register the cache with the application, and start the tasks that
+        receive the other caches' writes and keep the list of caches fresh.
+        Every blocking database call is made on the event loop's executor.
+        A local cache only loads its snapshot, and starts taking snapshots.
+
+        """
+
+        if self.__started:
+            return self
+
+        self.__started = True
+
+        if self.engine is not None:
+            from .database import create_schema
+
+            # Create the tables in the database if they don't already exist
+            await run_in_thread(create_schema, self.engine)
+
+        # Warm start: the items of the last snapshot are loaded before the
+        # cache listens, so that newer writes from other caches replace them
+        if self.snapshot_path is not None and os.path.exists(self.snapshot_path):
+            try:
+                await self.load()
+            except Exception:
+                logger.exception("Failed to load the snapshot %s", self.snapshot_path)
+
+        loop = asyncio.get_running_loop()
+
+        if self.transport is not None:
+            await self.__start_replicating(loop)
+
+        if self.snapshot_path is not None and self.snapshot_interval:
+            self.__tasks.append(loop.create_task(self.__snapshot_periodically()))
+
+        return self
+
+    async def __start_replicating(self, loop):
+
+        self.transport.subscribe(self)
+
+        # Start answering the neighbours' requests before registering,
+        # so that the cache registers the address it answers them on
+        if self.neighbour_address is not False and (self.neighbour_aware or self.neighbour_address is not None):
+            self.address = await self.transport.serve(self, self.neighbour_address or ('127.0.0.1', 0))
+
+        await run_in_thread(self.__register)
+        await self.refresh_peers()
+
+        # The writes made meanwhile wait in the transport until the listener starts
+        if self.bootstrap:
+            await self.catch_up()
+
+        if self.write_behind:
+            self.publisher = AsyncWriteBehindPublisher(self, flush_interval=self.flush_interval,
+                                                       batch_size=self.flush_batch_size,
+                                                       max_pending=self.max_pending_writes,
+                                                       overflow=self.overflow_policy)
+
+        self.__listener = loop.create_task(self.transport.listen(self))
+        self.__tasks.append(loop.create_task(self.__refresh_peers_periodically()))
+
+        return
+
+    async def close(self, deregister=None):
+        """
+        Shuts the cache down: propagates the writes that are still waiting
+        in write-behind mode, then stops the cache's tasks. The cache can
+        still be used locally afterwards, as it could before it was started.
+
+        :param deregister: see GeoLRUCache.close
+        """
+
+        was_started = self.__started
+
+        if self.publisher is not None:
+            await self.publisher.close()
+            self.publisher = None
+
+        if self.transport is not None:
+            await self.transport.unsubscribe(self)
+
+        # The listener returns once unsubscribed; the other tasks never do
+        for task in self.__tasks:
+            task.cancel()
+
+        listener = [self.__listener] if self.__listener is not None else []
+        await asyncio.gather(*listener, *self.__tasks, return_exceptions=True)
+        self.__listener = None
+        self.__tasks = []
+        self.__started = False
+
+        if self.__snapshotting is not None:
+            await asyncio.gather(self.__snapshotting, return_exceptions=True)
+            self.__snapshotting = None
+
+        if deregister is None:
+            deregister = not self.keep_registration
+
+        if deregister and was_started and not self.__engine_released:
+            try:
+                await run_in_thread(self.__deregister)
+            except Exception:
+                logger.exception("Failed to deregister the cache")
+
+        if not self.__engine_released:
+            from .database import release_engine
+
+            self.__engine_released = True
+            release_engine(self.engine)
+
+        if self.snapshot_path is not None:
+            await self.snapshot()
+
+        return
+
+    async def snapshot(self, path=None):
+        """
+        Save the cache's items to a snapshot file, on the event loop's
+        executor. See GeoLRUCache.snapshot.
+
+        :param path: the path of the file. Defaults to the cache's `snapshot_path`.
+        :return: the number of items saved
+        """
+
+        path = path if path is not None else self.snapshot_path
+        if path is None:
+            raise ValueError("No snapshot path was given")
+
+        return await run_in_thread(write_snapshot, path, self.store, self.serializer)
+
+    async def load(self, path=None):
+        """
+        Set the items of a snapshot file on the cache, without propagating
+        them, on the event loop's executor. See GeoLRUCache.load.
+
+        :param path: the path of the file. Defaults to the cache's `snapshot_path`.
+        :return: the number of items loaded
+        """
+
+        path = path if path is not None else self.snapshot_path
+        if path is None:
+            raise ValueError("No snapshot path was given")
+
+        loaded, taken_at = await run_in_thread(load_snapshot, self, path)
+        self.__synced_at = max(self.__synced_at or taken_at, taken_at)
+
+        return loaded
+
+    async def catch_up(self):
+        """
+        Fetch the unexpired items of the nearest peer that has any, and set
+        them on the cache without propagating them. See GeoLRUCache.catch_up.
+
+        :return: the number of items set
+        """
+
+        targets = [coordinates for coordinates, _ in self.__peers]
+
+        try:
+            items = await self.transport.fetch_items(self, targets, self.__synced_at, self.bootstrap_timeout)
+        except Exception:
+            logger.exception("Failed to catch up with the other caches")
+            return 0
+
+        return await run_in_thread(load_items, self, items)
+
+    async def __snapshot_periodically(self):
+
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            # Cancelling the task doesn't stop a snapshot being written on the
+            # executor: close() waits for it before taking the last snapshot
+            self.__snapshotting = asyncio.ensure_future(self.snapshot())
+            try:
+                await asyncio.shield(self.__snapshotting)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to snapshot the cache to %s", self.snapshot_path)
+
+    async def __aenter__(self):
+
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+
+        await self.close()
+
+    def __register(self):
+
+        from .database import with_retries
+        from .peers import register
+
+        session = self.Session()
+        try:
+            with_retries(session, partial(register, cache=self))
+        finally:
+            session.close()
+
+    def __deregister(self):
+
+        from .database import with_retries
+        from .peers import deregister
+
+        session = self.Session()
+        try:
+            with_retries(session, partial(deregister, cache=self))
+        finally:
+            session.close()
+
+    async def refresh_peers(self):
+        """
+        Check the registry for caches that have registered since the
+        last check, on the event loop's executor
+
+        :return: a list of (coordinates, distance) tuples
+        """
+
+        if self.peer_index is None:
+            return []
+
+        def refresh():
+            session = self.Session()
+            try:
+                return self.peer_index.sorted(session, refresh=True)
+            finally:
+                session.close()
+
+        self.__peers = await run_in_thread(refresh)
+
+        return self.__peers
+
+    async def __refresh_peers_periodically(self):
+
+        while True:
+            await asyncio.sleep(self.peer_refresh_interval)
+
+            try:
+                await self.refresh_peers()
+            except Exception:
+                logger.exception("Failed to refresh the list of caches")
+
+    def sort_distances(self):
+        """
+        Get the caches registered with the application, other than this
+        cache, sorted from the closest to the furthest to this cache, as
+        of the last refresh. Never touches the database.
+
+        :return: a list of (coordinates, distance) tuples
+        """
+
+        return self.__peers
+
+    async def flush(self, timeout=None):
+        """
+        In write-behind mode, propagate every write that is waiting to
+        be propagated, and wait until they are. Does nothing otherwise.
+
+        :param timeout: the maximum time, in seconds, to wait
+        :return: True if every write was propagated, False on timeout
+        """
+
+        if self.publisher is None:
+            return True
+
+        return await self.publisher.flush(timeout)
+
+    async def propagate(self, items, scope=None):
+        """
+        Propagate writes made on this cache, either right away or,
+        in write-behind mode, through the background publisher
+
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        """
+
+        # A local cache keeps its writes to itself, and so does one
+        # that isn't started yet, or is closed
+        if self.transport is None or not self.__started:
+            return
+
+        if self.publisher is not None:
+            await self.publisher.put(items, scope)
+        else:
+            await self.publish(items, scope)
+
+        return
+
+    async def publish(self, items, scope=None):
+        """
+        Propagate writes made on this cache to the other caches registered
+        in the environment that are within the writes' scope, nearest first
+
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        """
+
+        targets = (scope or self.replication_scope).select(self, self.__peers)
+        await self.transport.publish(self, targets, items)
+
+        return
+
+    async def aset(self, key, value, ttl=None, scope=None, tags=None):
+        """
+        Set an item on the cache, and propagate it to the other caches
+
+        :param key: key to set the item with on the cache
+        :param value: value of the item to set on the cache
+        :param ttl: the time-to-live of the item, in seconds, if not the cache's `expires_in`
+        :param scope: the ReplicationScope of the write, if not the cache's
+        :param tags: an iterable of strings the item is tagged with, for `ainvalidate_tag`
+        """
+
+        version = self.clock.now()
+        tags = tuple(tags) if tags is not None else None
+        await self.propagate([(key, value, to_deadline(ttl if ttl is not None else self.expires_in), version, tags)],
+                             scope)
+        self._set_local(key, value, ttl=ttl, version=version, tags=tags)
+
+        return
+
+    async def aset_many(self, items, ttl=None, scope=None, tags=None):
+        """
+        Set several items on the cache at once. The items are propagated
+        to the other caches together, in a single write to the transport.
+
+        :param items: a dict, or an iterable of (key, value) pairs
+        :param ttl: the time-to-live of the items, in seconds, if not the cache's `expires_in`
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        :param tags: an iterable of strings every item is tagged with
+        """
+
+        if hasattr(items, 'items'):
+            items = items.items()
+        items = list(items)
+
+        deadline = to_deadline(ttl if ttl is not None else self.expires_in)
+        tags = tuple(tags) if tags is not None else None
+        items = [(key, value, deadline, self.clock.now(), tags) for key, value in items]
+        await self.propagate(items, scope)
+
+        for key, value, _, version, _ in items:
+            self._set_local(key, value, ttl=ttl, version=version, tags=tags)
+
+        return
+
+    async def adelete(self, key, scope=None):
+        """
+        Delete an item from the cache, and from the other caches, see GeoLRUCache.delete
+
+        :param key: key of the item to delete
+        :param scope: the ReplicationScope of the deletion, if not the cache's
+        """
+
+        return await self.adelete_many([key], scope)
+
+    async def adelete_many(self, keys, scope=None):
+        """
+        Delete several items from the cache, and from the other caches
+
+        :param keys: an iterable of the keys of the items to delete
+        :param scope: the ReplicationScope of the deletions, if not the cache's
+        """
+
+        items = [(key, DELETE, None, self.clock.now(), None) for key in keys]
+        await self.propagate(items, scope)
+
+        for key, invalidation, _, version, _ in items:
+            apply_invalidation(self, key, invalidation, version)
+
+        return
+
+    async def ainvalidate_prefix(self, prefix, scope=None):
+        """
+        Delete the items whose key starts with `prefix` from the cache, and
+        from the other caches, see GeoLRUCache.invalidate_prefix
+
+        :return: the number of items deleted from this cache
+        """
+
+        return await self.__invalidate(prefix, INVALIDATE_PREFIX, scope)
+
+    async def ainvalidate_tag(self, tag, scope=None):
+        """
+        Delete the items set with `tag` from the cache, and
+        from the other caches, see GeoLRUCache.invalidate_tag
+
+        :return: the number of items deleted from this cache
+        """
+
+        return await self.__invalidate(tag, INVALIDATE_TAG, scope)
+
+    async def __invalidate(self, pattern, invalidation, scope):
+
+        version = self.clock.now()
+        await self.propagate([(pattern, invalidation, None, version, None)], scope)
+
+        return apply_invalidation(self, pattern, invalidation, version)
+
+    async def aget(self, key):
+        """
+        Get an item from the cache. A neighbour-aware cache asks its
+        nearest neighbours for items it doesn't have.
+
+        :param key: key of item to get from within the cache
+        :return: returns the value of the item accessed, if it's present,
+                 else None
+        """
+
+        entry = self._get_entry(key)
+
+        if entry is not None:
+            return entry.value
+
+        if self.neighbour_aware:
+            return await self.request_from_neighbours(key)
+
+        return None
+
+    async def aget_or_set(self, key, loader, ttl=None, stale_while_revalidate=0, early_refresh=0, tags=None):
+        """
+        The asyncio version of GeoLRUCache.get_or_set. Concurrent misses of the
+        same key only call `loader` once, and stale or early refreshes run as tasks.
+
+        :param loader: a coroutine function, or a callable, that takes no argument
+                       and returns the value of the item
+        """
+
+        load = partial(self.__load, key, loader, ttl, stale_while_revalidate, tuple(tags) if tags is not None else None)
+
+        entry = self._get_entry(key)
+
+        if entry is not None:
+            if entry.freshness is not None:
+                fresh_until, load_time = entry.freshness
+                now = time.monotonic()
+
+                if now >= fresh_until or should_refresh_early(now, fresh_until, load_time, early_refresh):
+                    self.single_flight.do_in_background(key, load)
+
+            return entry.value
+
+        if self.neighbour_aware:
+            value = await self.request_from_neighbours(key)
+            if value is not None:
+                return value
+
+        return await self.single_flight.do(key, load)
+
+    async def __load(self, key, loader, ttl, stale_while_revalidate, tags):
+
+        started_at = time.monotonic()
+        value = loader()
+        if inspect.isawaitable(value):
+            value = await value
+        load_time = time.monotonic() - started_at
+
+        if ttl is None:
+            ttl = self.expires_in
+
+        version = self.clock.now()
+
+        if ttl is None:
+            await self.propagate([(key, value, None, version, tags)])
+            self._set_local(key, value, version=version, tags=tags)
+        else:
+            # The item stays in the cache while it may be served stale, and
+            # on the other caches while it is fresh, see GeoLRUCache.get_or_set
+            await self.propagate([(key, value, to_deadline(ttl), version, tags)])
+            self._set_local(key, value, ttl=ttl + stale_while_revalidate,
+                            freshness=(time.monotonic() + ttl, load_time), version=version, tags=tags)
+
+        return value
+
+    async def request_from_neighbours(self, key):
+        """
+        Ask the cache's nearest neighbours for an item it doesn't have,
+        and save the item if one of them has it
+
+        :param key: key of the item
+        :return: returns the value of the item, if a neighbour had it,
+                 else None
+        """
+
+        if not self.__started:
+            return None
+
+        targets = [i[0] for i in self.__peers]
+        item = await self.transport.fetch(self, targets, key, self.neighbour_request_timeout,
+                                          count=self.neighbour_aware)
+
+        if item is None:
+            return None
+
+        # The item is only copied from the neighbour,
+        # so it isn't propagated again
+        return self._copy_from_neighbour(item)
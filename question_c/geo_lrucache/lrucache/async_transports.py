@@ -0,0 +1,348 @@
+
+import time
+import asyncio
+import logging
+
+from functools import partial
+
+from .transports import DatabaseTransport
+from .database import with_retries
+from .utils import run_in_thread
+from .neighbours import serve_neighbours, async_first_hit, async_request_item, async_request_items
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncReplicationTransport:
+    """
+    Base class of the channels through which AsyncGeoLRUCache instances
+    replicate their writes to one another. The counterpart of
+    ReplicationTransport, whose blocking hooks are coroutines here, so that
+    replication runs as tasks on the event loop instead of on threads.
+
+    A transport may be shared by several caches on the same event loop.
+    Caches are addressed by their node ids.
+
+    """
+
+    def __init__(self):
+
+        self._servers = dict()
+
+    def subscribe(self, cache):
+        """
+        Start accepting writes addressed to `cache`. Called before
+        the cache registers itself.
+
+        :param cache: the AsyncGeoLRUCache instance
+        """
+
+        return
+
+    async def listen(self, cache):
+        """
+        Deliver the writes addressed to `cache` to its `receive` method,
+        until `unsubscribe` is called or the task running it is cancelled
+
+        :param cache: the AsyncGeoLRUCache instance
+        """
+
+        raise NotImplementedError
+
+    async def publish(self, cache, targets, items):
+        """
+        Send writes made on `cache` to other caches
+
+        :param cache: the AsyncGeoLRUCache instance that made the writes
+        :param targets: the coordinates of the caches to send the writes
+                        to, nearest first
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        """
+
+        raise NotImplementedError
+
+    async def unsubscribe(self, cache):
+        """
+        Stop delivering writes to `cache`, which makes `listen` return,
+        and stop answering its neighbours' lookups
+
+        :param cache: the AsyncGeoLRUCache instance
+        """
+
+        server = self._servers.pop(cache, None)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+        return
+
+    async def serve(self, cache, address):
+        """
+        Start answering the lookups of `cache`'s neighbours
+
+        :param cache: the AsyncGeoLRUCache instance
+        :param address: the (host, port) pair to answer lookups on
+        :return: the address to register the cache with, if any
+        """
+
+        server = await serve_neighbours(cache, address)
+        self._servers[cache] = server
+
+        host, port = server.sockets[0].getsockname()[:2]
+        return f"{host}:{port}"
+
+    async def fetch(self, cache, targets, key, timeout, count=1):
+        """
+        Ask the nearest `count` targets that answer lookups for an item,
+        concurrently. A target that can't be reached is replaced by the
+        next nearest one, see ReplicationTransport.fetch.
+
+        :param cache: the AsyncGeoLRUCache instance that missed the item
+        :param targets: the coordinates of the caches to ask, nearest first
+        :param key: the key of the item
+        :param timeout: the maximum time, in seconds, to wait for an answer
+        :param count: the number of targets to get an answer from
+        :return: the first (key, value, deadline, version, tags) item found, or None
+        """
+
+        addresses = [cache.peer_index.address_of(coordinates) for coordinates in targets]
+        addresses = [address for address in addresses if address is not None]
+
+        return await async_first_hit([partial(async_request_item, address, key, timeout, cache.serializer)
+                                      for address in addresses], timeout, count)
+
+    async def fetch_items(self, cache, targets, since, timeout, count=3):
+        """
+        Get the unexpired items of the nearest target that answers lookups
+        and has any, for `cache` to catch up with. See
+        ReplicationTransport.fetch_items.
+
+        :param cache: the AsyncGeoLRUCache instance that is catching up
+        :param targets: the coordinates of the caches to ask, nearest first
+        :param since: a UNIX timestamp, or None
+        :param timeout: the maximum time, in seconds, a request may take
+        :param count: the number of targets to ask, at most
+        :return: a list of (key, value, deadline, version, tags) tuples, oldest first
+        """
+
+        addresses = [cache.peer_index.address_of(coordinates) for coordinates in targets]
+        addresses = [address for address in addresses if address is not None][:count]
+
+        for address in addresses:
+            try:
+                items = await async_request_items(address, since, timeout, cache.serializer)
+            except Exception:
+                logger.debug("Failed to fetch the items of %s", address, exc_info=True)
+                continue
+
+            if items:
+                return items
+
+        return []
+
+
+class AsyncDatabaseTransport(AsyncReplicationTransport):
+    """
+    Replicates writes through the datastore table of the database, exactly
+    like DatabaseTransport, so that async caches and threaded caches can
+    share a database and see each other's writes.
+
+    SQLAlchemy's blocking sessions are kept off the event loop: each query
+    runs on the loop's default executor, and the task polling the table
+    sleeps with asyncio.sleep.
+
+    """
+
+    def __init__(self, poll_interval=0.5, batch_size=5000, compaction_interval=60):
+        """
+        :param poll_interval: time, in seconds, that a cache waits between
+                              polls of the datastore table
+        :param batch_size: the maximum number of rows a cache fetches
+                           and applies at once
+        :param compaction_interval: time, in seconds, between two compactions of
+                                    the rows addressed to a cache, see DatabaseTransport
+        """
+
+        super().__init__()
+
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._stopped = dict()
+
+        # Does the actual reading and writing of rows
+        self._database = DatabaseTransport(poll_interval=poll_interval, batch_size=batch_size,
+                                           compaction_interval=compaction_interval)
+
+    def subscribe(self, cache):
+
+        self._stopped[cache] = asyncio.Event()
+        return
+
+    async def unsubscribe(self, cache):
+
+        await super().unsubscribe(cache)
+
+        stopped = self._stopped.get(cache)
+        if stopped is not None:
+            stopped.set()
+
+        return
+
+    @staticmethod
+    def run(cache, operation):
+        """
+        Run a database operation with the session of the executor's thread
+        it runs on, tried again on transient errors, and close the session
+
+        """
+
+        session = cache.Session()
+        try:
+            return with_retries(session, operation)
+        finally:
+            session.close()
+
+    async def listen(self, cache):
+
+        stopped = self._stopped[cache]
+        compact_at = self._database.next_compaction(first=True)
+
+        try:
+            while not stopped.is_set():
+                # The rows are applied from the executor's thread,
+                # which the cache's store is safe to be used from
+                try:
+                    await run_in_thread(self.run, cache, partial(self._database.consume, cache))
+                except Exception:
+                    logger.exception("Failed to consume the datastore table")
+
+                if compact_at is not None and time.monotonic() >= compact_at:
+                    try:
+                        await run_in_thread(self.run, cache, partial(self._database.compact, cache))
+                    except Exception:
+                        logger.exception("Failed to compact the datastore table")
+                    compact_at = self._database.next_compaction()
+
+                try:
+                    await asyncio.wait_for(stopped.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._database._cursors.pop(cache, None)
+
+        return
+
+    async def publish(self, cache, targets, items):
+
+        if not targets or not items:
+            return
+
+        def write():
+            # The session of the executor's thread, as several
+            # publishes may be running on the executor at once
+            session = cache.Session()
+            try:
+                self._database.write(session, targets, self._database.encode(cache, items))
+            finally:
+                session.close()
+
+        await run_in_thread(write)
+
+        return
+
+
+class AsyncInProcessTransport(AsyncReplicationTransport):
+    """
+    Replicates writes directly between async caches that live on the same
+    event loop, through one asyncio.Queue per cache. Nothing is written to
+    the database, and no thread is involved.
+
+    All the caches that should see each other's writes must be given the
+    same AsyncInProcessTransport instance. Neighbours' lookups are answered
+    by calling the caches directly.
+
+    """
+
+    # Put on a cache's queue to make its listener return
+    _STOP = object()
+
+    def __init__(self):
+
+        super().__init__()
+
+        self._queues = dict()
+        self._caches = dict()
+
+    def subscribe(self, cache):
+
+        self._queues[cache.node_id] = asyncio.Queue()
+        self._caches[cache.node_id] = cache
+
+        return
+
+    async def unsubscribe(self, cache):
+
+        messages = self._queues.pop(cache.node_id, None)
+        self._caches.pop(cache.node_id, None)
+
+        if messages is not None:
+            messages.put_nowait(AsyncInProcessTransport._STOP)
+
+        return
+
+    async def listen(self, cache):
+
+        messages = self._queues[cache.node_id]
+
+        while True:
+            items = await messages.get()
+
+            if items is AsyncInProcessTransport._STOP:
+                break
+
+            cache.receive(items)
+
+        return
+
+    async def publish(self, cache, targets, items):
+
+        items = list(items)
+
+        for coordinates in targets:
+            messages = self._queues.get(cache.peer_index.node_id_of(coordinates))
+
+            if messages is not None:
+                messages.put_nowait(items)
+
+        return
+
+    async def serve(self, cache, address):
+
+        # Subscribed caches can already be reached directly
+        return None
+
+    async def fetch(self, cache, targets, key, timeout, count=1):
+
+        peers = [self._caches.get(cache.peer_index.node_id_of(coordinates)) for coordinates in targets]
+        peers = [peer for peer in peers if peer is not None][:count]
+
+        # Lookups never block, so the peers are simply asked in turn
+        for peer in peers:
+            item = peer.lookup_item(key)
+            if item is not None:
+                return item
+
+        return None
+
+    async def fetch_items(self, cache, targets, since, timeout, count=3):
+
+        peers = [self._caches.get(cache.peer_index.node_id_of(coordinates)) for coordinates in targets]
+        peers = [peer for peer in peers if peer is not None][:count]
+
+        for peer in peers:
+            items = peer.export(since)
+            if items:
+                return items
+
+        return []
@@ -0,0 +1,345 @@
+
+import os
+import time
+import json
+
+from .store import ShardedStore
+from .scopes import AllPeers
+from .sizing import get_sizer
+from .serialization import Serializer
+from .clock import HybridLogicalClock
+from .invalidation import Invalidation, InvalidationRules, apply_invalidation, drop_if_invalidated
+from .snapshot import export_items
+from .utils import evict, validate_coordinates, clean_up, to_ttl, DB_NAME
+
+
+my_dir = os.path.abspath(os.path.dirname(__file__))
+
+
+
+class InvalidCoordinatesError(Exception):
+    pass
+
+
+class BaseGeoLRUCache:
+    """
+    What GeoLRUCache and AsyncGeoLRUCache have in common: the items the cache
+    holds, their expiry and eviction, their versions, and the tombstones and
+    invalidation rules that refuse late writes. None of it does any I/O, so
+    the async cache calls it straight from the event loop.
+
+    Subclasses replicate the writes, and read through from the neighbours.
+
+    """
+
+    DEFAULT_DATABASE_URL = 'sqlite:///' + os.path.join(my_dir, DB_NAME + '.db')
+
+    def __init__(self, coordinates, max_size, expires_in, db_url, shards, max_bytes, sizer, policy,
+                 replication_scope, region, codec, compression, compression_threshold, accept_codecs, tombstone_ttl,
+                 node_id):
+        """
+        See GeoLRUCache for the arguments
+        """
+
+        if not validate_coordinates(coordinates):
+            raise InvalidCoordinatesError("Coordinates must be a 2-length container of floats (or 'floatable' strings)")
+
+        if db_url is None:
+            self.db_url = BaseGeoLRUCache.DEFAULT_DATABASE_URL
+        else:
+            self.db_url = db_url
+
+        self.coordinates = tuple(coordinates)
+        self.max_size = max_size
+        self.expires_in = expires_in
+
+        # Items are only measured if there is a byte budget, or a sizer to measure them with
+        self.max_bytes = max_bytes
+        if sizer is None and max_bytes is not None:
+            sizer = 'getsizeof'
+        self.sizer = get_sizer(sizer) if sizer is not None else None
+
+        # Replicated values are encoded once per write, whatever the number of targets
+        self.serializer = Serializer(codec, compression, compression_threshold, accept_codecs)
+
+        # Versions the cache's writes, for last-writer-wins
+        self.clock = HybridLogicalClock(node_id)
+        self.node_id = self.clock.origin
+
+        # Deleted keys leave tombstones in the store, and invalidated prefixes and tags leave rules here
+        self.tombstone_ttl = tombstone_ttl if tombstone_ttl is not None else (expires_in or 60)
+        self.invalidations = InvalidationRules()
+
+        self.replication_scope = replication_scope if replication_scope is not None else AllPeers()
+        self.region = region
+
+        self.__store = ShardedStore(shards, policy=policy, capacity=max_size)
+        self.__oldest_item = None
+
+    def receive(self, items):
+        """
+        Save items that were propagated from other caches. Called by
+        the transport, from the listener thread or the event loop.
+
+        :param items: a list of (key, value, deadline, version, tags) tuples, where the deadline
+                      is the wall-clock time at which the item expires, or None to use the
+                      cache's own `expires_in`, the version is the (timestamp, origin) version
+                      of the write, or None, and the tags are a tuple of the item's tags, or None.
+                      An item is only set if the cache doesn't have a later version of it. Items
+                      whose value is an Invalidation remove items instead, see `delete`. Shorter
+                      tuples, down to (key, value) pairs, are accepted too.
+        """
+
+        for key, value, *meta in items:
+            ttl = to_ttl(meta[0]) if meta else None
+            version = meta[1] if len(meta) > 1 else None
+            tags = meta[2] if len(meta) > 2 else None
+
+            # The item has already expired on the cache that set it
+            if ttl is not None and ttl <= 0:
+                continue
+
+            if version is not None:
+                self.clock.update(version)
+
+            if isinstance(value, Invalidation):
+                apply_invalidation(self, key, value, version)
+                continue
+
+            # Items received are never propagated again
+            self._set_local(key, value, ttl=ttl, version=version, tags=tags)
+
+        return
+
+    def export(self, since=None):
+        """
+        Get the cache's unexpired items, on behalf of a cache that is
+        catching up with it
+
+        :param since: a UNIX timestamp. If given, only the items set or
+                      read since then are returned.
+        :return: a list of (key, value, deadline, version, tags) tuples, from the least
+                 to the most recently used
+        """
+
+        return export_items(self.__store, since)
+
+    @property
+    def store(self):
+
+        return self.__store
+
+    @property
+    def oldest_item(self):
+
+        if self.__oldest_item is None:
+            # Save the first item in the cache as the oldest item
+            oldest_entry = self.__store.oldest()
+            if oldest_entry is not None:
+                self.__oldest_item = (oldest_entry.key, oldest_entry.value)
+
+        return self.__oldest_item
+
+    @oldest_item.setter
+    def set_oldest_item(self, item=None):
+
+        self.__oldest_item = item
+        return
+
+    @clean_up
+    def _set_local(self, key, value, ttl=None, freshness=None, version=None, tags=None):
+        """
+        Save an item on the cache itself, without propagating it, unless
+        the cache has a later version of it, or has deleted or invalidated
+        it later
+
+        :param key: key to set the item with on the cache
+        :param value: value of the item to set on the cache
+        :param ttl: the time-to-live of the item, in seconds, if not the cache's `expires_in`
+        :param freshness: the (fresh_until, load_time) pair of an item loaded by get_or_set
+        :param version: the version of the write, or None
+        :param tags: a tuple of the tags of the item, or None
+        :return: False if a later write, deletion or invalidation of the item
+                 has already been applied, else True
+        """
+
+        now = time.monotonic()
+
+        if ttl is None:
+            ttl = self.expires_in
+
+        expires_at = now + ttl if ttl is not None else None
+        size = self.sizer(value) if self.sizer is not None else 0
+
+        # An item larger than the whole byte budget would evict every other
+        # item, then itself. It isn't kept, and neither is the value it replaces
+        # (unless that value was written after it).
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.__store.delete(key, version)
+            return True
+
+        entry = self.__store.set(key, value, now, expires_at, size, version, tags)
+
+        # A later write to the key, or a later deletion of it, has already been applied
+        if entry is None:
+            return False
+
+        # and so has a later invalidation of its prefix or one of its tags
+        if drop_if_invalidated(self, key, tags, version):
+            return False
+
+        entry.freshness = freshness
+
+        # Enforce the byte budget as soon as it is exceeded, rather
+        # than on the next operation, as one item can be large
+        if self.max_bytes is not None:
+            evict(self)
+
+        return True
+
+    @clean_up
+    def _get_entry(self, key):
+        """
+        Get an item's entry from the cache itself, and mark it as used
+
+        :param key: key of the item
+        :return: the entry, or None if the cache doesn't have the item
+        """
+
+        return self.__store.get(key, time.monotonic())
+
+    def lookup(self, key):
+        """
+        Get an item on behalf of a neighbouring cache. Unlike get(), the item
+        isn't marked as used, and the cache never asks its own neighbours.
+
+        :param key: key of the item
+        :return: returns the value of the item, if it's present, else None
+        """
+
+        item = self.lookup_item(key)
+
+        return item[1] if item is not None else None
+
+    def lookup_item(self, key):
+        """
+        Get an item, along with its deadline, version and tags, on behalf of a
+        neighbouring cache, so that the copy the neighbour keeps expires with
+        the item, and yields to the later writes and deletions of the key
+
+        :param key: key of the item
+        :return: a (key, value, deadline, version, tags) tuple, where the deadline is
+                 a UNIX timestamp or None, if the item is present, else None
+        """
+
+        entry = self.__store.peek(key)
+        now = time.monotonic()
+
+        if entry is None or entry.value is None or (entry.expires_at is not None and entry.expires_at < now):
+            return None
+
+        deadline = time.time() + (entry.expires_at - now) if entry.expires_at is not None else None
+
+        return entry.key, entry.value, deadline, entry.version, entry.tags
+
+    def _copy_from_neighbour(self, item):
+        """
+        Save an item a neighbour had, without propagating it. The copy keeps
+        the item's deadline and version, so that a deletion of the key made
+        after the neighbour's write is never undone by reading it through.
+
+        :param item: the (key, value, deadline, version, tags) tuple the neighbour answered
+        :return: the value of the item, or None if the item has expired, or if
+                 the cache has a later write, deletion or invalidation of it
+        """
+
+        key, value, deadline, version, tags = item
+        ttl = to_ttl(deadline)
+
+        if ttl is not None and ttl <= 0:
+            return None
+
+        if version is not None:
+            self.clock.update(version)
+
+        if not self._set_local(key, value, ttl=ttl, version=version, tags=tags):
+            return None
+
+        return value
+
+    def empty(self):
+        """
+        Empties the cache, and forgets its tombstones and invalidations.
+        Only this cache is emptied: see `invalidate_prefix` and `invalidate_tag`
+        to remove items from every cache.
+
+        """
+
+        self.__oldest_item = None
+        self.__store.clear()
+        self.invalidations.clear()
+
+        return
+
+    @clean_up
+    def size(self):
+
+        return len(self.__store)
+
+    @clean_up
+    def bytes_used(self):
+        """
+        :return: the total size, in bytes, of the items in the cache, as
+                 measured by the cache's sizer. 0 if the cache has none.
+        """
+
+        return self.__store.total_bytes
+
+    @clean_up
+    def __contains__(self, key):
+        """
+        Checks if a key is present in the cache
+
+        :param key: the key of the item whose presence is to be checked
+        :return: returns True or False depending on whether or not the
+                 item is present.
+        """
+
+        entry = self.__store.peek(key)
+
+        if entry is not None and entry.value is not None:
+            return True
+
+        return False
+
+    def __delitem__(self, key):
+        """
+        Delete an item from within the cache using its key. Only this
+        cache's copy is deleted: see `delete` to delete it everywhere.
+
+        :param key: key of item to delete from the cache
+
+        """
+        self.__store.delete(key)
+
+        return
+
+    @clean_up
+    def __repr__(self):
+        """
+        Convinience function that returns an API-like description
+        of the cache. Simply added in case of a future API-requirement.
+
+        """
+        cache = {
+            'number_of_items': len(self.__store),
+            'coordinates': self.coordinates,
+            'oldest_item': self.oldest_item,
+            'maximum_size': self.max_size,
+            'bytes_used': self.__store.total_bytes,
+            'maximum_bytes': self.max_bytes,
+            'each_item_expires_in': self.expires_in,
+            'items': {entry.key: entry.value for entry in self.__store}
+        }
+
+        return json.dumps(cache)
@@ -0,0 +1,65 @@
+
+import time
+import random
+import threading
+
+
+class HybridLogicalClock:
+    """
+    A hybrid logical clock, which versions the writes of a cache. Its
+    timestamps follow the wall clock, in milliseconds, but never go back,
+    and are always later than the timestamps of every write the cache has
+    received. A write made after another one was seen is therefore always
+    versioned later, even if the caches' wall clocks disagree.
+
+    A version is a (timestamp, origin) tuple, where the origin is the random
+    id of the clock's cache, so that two versions are never equal, and the
+    latest of two writes to a key (last-writer-wins) is the greatest.
+
+    A timestamp packs the milliseconds into its upper bits, and a counter
+    that orders the writes made within one millisecond into its lower
+    LOGICAL_BITS, so that timestamps are plain 64-bit integers.
+
+    """
+
+    LOGICAL_BITS = 16
+
+    def __init__(self, origin=None):
+        """
+        :param origin: the id of the clock's cache, an integer that fits
+                       in 63 bits. Defaults to a random one.
+        """
+
+        self.origin = origin if origin is not None else random.getrandbits(63)
+
+        self.__last = 0
+        self.__lock = threading.Lock()
+
+    def now(self):
+        """
+        Version a write made by this cache
+
+        :return: a (timestamp, origin) tuple, later than every version
+                 this clock has made or seen
+        """
+
+        physical = (time.time_ns() // 1000000) << HybridLogicalClock.LOGICAL_BITS
+
+        with self.__lock:
+            self.__last = max(self.__last + 1, physical)
+            return self.__last, self.origin
+
+    def update(self, version):
+        """
+        Take a write received from another cache into account
+
+        :param version: the (timestamp, origin) version of the write
+        """
+
+        timestamp = version[0]
+
+        if timestamp > self.__last:
+            with self.__lock:
+                self.__last = max(self.__last, timestamp)
+
+        return
@@ -0,0 +1,229 @@
+import time
+import random
+import logging
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+
+logger = logging.getLogger(__name__)
+
+
+# The engines of the process, shared by the caches connecting to the same database with the
+# same options, as (engine, number of caches using it) pairs keyed by the url and the options
+_engines = dict()
+_engines_lock = threading.Lock()
+
+# The engines whose database has had its tables created
+_schemas = set()
+_schemas_lock = threading.Lock()
+
+# serialization_failure and deadlock_detected: the database rolled back
+# the transaction so that another could go on, and it can be tried again
+_TRANSIENT_SQLSTATES = ('40001', '40P01')
+
+# The messages of SQLite's SQLITE_BUSY and SQLITE_LOCKED errors
+_TRANSIENT_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+
+
+def _is_sqlite_memory(url):
+
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def _uses_queue_pool(url):
+    """
+    :param url: a database url
+    :return: True if the dialect pools the connections of the url in a QueuePool,
+             which is the only pool that `pool_size`, `max_overflow` and `pool_timeout`
+             apply to. SQLite files, for one, get a NullPool from SQLAlchemy 1.3,
+             and a QueuePool from 1.4 on.
+    """
+
+    return issubclass(url.get_dialect().get_pool_class(url), QueuePool)
+
+
+def _configure_sqlite(engine, busy_timeout):
+    """
+    Make every new connection of a SQLite engine wait up to `busy_timeout`
+    seconds for a lock, rather than failing with 'database is locked' at once,
+    and switch the database file to write-ahead logging, with which readers
+    and the writer no longer block each other
+
+    """
+
+    @event.listens_for(engine, 'connect')
+    def configure(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+            # The journal mode is stored in the database file, so this only changes it once
+            cursor.execute("PRAGMA journal_mode = WAL")
+        finally:
+            cursor.close()
+
+    return
+
+
+def get_engine(db_url, pool_size=5, max_overflow=10, pool_timeout=30, busy_timeout=5):
+    """
+    This function gets the engine connecting to a database. Caches of the
+    same process that connect to the same database with the same options
+    share one engine, and its pool of connections, until `release_engine`
+    is called by all of them. Connections are checked before they are used
+    (pre-ping), so that connections the database dropped are replaced.
+    The pool options are only given to dialects that pool their connections
+    in a QueuePool, and are ignored otherwise.
+
+    :param db_url: the database url, in SQLAlchemy connection string format
+    :param pool_size: the number of connections kept open in the pool
+    :param max_overflow: the number of connections opened on top of `pool_size`
+                         when every pooled connection is in use, and closed when
+                         given back
+    :param pool_timeout: time, in seconds, to wait for a connection when
+                         `pool_size + max_overflow` are in use
+    :param busy_timeout: time, in seconds, that a SQLite connection waits for
+                         another to release a lock
+    :return: the engine
+    """
+
+    key = (str(db_url), pool_size, max_overflow, pool_timeout, busy_timeout)
+
+    with _engines_lock:
+        if key in _engines:
+            engine, users = _engines[key]
+            _engines[key] = (engine, users + 1)
+            return engine
+
+        url = make_url(db_url)
+
+        # An in-memory SQLite database lives and dies with its connection,
+        # one per thread: it has no pool to size, nor a file to log to
+        if _is_sqlite_memory(url):
+            engine = create_engine(url)
+        else:
+            if _uses_queue_pool(url):
+                options = dict(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout)
+            else:
+                options = dict()
+
+            engine = create_engine(url, pool_pre_ping=True, **options)
+
+            if url.get_backend_name() == 'sqlite':
+                _configure_sqlite(engine, busy_timeout)
+
+        _engines[key] = (engine, 1)
+
+    return engine
+
+
+def release_engine(engine):
+    """
+    This function releases an engine got from `get_engine`. Once every cache
+    using it has released it, the connections of its pool are closed. The
+    engine stays usable, and opens connections again if it is used.
+
+    :param engine: the engine
+    """
+
+    with _engines_lock:
+        for key, (shared, users) in _engines.items():
+            if shared is engine:
+                if users > 1:
+                    _engines[key] = (engine, users - 1)
+                    return
+
+                del _engines[key]
+                break
+
+    with _schemas_lock:
+        _schemas.discard(engine)
+
+    engine.dispose()
+
+    return
+
+
+def create_schema(engine):
+    """
+    This function creates the tables of the cache registry and of the
+    datastore in an engine's database, if they don't exist, the first
+    time it is called for the engine. Later calls return at once.
+
+    :param engine: the engine
+    """
+
+    if engine in _schemas:
+        return
+
+    from .models import Base
+
+    with _schemas_lock:
+        if engine not in _schemas:
+            Base.metadata.create_all(engine)
+            _schemas.add(engine)
+
+    return
+
+
+def is_transient(error):
+    """
+    :param error: an exception raised by a database operation
+    :return: True if the operation may succeed if tried again: the connection
+             was lost, the database was locked or busy, or the transaction
+             was rolled back by the database as a serialization failure or a
+             deadlock. Other errors, such as a missing table, a database file
+             that can't be opened or a syntax error, fail again if retried.
+    """
+
+    if not isinstance(error, DBAPIError):
+        return False
+
+    if error.connection_invalidated:
+        return True
+
+    # The SQLSTATE of PostgreSQL errors (psycopg2 names it pgcode)
+    if getattr(error.orig, 'pgcode', None) in _TRANSIENT_SQLSTATES:
+        return True
+
+    if isinstance(error, OperationalError):
+        message = str(error.orig).lower()
+        return any(fragment in message for fragment in _TRANSIENT_MESSAGES)
+
+    return False
+
+
+def with_retries(session, operation, attempts=4, backoff=0.05):
+    """
+    This function runs a database operation, and runs it again, after a
+    growing random delay, if it fails with a transient error (see
+    `is_transient`). The session is rolled back after every failure.
+
+    :param session: the database session the operation uses
+    :param operation: a callable that takes the session
+    :param attempts: the maximum number of times the operation is run
+    :param backoff: the delay, in seconds, before the second attempt. Each
+                    attempt waits twice as long as the one before, give or
+                    take a random half, so that writers that failed together
+                    don't retry together.
+    :return: what the operation returns
+    :raises: the error of the last attempt, or the first error that isn't transient
+    """
+
+    for attempt in range(attempts):
+        try:
+            return operation(session)
+        except Exception as error:
+            session.rollback()
+
+            if attempt == attempts - 1 or not is_transient(error):
+                raise
+
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.debug("Retrying a database operation in %.3fs after: %s", delay, error)
+            time.sleep(delay)
+
+    return
@@ -0,0 +1,100 @@
+
+import heapq
+
+
+class ExpiryHeap:
+    """
+    The expiry index of the cache. A min-heap of cache entries, ordered by
+    deadline, that lets the cache find the items that have expired without
+    walking every item it holds.
+
+    The heap uses lazy deletion: when an item is overwritten or deleted, its
+    old heap entry is left in place and is simply skipped when it is popped,
+    because it is no longer the entry held in `entries`. To stop the heap
+    from growing without bound on workloads that keep overwriting the same
+    keys, it is rebuilt from `entries` once the stale entries outnumber the
+    live ones.
+
+    """
+
+    # Do not bother compacting small heaps
+    COMPACTION_THRESHOLD = 64
+
+    def __init__(self, entries):
+        """
+        :param entries: the cache's key -> CacheEntry mapping. It is the source
+                        of truth that heap entries are checked against.
+        """
+
+        self.__entries = entries
+        self.__heap = []
+
+    def __len__(self):
+
+        return len(self.__heap)
+
+    @property
+    def next_deadline(self):
+        """
+        The earliest deadline in the heap, or None if the heap is empty
+        """
+
+        try:
+            return self.__heap[0].expires_at
+        except IndexError:
+            return None
+
+    def push(self, entry):
+        """
+        Index an entry's deadline. Must be called every time an
+        entry with a deadline is added to `entries`.
+
+        :param entry: the CacheEntry of the item
+        """
+
+        heapq.heappush(self.__heap, entry)
+
+        if len(self.__heap) > max(2 * len(self.__entries), ExpiryHeap.COMPACTION_THRESHOLD):
+            self.compact()
+
+        return
+
+    def pop_expired(self, now):
+        """
+        Remove and return all the entries whose deadline is earlier
+        than `now`. Only the expired entries are ever touched, so
+        each call costs O(k log n) for k expired items.
+
+        :param now: the current time
+        :return: a list of the expired entries
+        """
+
+        heap = self.__heap
+        entries = self.__entries
+        expired = []
+
+        while heap and heap[0].expires_at < now:
+            entry = heapq.heappop(heap)
+
+            # Skip the entries of items that have since been
+            # overwritten or deleted
+            if entries.get(entry.key) is entry:
+                expired.append(entry)
+
+        return expired
+
+    def compact(self):
+        """
+        Rebuild the heap from the live entries, dropping stale ones
+
+        """
+
+        self.__heap = [entry for entry in self.__entries.values() if entry.expires_at is not None]
+        heapq.heapify(self.__heap)
+
+        return
+
+    def clear(self):
+
+        self.__heap.clear()
+        return
@@ -1,26 +1,25 @@
 
 import os
 import time
-import json
+import logging
 import threading
 
+from functools import partial
 from collections import OrderedDict
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from .base import BaseGeoLRUCache, InvalidCoordinatesError
+from .publisher import WriteBehindPublisher
+from .loader import SingleFlight, should_refresh_early
+from .invalidation import DELETE, INVALIDATE_PREFIX, INVALIDATE_TAG, apply_invalidation
+from .snapshot import write_snapshot, load_snapshot, load_items
+from .utils import propagate_write, to_deadline
 
-from .models import CacheGeolocation, CacheDataStore, Base, DB_NAME
-from .utils import validate_coordinates, get_distance, clean_up, propagate_write
 
-my_dir = os.path.abspath(os.path.dirname(__file__))
+logger = logging.getLogger(__name__)
 
 
 
-class InvalidCoordinatesError(Exception):
-    pass
-
-
-class GeoLRUCache:
+class GeoLRUCache(BaseGeoLRUCache):
     """
     A geolocation-based LRUCache with optional time expiration. Geolocation is 
     implemented using coordinates, i.e. a (latitude, longitude) pair
@@ -30,15 +29,21 @@ class GeoLRUCache:
 
     """
 
-    DEFAULT_DATABASE_URL = 'sqlite:///' + os.path.join(my_dir, DB_NAME + '.db')
-
-    def __init__(self, coordinates, max_size=1024, expires_in=1*60, db_url=None):
+    def __init__(self, coordinates, max_size=1024, expires_in=1*60, db_url=None, transport=None,
+                 write_behind=False, flush_interval=0.05, flush_batch_size=1000, max_pending_writes=10000,
+                 overflow_policy=WriteBehindPublisher.BLOCK, peer_refresh_interval=1,
+                 neighbour_aware=False, neighbour_request_timeout=0.5, neighbour_address=None, shards=1,
+                 max_bytes=None, sizer=None, policy='lru', replication_scope=None, region=None,
+                 codec='pickle', compression=None, compression_threshold=1024, accept_codecs=(),
+                 snapshot_path=None, snapshot_interval=None, bootstrap=False, bootstrap_timeout=5,
+                 tombstone_ttl=None, node_id=None, pool_size=5, max_overflow=10, busy_timeout=5):
         """
         :param coordinates: the latitude-longitude pair of the cache's location
         :param max_size: the maximum number of items the cache can store before
                          removing the oldest item. Defaults to 1024 items.
-        :param expires_in: the time-to-live (in seconds) of each item in the cache.
-                           defaults to one minute (60 seconds)
+        :param expires_in: the default time-to-live (in seconds, fractions included) of
+                           each item in the cache. defaults to one minute (60 seconds).
+                           `set` and `set_many` can give items a ttl of their own.
 
         :param db_url: the database url (in SQLAlchemy connection string format) that 
                        the cache connects to to synchronize itself with other caches
@@ -46,197 +51,755 @@ class GeoLRUCache:
                        http://docs.sqlalchemy.org/en/latest/core/engines.html, on the
                        format of the string to be supplied. If none is supplied, it 
                        defaults to an sqlite database in the file's working directory.
+                       False makes a purely local cache, which neither replicates nor
+                       connects to any database (SQLAlchemy isn't even imported).
+        :param transport: the ReplicationTransport through which the cache sends its writes
+                          to, and receives writes from, the other caches. Defaults to a
+                          PostgresNotifyTransport on PostgreSQL (psycopg2), and to a polling
+                          DatabaseTransport on any other database. Caches that share a
+                          process can share an InProcessTransport instead.
+
+        :param write_behind: Boolean keyword argument. If True, setting an item only writes it
+                             to the cache itself; propagating it to the other caches is left
+                             to a background publisher, which flushes the writes in batches.
+                             A write that is not yet flushed is lost if the process crashes.
+        :param flush_interval: time, in seconds, that a write may wait in write-behind mode
+                               before it is propagated. Defaults to 50 milliseconds.
+        :param flush_batch_size: the maximum number of writes propagated at once in
+                                 write-behind mode
+        :param max_pending_writes: the maximum number of writes waiting to be propagated in
+                                   write-behind mode. Writes to the same key are coalesced.
+        :param overflow_policy: what setting an item does when `max_pending_writes` writes are
+                                already waiting: 'block' waits for space, 'drop_oldest' drops the
+                                oldest waiting write, and 'caller_runs' propagates the waiting
+                                writes on the caller's thread.
+        :param peer_refresh_interval: time, in seconds, for which the cache trusts its memoized
+                                      list of the other caches before it checks the database
+                                      for caches that have registered since. Defaults to one second.
 
-        -------------------------------------------------------------------------------
-        ---------------------------------*Future Upgrade*------------------------------
         :param neighbour_aware: Boolean keyword argument to make the cache aware of its 
                                 nearest neighbour. If True, when an item is requested 
                                 from the cache and it does not have said item, it asks 
                                 its nearest neigbour for the item, all within a specified
                                 timeout period. If the nearest neighbour has the item, it 
-                                returns the item, else it returns None.
+                                saves and returns the item, else it returns None.
+                                An integer k makes the cache ask its k nearest neighbours
+                                in parallel, and take the first answer.
         
         :param neighbour_request_timeout: time, in seconds, within which a request to the cache's
                                           nearest neighbour must be completed before the request
                                           times out.
-        ----------------------------------------------------------------------------------------
-        ----------------------------------------------------------------------------------------
+        :param neighbour_address: the (host, port) pair on which the cache answers its own
+                                  neighbours' requests. Neighbour-aware caches answer on a
+                                  free port of 127.0.0.1 by default; other caches only answer
+                                  if given an address. False never answers.
+        :param shards: the number of independently locked shards the cache's items are split
+                       into. The cache is thread-safe either way, but with one shard every
+                       operation takes the same lock. With several, threads using different
+                       keys rarely wait for one another, and the oldest item is evicted
+                       approximately rather than exactly.
+        :param max_bytes: the maximum total size, in bytes, of the items the cache can store
+                          before removing the oldest items, on top of `max_size`. None (the
+                          default) only limits the number of items. An item larger than
+                          `max_bytes` isn't kept at all.
+        :param sizer: how the size of an item's value is measured: 'getsizeof' (sys.getsizeof,
+                      the default when there is a byte budget), 'pickle' or 'json' (the length
+                      of the value once serialized), or a callable that takes a value and
+                      returns its size in bytes
+        :param policy: how the cache chooses the item to evict: 'lru' (the least recently used
+                       item, the default), 'sieve', 'arc' or 'tinylfu' (W-TinyLFU), which
+                       keep one-off keys (scans, far-away caches' writes) from flushing out
+                       the popular items, or an EvictionPolicy subclass. With several shards,
+                       each shard has a policy of its own.
+        :param replication_scope: the ReplicationScope deciding which caches the cache's writes
+                                  are replicated to (see lrucache.scopes): every cache (the
+                                  default), the k nearest, those within a radius, those of the
+                                  same region, or an explicit group. `set` and `set_many` can
+                                  override it per write. Caches outside of a write's scope can
+                                  still read it through from their neighbours if neighbour-aware.
+        :param region: the region tag the cache registers with, for SameRegion scopes
+        :param codec: how values are encoded for the datastore table: 'pickle' (the default,
+                      for any picklable value, but only safe between trusted caches), 'json',
+                      'msgpack' (requires the msgpack package), 'bytes' (for values that
+                      already are bytes), or a lrucache.serialization.Codec instance. Keys and
+                      tags sent to neighbours, or saved to snapshots, are encoded with it too
+                      (with JSON for 'bytes').
+        :param compression: None (the default), 'zlib', or 'lz4' (requires the lz4 package)
+        :param compression_threshold: the encoded length, in bytes, from which values are compressed
+        :param accept_codecs: the other codecs whose writes the cache decodes, for caches sharing a
+                              database with differently configured ones. A cache only decodes its
+                              own codec by default, and never pickle unless it is its codec or is
+                              accepted here, as unpickling runs whatever code the writer put in.
+        :param snapshot_path: the path of the file the cache's items are saved to (see `snapshot`).
+                              If the file exists, the cache starts with its items, before it
+                              receives the other caches' writes. The items are saved again on close.
+        :param snapshot_interval: time, in seconds, between two snapshots taken by a background
+                                  thread. None (the default) only saves the items on close.
+        :param bootstrap: Boolean. If True, the cache catches up with its nearest peer once it has
+                          registered: it fetches the peer's unexpired items (only those set or read
+                          since its own snapshot, if it loaded one), then starts receiving the
+                          writes made since it registered. Peers must answer lookups (see
+                          `neighbour_address`), or share the cache's InProcessTransport.
+        :param bootstrap_timeout: time, in seconds, within which each step of the transfer from
+                                  a peer must be completed
+        :param tombstone_ttl: time, in seconds, for which the cache remembers a deletion or an
+                              invalidation (see `delete` and `invalidate_prefix`), and refuses
+                              the writes made before it that arrive late. Defaults to `expires_in`,
+                              after which such writes have expired anyway, or to one minute if
+                              items never expire.
+        :param node_id: the id the cache is addressed by, an integer that fits in 63 bits, which
+                        also versions its writes. Defaults to a random one. A cache restarted with
+                        the same node id takes its registration back, along with the writes made
+                        for it while it was down. Caches with a random node id deregister when
+                        closed, see `close`.
+        :param pool_size: the number of database connections kept open. Caches of the same process
+                          that connect to the same database with the same pool options share their
+                          engine, and its connections.
+        :param max_overflow: the number of connections opened on top of `pool_size` while every
+                             pooled connection is in use
+        :param busy_timeout: time, in seconds, that a SQLite connection waits for a lock before
+                             failing. SQLite databases are switched to write-ahead logging.
 
         """
         
-        if not validate_coordinates(coordinates):
-            raise InvalidCoordinatesError("Coordinates must be a 2-length container of floats (or 'floatable' strings)")
-
-        if db_url is None:
-            self.db_url = GeoLRUCache.DEFAULT_DATABASE_URL
+        super().__init__(coordinates, max_size, expires_in, db_url, shards, max_bytes, sizer, policy,
+                         replication_scope, region, codec, compression, compression_threshold, accept_codecs,
+                         tombstone_ttl, node_id)
+
+        if self.db_url is False and (transport is not None or write_behind or neighbour_aware or
+                                     neighbour_address not in (None, False) or bootstrap):
+            raise ValueError("A cache without a database (db_url=False) can't replicate, "
+                             "nor answer or ask its neighbours")
+
+        # Only a cache given its node id can come back for its registration
+        self.keep_registration = node_id is not None
+
+        # Deduplicates the concurrent loads of get_or_set
+        self.single_flight = SingleFlight()
+
+        # Warm start: the items of the last snapshot are loaded before the
+        # cache listens, so that newer writes from other caches replace them
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.__synced_at = None
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            try:
+                self.load(snapshot_path)
+            except Exception:
+                logger.exception("Failed to load the snapshot %s", snapshot_path)
+
+        self.neighbour_aware = int(neighbour_aware)
+        self.neighbour_request_timeout = neighbour_request_timeout
+        self.address = None
+
+        self.bootstrap = bootstrap
+        self.bootstrap_timeout = bootstrap_timeout
+        # Set once the cache has registered, and caught up if it bootstraps
+        self.bootstrapped = threading.Event()
+
+        self.publisher = None
+        self.listener_thread = None
+        self.__closed = threading.Event()
+
+        # A local cache has nothing to replicate through
+        self.engine = self.Session = self.peer_index = self.transport = None
+        self.__engine_released = True
+
+        if self.db_url is False:
+            self.bootstrapped.set()
         else:
-            self.db_url = db_url
+            # A database that can't be reached, or written to, fails the constructor
+            try:
+                self.__connect(transport, peer_refresh_interval, neighbour_address, pool_size, max_overflow,
+                               busy_timeout)
+                self.__register()
+            except Exception:
+                if self.transport is not None:
+                    self.transport.unsubscribe(self)
+                self.__release_engine()
+                raise
+
+            if write_behind:
+                self.publisher = WriteBehindPublisher(self, flush_interval=flush_interval,
+                                                      batch_size=flush_batch_size, max_pending=max_pending_writes,
+                                                      overflow=overflow_policy)
+
+            self.listener_thread = threading.Thread(target=self.listener, daemon=True)
+            self.listener_thread.start()
+
+        self.snapshot_thread = None
+        if snapshot_path is not None and snapshot_interval:
+            self.snapshot_thread = threading.Thread(target=self.snapshotter, daemon=True)
+            self.snapshot_thread.start()
+
+    def __connect(self, transport, peer_refresh_interval, neighbour_address, pool_size, max_overflow,
+                  busy_timeout):
+        """
+        Set up what replicating takes: the database engine, the list of
+        peers, and the transport, which starts answering the neighbours'
+        requests if asked to. SQLAlchemy, and the modules that depend on it,
+        are only imported here, so that local caches start fast.
+
+        """
+
+        from sqlalchemy.orm import sessionmaker, scoped_session
+
+        from .database import get_engine
+        from .peers import PeerIndex
+        from .transports import DatabaseTransport, PostgresNotifyTransport
+
+        self.engine = get_engine(self.db_url, pool_size=pool_size, max_overflow=max_overflow,
+                                 busy_timeout=busy_timeout)
+        self.__engine_released = False
+
+        # Sessions aren't thread-safe: each thread using the cache (the caller's,
+        # the listener, the publisher) gets a session of its own from Session()
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+
+        self.peer_index = PeerIndex(self.coordinates, refresh_interval=peer_refresh_interval, node_id=self.node_id)
+
+        if transport is None:
+            if self.engine.dialect.name == 'postgresql' and self.engine.driver == 'psycopg2':
+                transport = PostgresNotifyTransport()
+            else:
+                transport = DatabaseTransport()
+
+        self.transport = transport
+        self.transport.subscribe(self)
+
+        # Start answering the neighbours' requests before registering,
+        # so that the cache registers the address it answers them on
+        if neighbour_address is not False and (self.neighbour_aware or neighbour_address is not None):
+            self.address = self.transport.serve(self, neighbour_address or ('127.0.0.1', 0))
+
+        return
+
+    def __register(self):
+        """
+        Register the cache to the application in the distributed environment,
+        through the database, creating the tables first if they don't exist.
+        Basically, means 'subscribing' to receive messages. Called from the
+        constructor, so that a database the cache can't use fails it.
+
+        """
+
+        from .database import create_schema, with_retries
+        from .peers import register
+
+        create_schema(self.engine)
 
+        session = self.Session()
         try:
-            self.engine = create_engine(self.db_url)
-        except Exception:
-            raise
+            with_retries(session, partial(register, cache=self))
+        finally:
+            session.close()
 
-        self.coordinates = tuple(coordinates)
-        self.max_size = max_size
-        self.expires_in = expires_in
-        
-        self.Session = sessionmaker(bind=self.engine)
-        self.session = self.Session()
-
-        # Create the tables in the database if they don't already exist
-        #try:
-        Base.metadata.create_all(self.engine)
-        # except:
-        #     pass
-
-        self.__values = dict()
-        self.__access_times = OrderedDict()
-        self.__times_to_live = OrderedDict()
-        self.__oldest_item = None
-        
-        self.listener_thread = threading.Thread(target=self.listener, daemon=True)
-        self.listener_thread.start()
+        return
 
     def listener(self):
         """
         Background thread that does two things:
-        1: On cache creation, registers itself to the application in the 
-           distributed environment, through the database.
+        1: If the cache bootstraps, catches up with its nearest peer: the
+           writes made since the cache registered wait for it in the
+           transport, and are applied after.
         2: Constantly looks out for updates to any cache in the environment,
-           through the database, so it can update itself accordingly (data consistency)
+           through its transport, so it can update itself accordingly (data consistency)
         """
 
-        # Register cache to application on instance creation.
-        # Basically, means 'subscribing' to receive messages
-        session = self.Session()
-        new_cache = CacheGeolocation(latitude=self.coordinates[0], longitude=self.coordinates[1])
-        session.add(new_cache)
-        session.commit()
-
-        # Perpetually listen for writes to the database. Leverage on database read concurrency
-        while True:
-            new_item = session.query(CacheDataStore).filter(CacheDataStore.latitude == self.coordinates[0]).\
-                               filter(CacheDataStore.longitude == self.coordinates[1]).first()
-
-            if new_item is not None:
-                # Get the key and value that was recently propagated
-                key, value = new_item.key, new_item.value 
-
-                # Save the item just recently propagated to the cache.
-                # Signify the cache that this operation was done from
-                # a background thread
-                self.__setitem__(key, value, from_thread=True)
-
-                # Once set, delete the database row, as it has been consumed
-                session.delete(new_item)
-                session.commit()
-
-            # Be nice on the CPU
-            time.sleep(0.5)  
+        # Nothing waits on a listener that failed to catch up
+        try:
+            if self.bootstrap and not self.__closed.is_set():
+                self.catch_up()
+        finally:
+            self.bootstrapped.set()
+
+        # Perpetually listen for writes made by the other caches
+        try:
+            self.transport.listen(self)
+        finally:
+            self.Session.remove()
         
         return
 
+    def catch_up(self):
+        """
+        Fetch the unexpired items of the nearest peer that has any, and set
+        them on the cache without propagating them. Called from the listener
+        thread when the cache bootstraps. Failures are only logged.
+
+        :return: the number of items set
+        """
+
+        session = self.Session()
+        try:
+            targets = [coordinates for coordinates, _ in self.peer_index.sorted(session, refresh=True)]
+            items = self.transport.fetch_items(self, targets, self.__synced_at, self.bootstrap_timeout)
+        except Exception:
+            logger.exception("Failed to catch up with the other caches")
+            return 0
+        finally:
+            session.close()
+
+        return load_items(self, items)
+
+    def snapshotter(self):
+        """
+        Background thread that saves the cache's items to its snapshot
+        file every `snapshot_interval` seconds, until the cache is closed
+
+        """
+
+        while not self.__closed.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception("Failed to snapshot the cache to %s", self.snapshot_path)
+
+        return
+
+    @property
+    def session(self):
+        """
+        The database session of the calling thread, or None for a local cache
+        """
+
+        if self.Session is None:
+            return None
+
+        return self.Session()
 
+    # The three properties below are read-only snapshots of the store,
+    # kept for compatibility. Each call walks every item in the cache.
+    # Times are read from the monotonic clock (time.monotonic()).
     @property
     def access_times(self):
 
-        return self.__access_times
+        return OrderedDict((entry.key, entry.accessed_at) for entry in self.store)
 
     @property
     def times_to_live(self):
 
-        return self.__times_to_live
+        return OrderedDict((entry.key, entry.expires_at) for entry in self.store
+                           if entry.expires_at is not None)
     
     @property
     def values(self):
 
-        return self.__values
+        return {entry.key: entry.value for entry in self.store}
 
-    @property
-    def oldest_item(self):
+    def flush(self, timeout=None):
+        """
+        In write-behind mode, propagate every write that is waiting to
+        be propagated, and wait until they are. Does nothing otherwise.
+
+        :param timeout: the maximum time, in seconds, to wait
+        :return: True if every write was propagated, False on timeout
+        """
+
+        if self.publisher is None:
+            return True
+
+        return self.publisher.flush(timeout)
+
+    def close(self, deregister=None):
+        """
+        Shuts the cache down: propagates the writes that are still waiting
+        in write-behind mode, then stops listening for writes from the other
+        caches. The cache can still be used locally afterwards: its writes
+        are no longer propagated, and its misses no longer read through.
+
+        :param deregister: Boolean. If True, the cache's registration, and the rows
+                           addressed to it, are deleted, so that the other caches stop
+                           writing to it. Defaults to True for caches with a random node
+                           id, and to False for those given one, so that they can take
+                           their registration back when restarted.
+        """
+
+        self.__closed.set()
+
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+        if self.transport is not None:
+            self.transport.unsubscribe(self)
+
+        if deregister is None:
+            deregister = not self.keep_registration
+        self.keep_registration = not deregister
+
+        if deregister and not self.__engine_released:
+            try:
+                self.__deregister()
+            except Exception:
+                logger.exception("Failed to deregister the cache")
 
-        return self.__oldest_item
+        self.__release_engine()
 
-    @oldest_item.setter
-    def set_oldest_item(self, item=None):
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+            self.snapshot_thread = None
+
+        if self.snapshot_path is not None:
+            self.snapshot()
+
+        return
+
+    def __release_engine(self):
+
+        # The connections are closed once no cache uses the engine anymore
+        if not self.__engine_released:
+            from .database import release_engine
+
+            self.__engine_released = True
+            release_engine(self.engine)
 
-        self.__oldest_item = item
         return
 
+    def __deregister(self):
+
+        from .database import with_retries
+        from .peers import deregister
+
+        session = self.Session()
+        try:
+            with_retries(session, partial(deregister, cache=self))
+        finally:
+            session.close()
+
+        return
 
-    def empty(self):
+    def snapshot(self, path=None):
         """
-        Empties the cache
+        Save the cache's items, with their deadlines and in their order of
+        recency, to a binary file that `load` can start another cache with.
+        Values are encoded with the cache's codec. The file is replaced
+        atomically, so a crash never leaves a partial snapshot behind.
 
+        :param path: the path of the file. Defaults to the cache's `snapshot_path`.
+        :return: the number of items saved
         """
 
-        self.__oldest_item = None
-        self.__values.clear()
-        self.__access_times.clear()
-        self.__times_to_live.clear()
+        path = path if path is not None else self.snapshot_path
+        if path is None:
+            raise ValueError("No snapshot path was given")
 
-        return
-    
-    @clean_up
-    def size(self):
+        return write_snapshot(path, self.store, self.serializer)
 
-        return len(self.__values)
+    def load(self, path=None):
+        """
+        Set the items of a snapshot file on the cache, from the least to the most
+        recently used, without propagating them. Items that have expired since
+        the snapshot was taken are dropped. The file is read through a memory
+        map, one item at a time.
 
-    @clean_up
-    def __contains__(self, key):
+        :param path: the path of the file. Defaults to the cache's `snapshot_path`.
+        :return: the number of items loaded
         """
-        Checks if a key is present in the cache
 
-        :param key: the key of the item whose presence is to be checked
-        :return: returns True or False depending on whether or not the
-                 item is present.
+        path = path if path is not None else self.snapshot_path
+        if path is None:
+            raise ValueError("No snapshot path was given")
+
+        loaded, taken_at = load_snapshot(self, path)
+
+        # When catching up, the items set before the snapshot was taken aren't fetched again
+        self.__synced_at = max(self.__synced_at or taken_at, taken_at)
+
+        return loaded
+
+    def sort_distances(self, refresh=False):
+        """
+        Get all the caches registered with the application, other than this
+        cache, sorted from the closest to the furthest to this cache. The
+        result is memoized, and is only computed again when a cache registers.
+
+        :param refresh: Boolean. If True, check the registry for new caches
+                        right away, instead of at most every `peer_refresh_interval`
+                        seconds.
+        :return: a list of (coordinates, distance) tuples
         """
 
-        if self.__values.get(key) is not None:
-            return True
+        if self.peer_index is None:
+            return []
 
-        return False 
+        return self.peer_index.sorted(self.session, refresh=refresh)
 
+    def nearest(self, k=1, refresh=False):
+        """
+        Get the k caches registered with the application that are closest
+        to this cache
 
-    def sort_distances(self):
+        :param k: the number of caches to get
+        :param refresh: see `sort_distances`
+        :return: a list of (coordinates, distance) tuples, closest first
+        """
+
+        if self.peer_index is None:
+            return []
+
+        return self.peer_index.nearest(self.session, k, refresh=refresh)
+
+    def within(self, radius_m, refresh=False):
+        """
+        Get all the caches registered with the application that are within
+        a distance of this cache
+
+        :param radius_m: the distance, in meters
+        :param refresh: see `sort_distances`
+        :return: a list of (coordinates, distance) tuples, closest first
+        """
+
+        if self.peer_index is None:
+            return []
 
-        # A list containing the distances of all the caches registered on the application
-        # to this cache
-        distance_index = []               
+        return self.peer_index.within(self.session, radius_m, refresh=refresh)
 
-        # Get all the caches registered with the application
-        caches = self.session.query(CacheGeolocation).all() 
+    def refresh_peers(self):
+        """
+        Forget the memoized list of caches, and read the registry again
 
-        # Add the distance between this cache and each cache to the distance_index list
-        for i in caches:
-            # No need to add this cache's coordinates 
-            if self.coordinates != (i.latitude, i.longitude):
-                distance_to_me = get_distance(self.coordinates, (i.latitude, i.longitude))
-                # Add it as a tuple of the cache's coordinates and its distance to this cache
-                distance_index.append(((i.latitude, i.longitude), distance_to_me))
+        :return: a list of (coordinates, distance) tuples
+        """
 
-        # Sort the cache to get the cache closest to, furthest to this cache
-        sorted_distances = sorted(distance_index, key=lambda i: i[1])     
+        if self.peer_index is not None:
+            self.peer_index.invalidate()
 
-        return sorted_distances
+        return self.sort_distances(refresh=True)
 
+    def propagate(self, items, scope=None):
+        """
+        Propagate writes made on this cache, either right away or,
+        in write-behind mode, through the background publisher
 
-    def set(self, key, value):
+        :param items: a list of (key, value, deadline, version, tags) tuples, see `receive`
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        """
+
+        # A local cache keeps its writes to itself, and so does a closed one
+        if self.transport is None or self.__closed.is_set():
+            return
+
+        if self.publisher is not None:
+            self.publisher.put(items, scope)
+        else:
+            self.publish(items, scope)
+
+        return
+
+    def publish(self, items, scope=None):
+        """
+        Propagate writes made on this cache to the other caches registered
+        in the environment that are within the writes' scope, on the
+        caller's thread
+
+        :param items: a list of (key, value, deadline, version, tags) tuples, see `receive`
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        """
+
+        # Get a list of all the caches registered in the environment, 
+        # arranged according to their distance to this cache 
+        prioritized_distance_index = self.sort_distances()
+
+        # Hand the items to the cache's transport, addressed to every other cache.
+        # The other caches (who are by default listening on the transport) will then read
+        # the items and save them on themselves.
+        # The first item in the list is the cache closest to this cache, the next item is the cache 
+        # second-closest to this cache, and so on. That way, data will always first be available from
+        # the cache closest to this cache (locality of reference).
+        # The scope then keeps the caches the writes are meant for, still in that order.
+        targets = (scope or self.replication_scope).select(self, prioritized_distance_index)
+        self.transport.publish(self, targets, items)
+
+        return
+
+
+    def set(self, key, value, ttl=None, scope=None, tags=None):
         """
         Allows a .set(key, value) operation on the cache instance
 
         :param key: key to set the item with on the cache
         :param value: value of the item to set on the cache
+        :param ttl: the time-to-live of the item, in seconds (fractions included),
+                    if not the cache's `expires_in`. The other caches expire the
+                    item at the same time as this one.
+        :param scope: the ReplicationScope of the write, if not the cache's
+        :param tags: an iterable of strings the item is tagged with, for `invalidate_tag`
+
+        """
+
+        return self.__setitem__(key, value, ttl=ttl, scope=scope, tags=tuple(tags) if tags is not None else None)
+
+    def set_many(self, items, ttl=None, scope=None, tags=None):
+        """
+        Set several items on the cache at once. The items are propagated to
+        the other caches together, in a single write to the transport.
+
+        :param items: a dict, or an iterable of (key, value) pairs, of the
+                      items to set on the cache
+        :param ttl: the time-to-live of the items, in seconds, if not
+                    the cache's `expires_in`
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        :param tags: an iterable of strings every item is tagged with
+        """
+
+        if hasattr(items, 'items'):
+            items = items.items()
+        items = list(items)
+
+        deadline = to_deadline(ttl if ttl is not None else self.expires_in)
+        tags = tuple(tags) if tags is not None else None
+        items = [(key, value, deadline, self.clock.now(), tags) for key, value in items]
+        self.propagate(items, scope)
+
+        for key, value, _, version, _ in items:
+            # The items have already been propagated above, so
+            # save them the way propagated items are saved
+            self.__setitem__(key, value, from_thread=True, ttl=ttl, version=version, tags=tags)
+
+        return
+
+    def delete(self, key, scope=None):
+        """
+        Delete an item from the cache, and from the other caches. The
+        deletion is versioned like a write: it doesn't delete a later write
+        to the key, and the caches refuse the earlier writes that arrive
+        after it for `tombstone_ttl` seconds.
+
+        :param key: key of the item to delete
+        :param scope: the ReplicationScope of the deletion, if not the cache's
+        """
+
+        return self.delete_many([key], scope)
+
+    def delete_many(self, keys, scope=None):
+        """
+        Delete several items from the cache, and from the other
+        caches, in a single write to the transport. See `delete`.
 
+        :param keys: an iterable of the keys of the items to delete
+        :param scope: the ReplicationScope of the deletions, if not the cache's
         """
 
-        return self.__setitem__(key, value)
+        items = [(key, DELETE, None, self.clock.now(), None) for key in keys]
+        self.propagate(items, scope)
 
+        for key, invalidation, _, version, _ in items:
+            apply_invalidation(self, key, invalidation, version)
+
+        return
+
+    def invalidate_prefix(self, prefix, scope=None):
+        """
+        Delete the items whose key starts with `prefix` from the cache, and
+        from the other caches. Like a deletion, the invalidation doesn't
+        delete later writes, and refuses earlier ones for `tombstone_ttl` seconds.
+        Goes through every item of every cache.
+
+        :param prefix: a string (or bytes) prefix. Keys of other types never match.
+        :param scope: the ReplicationScope of the invalidation, if not the cache's
+        :return: the number of items deleted from this cache
+        """
+
+        return self.__invalidate(prefix, INVALIDATE_PREFIX, scope)
+
+    def invalidate_tag(self, tag, scope=None):
+        """
+        Delete the items set with `tag` from the cache, and from the other
+        caches. See `invalidate_prefix`.
+
+        :param tag: the tag of the items
+        :param scope: the ReplicationScope of the invalidation, if not the cache's
+        :return: the number of items deleted from this cache
+        """
+
+        return self.__invalidate(tag, INVALIDATE_TAG, scope)
+
+    def __invalidate(self, pattern, invalidation, scope):
+
+        version = self.clock.now()
+        self.propagate([(pattern, invalidation, None, version, None)], scope)
+
+        return apply_invalidation(self, pattern, invalidation, version)
+
+
+    def get_or_set(self, key, loader, ttl=None, stale_while_revalidate=0, early_refresh=0, tags=None):
+        """
+        Get an item from the cache, or load it with `loader` if the cache (and,
+        if the cache is neighbour-aware, its neighbours) doesn't have it. The
+        loaded item is set on the cache, and propagated like any other write.
+
+        Concurrent misses of the same key only call `loader` once: the other
+        callers wait for its result, so that an item expiring doesn't send
+        every caller to the origin at the same time.
+
+        :param key: key of the item
+        :param loader: a callable that takes no argument and returns the value of
+                       the item. Its exceptions are raised to every waiting caller,
+                       and nothing is saved.
+        :param ttl: the time-to-live, in seconds, of the loaded item. Defaults
+                    to the cache's `expires_in`.
+        :param stale_while_revalidate: time, in seconds, during which an item that
+                                       has outlived its ttl is still returned, while
+                                       it is loaded again in the background
+        :param early_refresh: how eagerly an item is loaded again, in the background,
+                              before it outlives its ttl (the beta of probabilistic
+                              early expiration). 0 never does, 1 is the usual setting.
+        :param tags: an iterable of strings the loaded item is tagged with
+        :return: the value of the item
+        """
+
+        load = partial(self.__load, key, loader, ttl, stale_while_revalidate, tuple(tags) if tags is not None else None)
+
+        entry = self._get_entry(key)
+
+        if entry is not None:
+            if entry.freshness is not None:
+                fresh_until, load_time = entry.freshness
+                now = time.monotonic()
+
+                # Stale items are still served, and hot items refreshed early,
+                # while one background load replaces them
+                if now >= fresh_until or should_refresh_early(now, fresh_until, load_time, early_refresh):
+                    self.single_flight.do_in_background(key, load)
+
+            return entry.value
+
+        if self.neighbour_aware:
+            value = self.request_from_neighbours(key)
+            if value is not None:
+                return value
+
+        return self.single_flight.do(key, load)
+
+    def __load(self, key, loader, ttl, stale_while_revalidate, tags):
+        """
+        Load an item for get_or_set, and save it along with its freshness
+        """
+
+        started_at = time.monotonic()
+        value = loader()
+        load_time = time.monotonic() - started_at
+
+        if ttl is None:
+            ttl = self.expires_in
+
+        if ttl is None:
+            self.__setitem__(key, value, tags=tags)
+        else:
+            # The item stays in the cache while it may be served stale. The other
+            # caches only get its fresh lifetime: they don't know when it goes
+            # stale, so they'd serve it stale without ever loading it again.
+            version = self.clock.now()
+            self.propagate([(key, value, to_deadline(ttl), version, tags)])
+            self._set_local(key, value, ttl=ttl + stale_while_revalidate,
+                            freshness=(time.monotonic() + ttl, load_time), version=version, tags=tags)
+
+        return value
 
     @propagate_write
-    @clean_up
-    def __setitem__(self, key, value, from_thread=False):
+    def __setitem__(self, key, value, from_thread=False, ttl=None, freshness=None, scope=None, version=None,
+                    tags=None):
         """
         Create a new item in the cache using the key, value pair
 
@@ -244,15 +807,16 @@ class GeoLRUCache:
         :param value: value of the item to set on the cache
         :param from_thread: keyword argument to differentiate when a write operation
                             is being done from a background thread or the main thread
+        :param ttl: the time-to-live of the item, in seconds, if not the cache's `expires_in`
+        :param freshness: the (fresh_until, load_time) pair of an item loaded by get_or_set
+        :param scope: the ReplicationScope the item is propagated with, if not the cache's
+        :param version: the version of the write, set by propagate_write for the cache's own
+                        writes. The item isn't set if the cache has a later version of it.
+        :param tags: a tuple of the tags of the item, or None
 
         """        
         
-        now = int(time.time())
-
-        self.__delitem__(key)
-        self.__values[key] = value
-        self.__access_times[key] = now
-        self.__times_to_live[key] = now + self.expires_in
+        self._set_local(key, value, ttl=ttl, freshness=freshness, version=version, tags=tags)
 
         return
 
@@ -268,7 +832,6 @@ class GeoLRUCache:
 
         return self.__getitem__(key)
 
-    @clean_up
     def __getitem__(self, key):
         """
         Get an item from the cache using its key. 
@@ -277,48 +840,37 @@ class GeoLRUCache:
         :return: returns the value of the item accessed, if it's present,
                  else None
         """
-        now = int(time.time())
 
-        if self.__values.get(key) is not None:
-            del self.__access_times[key]
-            self.__access_times[key] = now
+        entry = self._get_entry(key)
 
-        return self.__values.get(key)
+        if entry is not None:
+            return entry.value
 
-    
-    def __delitem__(self, key):
-        """
-        Delete an item from within the cache using its key
+        if self.neighbour_aware:
+            return self.request_from_neighbours(key)
 
-        :param key: key of item to delete from the cache
+        return None
 
-        """        
-        if self.__values.get(key):
-            self.__values.pop(key, None)
-            self.__access_times.pop(key, None)
-            self.__times_to_live.pop(key, None)
-        
-        return
+    def request_from_neighbours(self, key):
+        """
+        Ask the cache's nearest neighbours for an item it doesn't have,
+        and save the item if one of them has it
 
-    @clean_up
-    def __repr__(self):
+        :param key: key of the item
+        :return: returns the value of the item, if a neighbour had it,
+                 else None
         """
-        Convinience function that returns an API-like description
-        of the cache. Simply added in case of a future API-requirement.
 
-        """        
-        cache = {
-            'number_of_items': len(self.__values),
-            'coordinates': self.coordinates,
-            'oldest_item': self.__oldest_item,
-            'maximum_size': self.max_size,
-            'each_item_expires_in': self.expires_in,
-            'items': {k:v for k,v in self.__values.items()}
-        }
-
-        return json.dumps(cache)
-        
+        # A closed cache is only used locally
+        if self.__closed.is_set():
+            return None
 
+        targets = [i[0] for i in self.sort_distances()]
+        item = self.transport.fetch(self, targets, key, self.neighbour_request_timeout, count=self.neighbour_aware)
 
+        if item is None:
+            return None
 
-        
+        # The item is only copied from the neighbour,
+        # so it isn't propagated again
+        return self._copy_from_neighbour(item)
@@ -0,0 +1,225 @@
+
+import time
+import threading
+
+
+class Invalidation:
+    """
+    The value of a replicated item that removes items from the caches,
+    instead of setting one. The key of the item is what is removed: a key
+    (deletions), a prefix that the removed keys start with, or a tag that
+    the removed items were set with.
+
+    Invalidations are versioned like writes, and only remove the items
+    written before them (last-writer-wins). So that a write made before an
+    invalidation, but delivered after it, doesn't bring an item back, caches
+    remember their invalidations for a while: deleted keys as tombstones in
+    their store, prefixes and tags as InvalidationRules.
+
+    """
+
+    KEY = 'key'
+    PREFIX = 'prefix'
+    TAG = 'tag'
+
+    __slots__ = ('kind',)
+
+    def __init__(self, kind):
+        """
+        :param kind: what the invalidated pattern is: Invalidation.KEY,
+                     Invalidation.PREFIX or Invalidation.TAG
+        """
+
+        if kind not in (Invalidation.KEY, Invalidation.PREFIX, Invalidation.TAG):
+            raise ValueError(f"Unknown kind of invalidation {kind!r}")
+
+        self.kind = kind
+
+    def __eq__(self, other):
+
+        return isinstance(other, Invalidation) and other.kind == self.kind
+
+    def __hash__(self):
+
+        return hash((Invalidation, self.kind))
+
+    def __repr__(self):
+
+        return f"Invalidation({self.kind!r})"
+
+    def matches(self, pattern, key, tags):
+        """
+        :param pattern: the invalidated key, prefix or tag
+        :param key: the key of an item
+        :param tags: the tags of the item, or None
+        :return: True if the invalidation of `pattern` removes the item
+        """
+
+        if self.kind == Invalidation.KEY:
+            return key == pattern
+
+        if self.kind == Invalidation.PREFIX:
+            # Only string keys (or bytes keys, for a bytes prefix) have prefixes
+            return isinstance(pattern, (str, bytes)) and isinstance(key, type(pattern)) and key.startswith(pattern)
+
+        return tags is not None and pattern in tags
+
+
+# The values of replicated deletions, and of prefix and tag invalidations
+DELETE = Invalidation(Invalidation.KEY)
+INVALIDATE_PREFIX = Invalidation(Invalidation.PREFIX)
+INVALIDATE_TAG = Invalidation(Invalidation.TAG)
+
+# The invalidation of each kind, as the datastore table names them
+INVALIDATIONS = {invalidation.kind: invalidation for invalidation in (DELETE, INVALIDATE_PREFIX, INVALIDATE_TAG)}
+
+
+def pending_key(key, value):
+    """
+    The key under which a pending write is coalesced with the pending writes
+    before it, so that the invalidation of a prefix or a tag never replaces
+    a write to a key spelled the same (or the other way around)
+
+    :param key: the key of the item
+    :param value: the value of the item
+    :return: a hashable
+    """
+
+    if isinstance(value, Invalidation) and value.kind != Invalidation.KEY:
+        return value, key
+
+    return key
+
+
+class InvalidationRules:
+    """
+    The prefixes and tags a cache has recently invalidated, each with the
+    version of its latest invalidation. A versioned write that one of them
+    covers, and that is earlier than it, was made before the invalidation
+    and is removed as soon as it is set. Rules are forgotten once they have
+    outlived the cache's `tombstone_ttl`.
+
+    Checking the rules takes no lock: the rules are replaced, never
+    modified, whenever one is added.
+
+    """
+
+    def __init__(self):
+
+        self.__rules = dict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+
+        return len(self.__rules)
+
+    def add(self, invalidation, pattern, version, expires_at, now):
+        """
+        Remember an invalidation
+
+        :param invalidation: INVALIDATE_PREFIX or INVALIDATE_TAG
+        :param pattern: the invalidated prefix or tag
+        :param version: the version of the invalidation
+        :param expires_at: the time after which the rule is forgotten
+        :param now: the current time. Rules that have expired are forgotten.
+        """
+
+        with self.__lock:
+            rules = {rule: state for rule, state in self.__rules.items() if state[1] > now}
+
+            current = rules.get((invalidation, pattern))
+            if current is not None:
+                version, expires_at = max(current[0], version), max(current[1], expires_at)
+
+            rules[(invalidation, pattern)] = (version, expires_at)
+            self.__rules = rules
+
+        return
+
+    def covering(self, key, tags, version, now):
+        """
+        :param key: the key of a write
+        :param tags: the tags of the write, or None
+        :param version: the version of the write
+        :param now: the current time
+        :return: the version of the latest live rule that covers the write and
+                 is later than it, or None if the write wasn't invalidated
+        """
+
+        latest = None
+
+        for (invalidation, pattern), (rule_version, expires_at) in self.__rules.items():
+            if rule_version > version and expires_at > now and invalidation.matches(pattern, key, tags):
+                if latest is None or rule_version > latest:
+                    latest = rule_version
+
+        return latest
+
+    def clear(self):
+
+        with self.__lock:
+            self.__rules = dict()
+
+        return
+
+
+def apply_invalidation(cache, pattern, invalidation, version):
+    """
+    This function removes the items an invalidation covers from a cache,
+    unless they were written after it, and remembers the invalidation for
+    the cache's `tombstone_ttl`. Invalidating a prefix or a tag goes through
+    every item of the cache.
+
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance
+    :param pattern: the invalidated key, prefix or tag
+    :param invalidation: DELETE, INVALIDATE_PREFIX or INVALIDATE_TAG
+    :param version: the version of the invalidation. Unversioned
+                    invalidations remove every item they cover, and
+                    aren't remembered.
+    :return: the number of items removed
+    """
+
+    store = cache.store
+    now = time.monotonic()
+    until = now + cache.tombstone_ttl
+
+    if invalidation.kind == Invalidation.KEY:
+        removed = store.delete(pattern, version, now, until) is not None
+        return int(removed)
+
+    # The rule is added before the items are swept, so that a write set meanwhile
+    # is either swept, or sees the rule once set (see `drop_if_invalidated`)
+    if version is not None:
+        cache.invalidations.add(invalidation, pattern, version, until, now)
+
+    removed = 0
+    for entry in store:
+        if invalidation.matches(pattern, entry.key, entry.tags) and store.delete(entry.key, version) is not None:
+            removed += 1
+
+    return removed
+
+
+def drop_if_invalidated(cache, key, tags, version):
+    """
+    This function removes an item just set on a cache if a prefix or tag
+    invalidation later than the write covers it
+
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance
+    :param key: the key of the item
+    :param tags: the tags of the item, or None
+    :param version: the version of the write, or None. Unversioned
+                    writes are never dropped.
+    :return: True if the item was removed
+    """
+
+    if version is None or not cache.invalidations:
+        return False
+
+    latest = cache.invalidations.covering(key, tags, version, time.monotonic())
+    if latest is None:
+        return False
+
+    cache.store.delete(key, latest)
+
+    return True
@@ -0,0 +1,202 @@
+
+import math
+import random
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# Shared by every cache in the process, to refresh items in the background
+_executor = None
+_executor_lock = threading.Lock()
+
+# asyncio and inspect are imported by the methods of AsyncSingleFlight,
+# rather than here, so that threaded caches don't pay for importing them
+
+
+def should_refresh_early(now, fresh_until, load_time, beta):
+    """
+    This function decides whether an item that is still fresh should be
+    refreshed anyway, with the probabilistic early expiration of Vattani et
+    al. ("Optimal Probabilistic Cache Stampede Prevention"). The closer the
+    item is to going stale, and the longer it took to load, the likelier
+    a refresh: callers spread out their refreshes instead of all missing
+    the item at the same moment.
+
+    :param now: the current time, in seconds
+    :param fresh_until: the time the item goes stale, in seconds
+    :param load_time: the time, in seconds, the item took to load
+    :param beta: how eagerly to refresh. 0 never refreshes early, 1 is
+                 the usual setting, and more refreshes earlier.
+    """
+
+    if beta <= 0 or load_time <= 0:
+        return False
+
+    # 1 - random() is in (0, 1], so that the logarithm is defined
+    return now - load_time * beta * math.log(1 - random.random()) >= fresh_until
+
+
+class _Call:
+    """
+    A load in flight, that the callers of the same key wait on
+    """
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent loads of the same key: while a load of a key is
+    in flight, other callers wait for its result instead of loading the key
+    again. The result is not kept once the load is done; that's the cache's job.
+
+    """
+
+    def __init__(self):
+
+        self.__calls = dict()
+        self.__lock = threading.Lock()
+
+    def in_flight(self, key):
+
+        return key in self.__calls
+
+    def do(self, key, load):
+        """
+        Run `load`, unless a load of `key` is already in flight,
+        and return the result of whichever load runs
+
+        :param key: the key being loaded
+        :param load: a callable that takes no argument
+        :return: the result of the load. Its exception, if it raised,
+                 is raised to every caller.
+        """
+
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.value = load()
+            except BaseException as error:
+                call.error = error
+            finally:
+                with self.__lock:
+                    del self.__calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.value
+
+    def do_in_background(self, key, load):
+        """
+        Run `load` on a background thread, unless a load of
+        `key` is already in flight. Failures are only logged.
+
+        :param key: the key being loaded
+        :param load: a callable that takes no argument
+        """
+
+        global _executor
+
+        if self.in_flight(key):
+            return
+
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='geo_lrucache-refresh')
+
+        def refresh():
+            try:
+                self.do(key, load)
+            except Exception:
+                logger.exception("Failed to refresh %r in the background", key)
+
+        _executor.submit(refresh)
+
+        return
+
+
+class AsyncSingleFlight:
+    """
+    The asyncio version of SingleFlight. Loads may be coroutine functions
+    or plain callables. Must be used from a single event loop.
+
+    """
+
+    def __init__(self):
+
+        self.__futures = dict()
+        self.__tasks = set()
+
+    def in_flight(self, key):
+
+        return key in self.__futures
+
+    async def do(self, key, load):
+        """
+        See SingleFlight.do. A caller that is cancelled while waiting
+        doesn't cancel the load for the other callers.
+        """
+
+        import asyncio
+
+        future = self.__futures.get(key)
+
+        if future is None:
+            future = self.__futures[key] = asyncio.ensure_future(self.__load(key, load))
+
+        return await asyncio.shield(future)
+
+    async def __load(self, key, load):
+
+        import inspect
+
+        try:
+            value = load()
+            if inspect.isawaitable(value):
+                value = await value
+
+            return value
+        finally:
+            del self.__futures[key]
+
+    def do_in_background(self, key, load):
+        """
+        See SingleFlight.do_in_background. The load runs as a task.
+        """
+
+        import asyncio
+
+        if self.in_flight(key):
+            return
+
+        async def refresh():
+            try:
+                await self.do(key, load)
+            except Exception:
+                logger.exception("Failed to refresh %r in the background", key)
+
+        # Keep a reference to the task, so that it isn't collected while pending
+        task = asyncio.ensure_future(refresh())
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+        return
@@ -1,11 +1,13 @@
 
 
 
+import random
+
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float, Boolean
+from sqlalchemy import Column, Index, Integer, BigInteger, String, Text, Float, Boolean, LargeBinary
 
+from .utils import DB_NAME
 
-DB_NAME = 'ormuco'
 
 Base = declarative_base()
 
@@ -19,8 +21,21 @@ class CacheGeolocation(Base):
      __tablename__ = 'caches_geolocation'
 
      id = Column(Integer, primary_key=True)
+     # The id the cache is addressed by, which tells apart caches at
+     # the same coordinates. Caches registered without one get a random one.
+     node_id = Column(BigInteger, unique=True, default=lambda: random.getrandbits(63))
      latitude = Column(Float)
      longitude = Column(Float)
+     # The id of the last datastore row the cache has consumed. The rows
+     # addressed to it up to there can be deleted by a compaction.
+     last_consumed_id = Column(Integer, nullable=False, default=0)
+     # Where the cache answers its neighbours' lookups ("host:port"), if it does
+     address = Column(String(255), nullable=True)
+     # The region tag of the cache, if it has one
+     region = Column(String(64), nullable=True)
+     # Bumped every time the cache registers, so that peers notice
+     # a registration updated in place (e.g. a new address)
+     generation = Column(Integer, nullable=False, default=0)
 
 
 class CacheDataStore(Base):
@@ -34,7 +49,36 @@ class CacheDataStore(Base):
      __tablename__ = 'datastore'
 
      id = Column(Integer, primary_key=True)
+     # The node id of the cache the row is addressed to
+     target_node = Column(BigInteger)
+     # and its coordinates, for whoever inspects the table
      latitude = Column(Float)    
      longitude = Column(Float)
-     key = Column(String(64))
-     value = Column(String(64))
+     # The key (or, for a prefix or tag invalidation, the prefix or tag), as encoded
+     # by the writing cache's `Serializer.keys`, and a hash of the encoded key, which
+     # is what rows are looked up by, as keys can be any length
+     key = Column(LargeBinary)
+     key_hash = Column(BigInteger)
+     # The value, as encoded by the writing cache's Serializer (None for an invalidation)
+     value = Column(LargeBinary)
+     # The wall-clock time (UNIX timestamp) at which the item expires
+     # on the cache that set it, or None for the consuming cache's default
+     expires_at = Column(Float, nullable=True)
+     # The version of the write: the hybrid logical clock timestamp and
+     # the origin id of the cache that made it (see HybridLogicalClock)
+     version = Column(BigInteger, nullable=True)
+     origin = Column(BigInteger, nullable=True)
+     # The tags of the item, as a JSON list, or None
+     tags = Column(Text, nullable=True)
+     # None for a write. For an invalidation, what the key is: the
+     # deleted key ('key'), or an invalidated prefix or tag ('prefix', 'tag')
+     operation = Column(String(8), nullable=True)
+
+     # The first index finds the pending rows a newer write to the same key supersedes.
+     # The second one makes a poll read only the rows addressed to the polling cache
+     # past its cursor, whatever the number of rows addressed to the other caches.
+     # Ids must never be reused, or a cursor would skip the rows that reuse them,
+     # hence AUTOINCREMENT on SQLite (which otherwise reuses the highest deleted id).
+     __table_args__ = (Index('ix_datastore_key_hash', 'key_hash'),
+                       Index('ix_datastore_target_node_id', 'target_node', 'id'),
+                       {'sqlite_autoincrement': True})
@@ -0,0 +1,333 @@
+
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+import socketserver
+
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .snapshot import dump_items, read_items
+
+
+logger = logging.getLogger(__name__)
+
+# Shared by every cache in the process, to ask several neighbours in parallel
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def first_hit(requests, timeout, count=None):
+    """
+    This function runs requests in parallel, `count` at a time, and returns
+    the first result that isn't None. A request that fails (its neighbour
+    refused the connection, or timed out) is replaced by the next request,
+    which gets `timeout` seconds of its own, so that up to `count` requests
+    are answered. Requests still running are abandoned.
+
+    :param requests: a list of callables that take no argument, in the order they are to be run
+    :param timeout: the maximum time, in seconds, to wait for the requests running
+    :param count: the number of requests to run at once. Defaults to all of them.
+    :return: the first result that isn't None, or None if every answered request
+             misses, or the timeout elapses first
+    """
+
+    global _executor
+
+    if not requests:
+        return None
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='geo_lrucache-neighbours')
+
+    waiting = iter(requests)
+    running = {_executor.submit(request) for request in islice(waiting, count)}
+    deadline = time.monotonic() + timeout
+
+    while running:
+        done, running = wait(running, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+
+        # The timeout elapsed
+        if not done:
+            break
+
+        for future in done:
+            try:
+                value = future.result()
+            except Exception:
+                logger.debug("A request to a neighbour failed", exc_info=True)
+
+                request = next(waiting, None)
+                if request is not None:
+                    running.add(_executor.submit(request))
+                    deadline = time.monotonic() + timeout
+                continue
+
+            if value is not None:
+                return value
+
+    return None
+
+
+async def async_first_hit(requests, timeout, count=None):
+    """
+    The asyncio version of first_hit. Requests still running are cancelled.
+
+    :param requests: a list of coroutine functions that take no argument
+    :param timeout: the maximum time, in seconds, to wait for the requests running
+    :param count: the number of requests to run at once. Defaults to all of them.
+    """
+
+    if not requests:
+        return None
+
+    waiting = iter(requests)
+    running = {asyncio.ensure_future(request()) for request in islice(waiting, count)}
+    deadline = time.monotonic() + timeout
+
+    try:
+        while running:
+            done, running = await asyncio.wait(running, timeout=max(deadline - time.monotonic(), 0),
+                                               return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                break
+
+            for task in done:
+                try:
+                    value = task.result()
+                except Exception:
+                    logger.debug("A request to a neighbour failed", exc_info=True)
+
+                    request = next(waiting, None)
+                    if request is not None:
+                        running.add(asyncio.ensure_future(request()))
+                        deadline = time.monotonic() + timeout
+                    continue
+
+                if value is not None:
+                    return value
+    finally:
+        for task in running:
+            task.cancel()
+
+    return None
+
+
+def answer(cache, line):
+    """
+    This function answers one request of a neighbouring cache: either a
+    lookup, or the export of the cache's items to a joining cache. Items
+    are sent as records (see lrucache.snapshot), their values encoded with
+    the cache's serializer, so that any value the cache can replicate can
+    be read through too, with its type intact.
+
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance to answer from
+    :param line: the encoded {"key": ...} or {"export": since} request
+    :return: the encoded {"length": ...} header of the response, followed by that
+             many bytes of items: the item looked up, if the cache holds it, or
+             the items exported
+    """
+
+    try:
+        request = json.loads(line)
+
+        if 'export' in request:
+            items = cache.export(request['export'])
+        else:
+            item = cache.lookup_item(request['key'])
+            items = [item] if item is not None else []
+
+        items = dump_items(items, cache.serializer)
+    except (ValueError, KeyError, TypeError):
+        items = b''
+
+    return json.dumps({'length': len(items)}).encode() + b'\n' + items
+
+
+class _NeighbourRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the lookups of neighbouring caches, one JSON document per line:
+    {"key": ...} is answered with {"length": ...}, then the item, or nothing
+    if the cache doesn't hold it. {"export": since} is answered with
+    {"length": ...}, then the cache's items, see `request_items`.
+
+    """
+
+    def handle(self):
+
+        for line in self.rfile:
+            self.wfile.write(answer(self.server.cache, line))
+            self.wfile.flush()
+
+
+class NeighbourServer(socketserver.ThreadingTCPServer):
+    """
+    A TCP server, on its own thread, through which a cache answers
+    the lookups of its neighbours
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cache, address=('127.0.0.1', 0)):
+        """
+        :param cache: the GeoLRUCache instance to answer lookups from
+        :param address: the (host, port) pair to listen on. Port 0 picks
+                        any free port.
+        """
+
+        super().__init__(tuple(address), _NeighbourRequestHandler)
+        self.cache = cache
+
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        """
+        The "host:port" string neighbours can reach the server at
+        """
+
+        host, port = self.server_address[:2]
+        return f"{host}:{port}"
+
+    def close(self):
+
+        self.shutdown()
+        self.server_close()
+
+        return
+
+
+def _request(address, request, timeout):
+    """
+    :param address: the "host:port" string of the cache's NeighbourServer
+    :param request: the request, see `answer`
+    :param timeout: the maximum time, in seconds, any step of the request may take
+    :return: the items of the response, as records
+    """
+
+    host, port = address.rsplit(':', 1)
+
+    with socket.create_connection((host, int(port)), timeout=timeout) as connection:
+        connection.sendall(json.dumps(request).encode() + b'\n')
+
+        response = connection.makefile('rb')
+        header = response.readline()
+        length = json.loads(header)['length'] if header else 0
+
+        return response.read(length)
+
+
+def request_item(address, key, timeout, serializer):
+    """
+    This function asks the cache listening at `address` for an item
+
+    :param address: the "host:port" string of the cache's NeighbourServer
+    :param key: the key of the item
+    :param timeout: the maximum time, in seconds, the request may take
+    :param serializer: the Serializer to decode the value with
+    :return: the (key, value, deadline, version, tags) item, or None if the cache doesn't hold it
+    """
+
+    return next(read_items(_request(address, {'key': key}, timeout), serializer), None)
+
+
+def request_items(address, since, timeout, serializer):
+    """
+    This function asks the cache listening at `address` for all its
+    unexpired items, so that a joining cache can catch up with it
+
+    :param address: the "host:port" string of the cache's NeighbourServer
+    :param since: a UNIX timestamp. If given, only the items the cache set
+                  or read since then are sent. None sends every item.
+    :param timeout: the maximum time, in seconds, any step of the request may take
+    :param serializer: the Serializer to decode the values with
+    :return: a list of (key, value, deadline, version, tags) tuples, oldest first
+    """
+
+    return list(read_items(_request(address, {'export': since}, timeout), serializer))
+
+
+async def serve_neighbours(cache, address=('127.0.0.1', 0)):
+    """
+    The asyncio version of NeighbourServer: answers the lookups of
+    a cache's neighbours from the running event loop
+
+    :param cache: the AsyncGeoLRUCache instance to answer lookups from
+    :param address: the (host, port) pair to listen on
+    :return: the asyncio.Server. Its address is that of its first socket.
+    """
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                writer.write(answer(cache, line))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    host, port = address
+    return await asyncio.start_server(handle, host, port)
+
+
+async def _async_request(address, request, timeout):
+    """
+    The asyncio version of _request, within `timeout` seconds altogether
+    """
+
+    host, port = address.rsplit(':', 1)
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(host, int(port))
+        try:
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+
+            header = await reader.readline()
+            length = json.loads(header)['length'] if header else 0
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    return await asyncio.wait_for(exchange(), timeout)
+
+
+async def async_request_item(address, key, timeout, serializer):
+    """
+    The asyncio version of request_item
+
+    :param address: the "host:port" string of the cache's neighbour server
+    :param key: the key of the item
+    :param timeout: the maximum time, in seconds, the request may take
+    :param serializer: the Serializer to decode the value with
+    :return: the (key, value, deadline, version, tags) item, or None if the cache doesn't hold it
+    """
+
+    return next(read_items(await _async_request(address, {'key': key}, timeout), serializer), None)
+
+
+async def async_request_items(address, since, timeout, serializer):
+    """
+    The asyncio version of request_items
+
+    :param address: the "host:port" string of the cache's neighbour server
+    :param since: see request_items
+    :param timeout: the maximum time, in seconds, the whole request may take
+    :param serializer: the Serializer to decode the values with
+    :return: a list of (key, value, deadline, version, tags) tuples, oldest first
+    """
+
+    return list(read_items(await _async_request(address, {'export': since}, timeout), serializer))
@@ -0,0 +1,255 @@
+
+import time
+import threading
+
+from sqlalchemy import func
+
+from .models import CacheGeolocation, CacheDataStore
+from .utils import sort_by_distance
+from .spatial import SpatialIndex
+
+
+class Peer(tuple):
+    """
+    The coordinates of a peer, as the (latitude, longitude) pair that
+    peers have always been listed by, which also carries the node id the
+    peer is addressed by. Two peers at the same coordinates are equal
+    coordinates, but different nodes.
+
+    """
+
+    def __new__(cls, latitude, longitude, node_id):
+
+        peer = super().__new__(cls, (latitude, longitude))
+        peer.node_id = node_id
+
+        return peer
+
+    def __repr__(self):
+
+        return f"Peer({self[0]!r}, {self[1]!r}, node_id={self.node_id!r})"
+
+
+def register(session, cache):
+    """
+    This function registers a cache with the application, or updates its
+    registration if a cache with the same node id registered before (e.g.
+    the same cache, restarted with a fixed `node_id`), in which case the
+    cache keeps its place in the datastore table.
+
+    :param session: a database session, committed on return
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance
+    """
+
+    registration = session.query(CacheGeolocation).filter(CacheGeolocation.node_id == cache.node_id).one_or_none()
+
+    if registration is None:
+        registration = CacheGeolocation(node_id=cache.node_id)
+        session.add(registration)
+
+    registration.latitude, registration.longitude = cache.coordinates
+    registration.address = cache.address
+    registration.region = cache.region
+    registration.generation = (registration.generation or 0) + 1
+    session.commit()
+
+    return
+
+
+def deregister(session, cache):
+    """
+    This function removes a cache from the application: its registration,
+    so that the other caches stop writing to it, and the rows addressed to it
+
+    :param session: a database session, committed on return
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance
+    :return: the number of rows addressed to the cache that were deleted
+    """
+
+    session.query(CacheGeolocation).filter(CacheGeolocation.node_id == cache.node_id).\
+            delete(synchronize_session=False)
+    deleted = session.query(CacheDataStore).filter(CacheDataStore.target_node == cache.node_id).\
+                      delete(synchronize_session=False)
+    session.commit()
+
+    return deleted
+
+
+class PeerIndex:
+    """
+    A memoized list of the caches registered in the environment (the peers
+    of a cache), sorted by their distance to the cache.
+
+    The registry rarely changes, so instead of reading every registered cache
+    on every write, the index only checks the registry's generation: the count
+    and the highest id of its rows, which change when a cache registers or
+    leaves, and the sum of their own generations, which changes when a cache
+    registers again in place (e.g. restarted with the same node id, at a new
+    address). The peers are only read again, and sorted again, when the
+    generation has changed. The generation itself is checked at most once
+    every `refresh_interval` seconds.
+
+    For k-nearest and radius queries, which do not need every peer sorted,
+    the index also builds a SpatialIndex over the peers.
+
+    """
+
+    def __init__(self, coordinates, refresh_interval=1, node_id=None):
+        """
+        :param coordinates: the latitude-longitude pair of the cache
+        :param node_id: the node id of the cache, which is left out of its
+                        own peers. If None, the caches registered at the same
+                        coordinates as the cache are left out instead.
+        :param refresh_interval: time, in seconds, during which the index is
+                                 trusted without checking the registry. A cache
+                                 that registers in that time misses the writes
+                                 made in the meantime.
+        """
+
+        self.coordinates = tuple(coordinates)
+        self.refresh_interval = refresh_interval
+        self.node_id = node_id
+
+        self.__locations = []
+        self.__node_ids = dict()
+        self.__addresses = dict()
+        self.__regions = dict()
+        self.__peers = None
+        self.__index = None
+        self.__generation = None
+        self.__checked_at = None
+        self.__lock = threading.Lock()
+
+    def sorted(self, session, refresh=False):
+        """
+        Get the peers, nearest first
+
+        :param session: a database session to read the registry with
+        :param refresh: Boolean. If True, check the registry even if the
+                        refresh interval hasn't elapsed
+        :return: a list of (coordinates, distance) tuples, the coordinates
+                 being Peer instances. The list must not be modified.
+        """
+
+        with self.__lock:
+            self.__update(session, refresh)
+
+            if self.__peers is None:
+                # Pair each cache's coordinates with its distance to this cache, and
+                # sort them to get the cache closest to, furthest to this cache
+                self.__peers = sort_by_distance(self.coordinates, self.__locations)
+
+            return self.__peers
+
+    def nearest(self, session, k, refresh=False):
+        """
+        Get the k peers nearest to the cache, without sorting every peer
+
+        :param session: a database session to read the registry with
+        :param k: the number of peers to get
+        :param refresh: see `sorted`
+        :return: a list of (coordinates, distance) tuples, nearest first
+        """
+
+        return self.__spatial_index(session, refresh).nearest(self.coordinates, k)
+
+    def within(self, session, radius, refresh=False):
+        """
+        Get every peer within a distance of the cache
+
+        :param session: a database session to read the registry with
+        :param radius: the distance, in meters
+        :param refresh: see `sorted`
+        :return: a list of (coordinates, distance) tuples, nearest first
+        """
+
+        return self.__spatial_index(session, refresh).within(self.coordinates, radius)
+
+    def node_id_of(self, coordinates):
+        """
+        :param coordinates: a Peer, or the latitude-longitude pair of a peer
+        :return: the node id of the peer (of the last one registered, if several
+                 are at these coordinates), or None if it isn't registered
+        """
+
+        if isinstance(coordinates, Peer):
+            return coordinates.node_id
+
+        return self.__node_ids.get(tuple(coordinates))
+
+    def address_of(self, coordinates):
+        """
+        Get the address at which a peer answers its neighbours' lookups
+
+        :param coordinates: a Peer, or the latitude-longitude pair of the peer
+        :return: a "host:port" string, or None if the peer doesn't answer lookups
+        """
+
+        return self.__addresses.get(self.node_id_of(coordinates))
+
+    def region_of(self, coordinates):
+        """
+        Get the region tag a peer registered with
+
+        :param coordinates: a Peer, or the latitude-longitude pair of the peer
+        :return: the region tag, or None if the peer has none
+        """
+
+        return self.__regions.get(self.node_id_of(coordinates))
+
+    def invalidate(self):
+        """
+        Make the next call to `sorted` read the registry again
+
+        """
+
+        with self.__lock:
+            self.__generation = None
+            self.__checked_at = None
+
+        return
+
+    def __spatial_index(self, session, refresh):
+
+        with self.__lock:
+            self.__update(session, refresh)
+
+            if self.__index is None:
+                self.__index = SpatialIndex(self.__locations)
+
+            return self.__index
+
+    def __update(self, session, refresh):
+        """
+        Read the registry again if it has changed. Must be called with the lock held.
+        The sorted list and the spatial index are only built once they are needed.
+        """
+
+        now = time.monotonic()
+
+        if refresh or self.__checked_at is None or now - self.__checked_at >= self.refresh_interval:
+            generation = tuple(session.query(func.count(CacheGeolocation.id), func.max(CacheGeolocation.id),
+                                             func.sum(CacheGeolocation.generation)).one())
+
+            if generation != self.__generation:
+                caches = session.query(CacheGeolocation.node_id, CacheGeolocation.latitude,
+                                       CacheGeolocation.longitude, CacheGeolocation.address,
+                                       CacheGeolocation.region).order_by(CacheGeolocation.id).all()
+
+                # No need to add this cache itself
+                if self.node_id is not None:
+                    caches = [cache for cache in caches if cache.node_id != self.node_id]
+                else:
+                    caches = [cache for cache in caches if (cache.latitude, cache.longitude) != self.coordinates]
+
+                self.__locations = [Peer(cache.latitude, cache.longitude, cache.node_id) for cache in caches]
+                self.__node_ids = {(cache.latitude, cache.longitude): cache.node_id for cache in caches}
+                self.__addresses = {cache.node_id: cache.address for cache in caches if cache.address is not None}
+                self.__regions = {cache.node_id: cache.region for cache in caches if cache.region is not None}
+                self.__peers = None
+                self.__index = None
+                self.__generation = generation
+
+            self.__checked_at = now
+
+        return
@@ -0,0 +1,637 @@
+
+from itertools import chain
+from collections import OrderedDict
+
+
+class _Root:
+    """
+    The sentinel node of an _EntryList
+    """
+
+    __slots__ = ('prev', 'next')
+
+
+class _EntryList:
+    """
+    A circular doubly linked list of CacheEntry objects, threaded through
+    the entries' own `prev` and `next` slots. An entry can only be in one
+    list at a time. Iterates from the oldest entry to the newest.
+
+    """
+
+    __slots__ = ('root', 'length')
+
+    def __init__(self):
+
+        self.root = root = _Root()
+        root.prev = root.next = root
+        self.length = 0
+
+    def __len__(self):
+
+        return self.length
+
+    def __iter__(self):
+
+        root = self.root
+        entry = root.next
+
+        while entry is not root:
+            # Fetch the next entry first, in case the caller
+            # removes this one while iterating
+            next_entry = entry.next
+            yield entry
+            entry = next_entry
+
+    def first(self):
+        """
+        :return: the oldest entry, or None if the list is empty
+        """
+
+        entry = self.root.next
+        return None if entry is self.root else entry
+
+    def append(self, entry):
+
+        root = self.root
+        last = root.prev
+        entry.prev, entry.next = last, root
+        last.next = root.prev = entry
+        self.length += 1
+
+    def remove(self, entry):
+
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+        self.length -= 1
+
+    def move_to_end(self, entry):
+
+        self.remove(entry)
+        self.append(entry)
+
+    def clear(self):
+
+        # Break the links so that the old entries can be
+        # freed by reference counting alone
+        for entry in self:
+            entry.prev = entry.next = None
+
+        root = self.root
+        root.prev = root.next = root
+        self.length = 0
+
+
+class EvictionPolicy:
+    """
+    Base class of the policies that decide which item a store evicts when
+    the cache is over budget. A policy orders the store's entries however it
+    sees fit, and is told about every entry that is added, read, overwritten
+    or removed. Each shard of a store has a policy of its own.
+
+    Entries link into the policy's lists through their `prev` and `next`
+    slots, and policies may keep any small piece of state in their
+    `segment` slot.
+
+    """
+
+    def __init__(self, capacity=None):
+        """
+        :param capacity: the number of items the policy's store is expected
+                         to hold, which some policies size themselves by
+        """
+
+        self.capacity = max(capacity or 1, 1)
+
+    def __iter__(self):
+        """
+        Iterates over the entries, roughly from the next to be evicted
+        """
+
+        raise NotImplementedError
+
+    def insert(self, entry):
+        """
+        An entry was added for a key the store didn't hold
+        """
+
+        raise NotImplementedError
+
+    def access(self, entry):
+        """
+        An entry was read
+        """
+
+        raise NotImplementedError
+
+    def replace(self, old, new):
+        """
+        An entry was overwritten. The write counts as an access.
+        """
+
+        self.remove(old)
+        self.insert(new)
+
+    def remove(self, entry):
+        """
+        An entry was deleted or expired
+        """
+
+        raise NotImplementedError
+
+    def victim(self):
+        """
+        :return: the entry the policy would evict next, or None
+        """
+
+        raise NotImplementedError
+
+    def evict(self):
+        """
+        Choose an entry to evict, and stop tracking it
+
+        :return: the evicted entry, or None if there is none
+        """
+
+        entry = self.victim()
+        if entry is not None:
+            self.remove(entry)
+
+        return entry
+
+    def clear(self):
+
+        raise NotImplementedError
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used item. Cheap, but a scan of one-off keys
+    flushes every item out of the cache.
+
+    """
+
+    def __init__(self, capacity=None):
+
+        super().__init__(capacity)
+        self.__entries = _EntryList()
+
+    def __iter__(self):
+
+        return iter(self.__entries)
+
+    def insert(self, entry):
+
+        self.__entries.append(entry)
+
+    def access(self, entry):
+
+        self.__entries.move_to_end(entry)
+
+    def replace(self, old, new):
+
+        self.__entries.remove(old)
+        self.__entries.append(new)
+
+    def remove(self, entry):
+
+        self.__entries.remove(entry)
+
+    def victim(self):
+
+        return self.__entries.first()
+
+    def clear(self):
+
+        self.__entries.clear()
+
+
+class SIEVEPolicy(EvictionPolicy):
+    """
+    SIEVE (Zhang et al., NSDI 2024). Entries are kept in insertion order and
+    reads only set a `visited` bit, so hits never move entries around. A hand
+    sweeps from the oldest entry to the newest, clearing the bits it meets,
+    and evicts the first entry whose bit is clear. Items that are read again
+    survive a sweep; one-off items do not.
+
+    The entries' `segment` slot holds their visited bit.
+
+    """
+
+    def __init__(self, capacity=None):
+
+        super().__init__(capacity)
+        self.__entries = _EntryList()
+        self.__hand = None
+
+    def __iter__(self):
+
+        return iter(self.__entries)
+
+    def __newer(self, entry):
+
+        entry = entry.next
+        return None if entry is self.__entries.root else entry
+
+    def insert(self, entry):
+
+        entry.segment = False
+        self.__entries.append(entry)
+
+    def access(self, entry):
+
+        entry.segment = True
+
+    def replace(self, old, new):
+
+        self.remove(old)
+        self.insert(new)
+        new.segment = True
+
+    def remove(self, entry):
+
+        if entry is self.__hand:
+            self.__hand = self.__newer(entry)
+
+        self.__entries.remove(entry)
+
+    def victim(self):
+
+        entry = self.__hand or self.__entries.first()
+
+        # Terminates, as every entry passed over has its bit cleared
+        while entry is not None and entry.segment:
+            entry.segment = False
+            entry = self.__newer(entry) or self.__entries.first()
+
+        self.__hand = entry
+        return entry
+
+    def clear(self):
+
+        self.__entries.clear()
+        self.__hand = None
+
+
+class ARCPolicy(EvictionPolicy):
+    """
+    Adaptive Replacement Cache (Megiddo and Modha, FAST 2003). Items seen
+    once are kept in T1 and items seen again in T2, each in LRU order. The
+    keys of recently evicted items are remembered in two ghost lists, B1 and
+    B2, and a hit on a ghost shifts the target size of T1 towards the list
+    the key was evicted from. Scans only ever churn T1.
+
+    The entries' `segment` slot holds the list they are in.
+
+    """
+
+    T1 = 1
+    T2 = 2
+
+    # What the last insertion was, to decide the next eviction like ARC
+    # does before the incoming item joins the cache
+    _NEW = 'new'
+    _GHOST_B2 = 'b2'
+
+    def __init__(self, capacity=None):
+
+        super().__init__(capacity)
+
+        self.__t1 = _EntryList()
+        self.__t2 = _EntryList()
+        self.__b1 = OrderedDict()
+        self.__b2 = OrderedDict()
+        self.__target = 0.0
+        self.__last_insert = None
+
+    def __iter__(self):
+
+        return chain(self.__t1, self.__t2)
+
+    def __list(self, entry):
+
+        return self.__t1 if entry.segment == ARCPolicy.T1 else self.__t2
+
+    def __append(self, entry, segment):
+
+        entry.segment = segment
+        self.__list(entry).append(entry)
+
+    def insert(self, entry):
+
+        key = entry.key
+        b1, b2 = self.__b1, self.__b2
+
+        if key in b1:
+            # Evicted from T1 too early: give T1 more room
+            self.__target = min(self.capacity, self.__target + max(len(b2) / len(b1), 1))
+            del b1[key]
+            self.__append(entry, ARCPolicy.T2)
+            self.__last_insert = None
+
+        elif key in b2:
+            # Evicted from T2 too early: give T2 more room
+            self.__target = max(0.0, self.__target - max(len(b1) / len(b2), 1))
+            del b2[key]
+            self.__append(entry, ARCPolicy.T2)
+            self.__last_insert = ARCPolicy._GHOST_B2
+
+        else:
+            self.__append(entry, ARCPolicy.T1)
+            self.__last_insert = ARCPolicy._NEW
+
+    def access(self, entry):
+
+        self.__list(entry).remove(entry)
+        self.__append(entry, ARCPolicy.T2)
+
+    def replace(self, old, new):
+
+        self.__list(old).remove(old)
+        self.__append(new, ARCPolicy.T2)
+
+    def remove(self, entry):
+
+        self.__list(entry).remove(entry)
+
+    def victim(self):
+
+        t1, t2 = self.__t1, self.__t2
+
+        t1_length = len(t1)
+        if self.__last_insert == ARCPolicy._NEW:
+            t1_length -= 1
+
+        if len(t1) and (t1_length > self.__target or not len(t2) or
+                        (self.__last_insert == ARCPolicy._GHOST_B2 and t1_length == self.__target)):
+            return t1.first()
+
+        return t2.first()
+
+    def evict(self):
+
+        entry = self.victim()
+        if entry is None:
+            return None
+
+        ghosts = self.__b1 if entry.segment == ARCPolicy.T1 else self.__b2
+        self.remove(entry)
+        ghosts[entry.key] = None
+        self.__last_insert = None
+
+        # Keep |T1| + |B1| <= c and |T1| + |T2| + |B1| + |B2| <= 2c
+        capacity = self.capacity
+        while self.__b1 and len(self.__t1) + len(self.__b1) > capacity:
+            self.__b1.popitem(last=False)
+        while self.__b2 and len(self.__t1) + len(self.__t2) + len(self.__b1) + len(self.__b2) > 2 * capacity:
+            self.__b2.popitem(last=False)
+
+        return entry
+
+    def clear(self):
+
+        self.__t1.clear()
+        self.__t2.clear()
+        self.__b1.clear()
+        self.__b2.clear()
+        self.__target = 0.0
+        self.__last_insert = None
+
+
+class CountMinSketch:
+    """
+    An approximate count of how often each key was seen, in a fixed amount
+    of memory: `depth` rows of small counters, each key hashing to one counter
+    per row, and its count being the smallest of them. Counters saturate at 15,
+    and are all halved once `10 * width` keys have been counted, so that the
+    counts reflect recent popularity rather than all-time popularity.
+
+    """
+
+    MAXIMUM = 15
+
+    def __init__(self, capacity):
+        """
+        :param capacity: the number of items of the cache. The sketch
+                         is given the next power of two counters per row.
+        """
+
+        width = 1 << max(4, (max(capacity, 1) - 1).bit_length())
+
+        self.__mask = width - 1
+        self.__rows = [bytearray(width) for _ in range(4)]
+        self.__sample_size = 10 * width
+        self.__additions = 0
+
+    def __indexes(self, key):
+
+        # Two 64-bit multiplicative hashes, each split into two 32-bit halves,
+        # give the four rows' indexes for the price of one hash() call
+        hashed = hash(key)
+        mask = self.__mask
+        first = (hashed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        second = (hashed * 0xC2B2AE3D27D4EB4F) & 0xFFFFFFFFFFFFFFFF
+
+        return (first >> 32) & mask, first & mask, (second >> 32) & mask, second & mask
+
+    def add(self, key):
+
+        maximum = CountMinSketch.MAXIMUM
+        for row, index in zip(self.__rows, self.__indexes(key)):
+            if row[index] < maximum:
+                row[index] += 1
+
+        self.__additions += 1
+        if self.__additions >= self.__sample_size:
+            self.__age()
+
+    def estimate(self, key):
+
+        first, second, third, fourth = self.__rows
+        a, b, c, d = self.__indexes(key)
+
+        return min(first[a], second[b], third[c], fourth[d])
+
+    def __age(self):
+
+        self.__rows = [bytearray(count >> 1 for count in row) for row in self.__rows]
+        self.__additions //= 2
+
+    def clear(self):
+
+        for row in self.__rows:
+            row[:] = bytes(len(row))
+        self.__additions = 0
+
+
+class WTinyLFUPolicy(EvictionPolicy):
+    """
+    Window TinyLFU (Einziger et al., "TinyLFU: A Highly Efficient Cache
+    Admission Policy"), as used by Caffeine. New items enter a small LRU
+    window. When the cache is full, the window's oldest item only enters the
+    main space (a segmented LRU of probation and protected items) if a count-
+    min sketch says it has been seen more often than the item it would evict
+    from there. One-off keys, such as those of a scan or of writes replicated
+    from far-away caches, never displace popular items.
+
+    The entries' `segment` slot holds the segment they are in.
+
+    """
+
+    WINDOW = 1
+    PROBATION = 2
+    PROTECTED = 3
+
+    def __init__(self, capacity=None, window_ratio=0.01, protected_ratio=0.8):
+        """
+        :param capacity: see EvictionPolicy
+        :param window_ratio: the share of the capacity given to the window
+        :param protected_ratio: the share of the main space given to the
+                                protected segment
+        """
+
+        super().__init__(capacity)
+
+        self.__window_capacity = max(1, round(self.capacity * window_ratio))
+        self.__main_capacity = max(1, self.capacity - self.__window_capacity)
+        self.__protected_capacity = max(1, int(self.__main_capacity * protected_ratio))
+
+        self.__sketch = CountMinSketch(self.capacity)
+        self.__segments = {WTinyLFUPolicy.WINDOW: _EntryList(),
+                           WTinyLFUPolicy.PROBATION: _EntryList(),
+                           WTinyLFUPolicy.PROTECTED: _EntryList()}
+
+    def __iter__(self):
+
+        segments = self.__segments
+        return chain(segments[WTinyLFUPolicy.WINDOW], segments[WTinyLFUPolicy.PROBATION],
+                     segments[WTinyLFUPolicy.PROTECTED])
+
+    def __move(self, entry, segment):
+
+        self.__segments[entry.segment].remove(entry)
+        entry.segment = segment
+        self.__segments[segment].append(entry)
+
+    def __main_length(self):
+
+        return len(self.__segments[WTinyLFUPolicy.PROBATION]) + len(self.__segments[WTinyLFUPolicy.PROTECTED])
+
+    def insert(self, entry):
+
+        self.__sketch.add(entry.key)
+
+        entry.segment = WTinyLFUPolicy.WINDOW
+        window = self.__segments[WTinyLFUPolicy.WINDOW]
+        window.append(entry)
+
+        # While the main space has room, the window's overflow moves there freely
+        while len(window) > self.__window_capacity and self.__main_length() < self.__main_capacity:
+            self.__move(window.first(), WTinyLFUPolicy.PROBATION)
+
+    def access(self, entry):
+
+        self.__sketch.add(entry.key)
+
+        if entry.segment == WTinyLFUPolicy.PROBATION:
+            self.__move(entry, WTinyLFUPolicy.PROTECTED)
+
+            # Make room in the protected segment by demoting its oldest items
+            protected = self.__segments[WTinyLFUPolicy.PROTECTED]
+            while len(protected) > self.__protected_capacity:
+                self.__move(protected.first(), WTinyLFUPolicy.PROBATION)
+        else:
+            self.__segments[entry.segment].move_to_end(entry)
+
+    def replace(self, old, new):
+
+        self.__sketch.add(new.key)
+
+        segment = self.__segments[old.segment]
+        segment.remove(old)
+        new.segment = old.segment
+        segment.append(new)
+
+    def remove(self, entry):
+
+        self.__segments[entry.segment].remove(entry)
+
+    def __duel(self):
+        """
+        :return: the window's candidate for the main space, and the main space's
+                 victim. Either is None if there is no need or no item for it.
+        """
+
+        segments = self.__segments
+        main_victim = segments[WTinyLFUPolicy.PROBATION].first() or segments[WTinyLFUPolicy.PROTECTED].first()
+
+        if len(segments[WTinyLFUPolicy.WINDOW]) > self.__window_capacity or main_victim is None:
+            return segments[WTinyLFUPolicy.WINDOW].first(), main_victim
+
+        return None, main_victim
+
+    def __choose(self, candidate, main_victim):
+
+        if candidate is None or main_victim is None:
+            return main_victim or candidate
+
+        # The candidate is only admitted if it is more popular
+        if self.__sketch.estimate(candidate.key) > self.__sketch.estimate(main_victim.key):
+            return main_victim
+
+        return candidate
+
+    def victim(self):
+
+        return self.__choose(*self.__duel())
+
+    def evict(self):
+
+        candidate, main_victim = self.__duel()
+        entry = self.__choose(candidate, main_victim)
+
+        if entry is None:
+            return None
+
+        self.remove(entry)
+
+        # The candidate won its place in the main space
+        if candidate is not None and entry is main_victim:
+            self.__move(candidate, WTinyLFUPolicy.PROBATION)
+
+        return entry
+
+    def clear(self):
+
+        for segment in self.__segments.values():
+            segment.clear()
+        self.__sketch.clear()
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'sieve': SIEVEPolicy,
+    'arc': ARCPolicy,
+    'tinylfu': WTinyLFUPolicy,
+}
+
+
+def get_policy(policy, capacity=None):
+    """
+    This function creates the eviction policy of one store
+
+    :param policy: one of 'lru', 'sieve', 'arc' or 'tinylfu', or an
+                   EvictionPolicy subclass (or any callable taking
+                   the capacity and returning an EvictionPolicy)
+    :param capacity: the number of items the store is expected to hold
+    :return: the EvictionPolicy instance
+    """
+
+    if callable(policy):
+        return policy(capacity)
+
+    try:
+        return POLICIES[policy](capacity)
+    except (KeyError, TypeError):
+        raise ValueError(f"policy must be an EvictionPolicy subclass, or one of {', '.join(POLICIES)}") from None
@@ -0,0 +1,415 @@
+
+import atexit
+import logging
+import threading
+import weakref
+
+from collections import OrderedDict
+
+from .invalidation import pending_key
+
+
+logger = logging.getLogger(__name__)
+
+# Every publisher that is still running, so that their pending
+# writes can be flushed when the interpreter exits
+_running_publishers = weakref.WeakSet()
+
+# asyncio is imported by the methods of AsyncWriteBehindPublisher, rather
+# than here, so that threaded caches don't pay for importing it
+
+
+class _PendingWrites:
+    """
+    The writes a write-behind publisher has yet to publish, and what is done
+    with them whatever the publisher waits with: writes to the same key are
+    coalesced, only `max_pending` are kept, and they are taken off in batches,
+    oldest first. The publishers below only add the waiting, with threading
+    or with asyncio, and must hold their condition when using these methods.
+
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    CALLER_RUNS = 'caller_runs'
+
+    OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, CALLER_RUNS)
+
+    def __init__(self, cache, flush_interval, batch_size, max_pending, overflow):
+
+        if overflow not in _PendingWrites.OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {', '.join(_PendingWrites.OVERFLOW_POLICIES)}")
+
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+
+    @property
+    def pending(self):
+
+        return len(self._pending)
+
+    def _add(self, item, scope):
+        """
+        Queue one write, in place of a pending write to the same key if there is one
+
+        :return: False, and the write isn't queued, if the queue is full
+        """
+
+        if self._closed:
+            raise RuntimeError("The publisher has been closed")
+
+        key = pending_key(item[0], item[1])
+
+        # Coalesce the write with a pending write to the same key
+        if key in self._pending:
+            self._pending.pop(key)
+        elif len(self._pending) >= self.max_pending:
+            return False
+
+        self._pending[key] = (item, scope)
+
+        return True
+
+    def _drop_oldest(self):
+
+        dropped_key, _ = self._pending.popitem(last=False)
+        logger.warning("Write-behind queue is full, dropped the pending write of %r", dropped_key)
+
+    def _must_publish(self):
+        """
+        Whether the pending writes must be published without waiting
+        for the rest of the flush interval
+        """
+
+        return (self._closed or self._flush_requested or
+                len(self._pending) >= min(self.batch_size, self.max_pending))
+
+    def _flushed(self):
+
+        return not self._pending and not self._in_flight
+
+    def _take_batch(self):
+        """
+        Take the oldest pending writes, up to `batch_size`, off the queue
+
+        :return: the number of writes taken, and a dict of the lists of
+                 writes keyed by their scope, as writes are published
+                 together when they share a scope
+        """
+
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            batch.append(self._pending.popitem(last=False)[1])
+
+        scoped = dict()
+        for item, scope in batch:
+            scoped.setdefault(scope, []).append(item)
+
+        return len(batch), scoped
+
+
+class WriteBehindPublisher(_PendingWrites):
+    """
+    Publishes a cache's writes from a background thread, so that setting an
+    item only costs the local write. Writes wait on a bounded queue and are
+    flushed to the cache's transport in batches, either every `flush_interval`
+    seconds or as soon as `batch_size` of them are pending.
+
+    While pending, writes to the same key are coalesced: only the latest
+    value of a key, or its deletion, is published.
+
+    """
+
+    def __init__(self, cache, flush_interval=0.05, batch_size=1000, max_pending=10000, overflow=_PendingWrites.BLOCK):
+        """
+        :param cache: the GeoLRUCache instance whose writes are published
+        :param flush_interval: time, in seconds, that writes may wait on the queue
+                               before they are published
+        :param batch_size: the maximum number of writes published at once
+        :param max_pending: the maximum number of writes on the queue
+        :param overflow: what a write does when the queue is full:
+                         'block' waits until there is space on the queue,
+                         'drop_oldest' drops the oldest pending write, and
+                         'caller_runs' publishes the queued writes on the
+                         caller's thread
+        """
+
+        super().__init__(cache, flush_interval, batch_size, max_pending, overflow)
+
+        self.__condition = threading.Condition()
+
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+        _running_publishers.add(self)
+
+    def put(self, items, scope=None):
+        """
+        Queue writes to be published
+
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        """
+
+        with self.__condition:
+            for item in items:
+                while not self._add(item, scope):
+                    self.__make_room()
+
+            if len(self._pending) >= self.batch_size:
+                self.__condition.notify_all()
+
+        return
+
+    def __make_room(self):
+        """
+        Make room on the full queue, as the overflow policy says. Must
+        be called with the condition held.
+        """
+
+        if self.overflow == WriteBehindPublisher.DROP_OLDEST:
+            self._drop_oldest()
+
+        elif self.overflow == WriteBehindPublisher.CALLER_RUNS:
+            self.__publish_batch()
+
+        else:
+            self.__condition.notify_all()
+            self.__condition.wait()
+
+    def flush(self, timeout=None):
+        """
+        Publish every pending write now, and wait until they are published
+
+        :param timeout: the maximum time, in seconds, to wait
+        :return: True if every write was published, False on timeout
+        """
+
+        with self.__condition:
+            self._flush_requested = True
+            self.__condition.notify_all()
+
+            return self.__condition.wait_for(self._flushed, timeout)
+
+    def close(self, timeout=None):
+        """
+        Flush the pending writes, then stop the publisher's thread
+
+        :param timeout: the maximum time, in seconds, to wait for the flush
+        """
+
+        with self.__condition:
+            if self._closed:
+                return
+
+            self._closed = True
+            self.__condition.notify_all()
+
+        self.__thread.join(timeout)
+        _running_publishers.discard(self)
+
+        return
+
+    def __run(self):
+
+        with self.__condition:
+            while True:
+                self.__condition.wait_for(lambda: self._pending or self._closed)
+
+                # Give more writes the chance to join the batch,
+                # unless the batch is full or a flush is waiting
+                if not self._must_publish():
+                    self.__condition.wait_for(self._must_publish, self.flush_interval)
+
+                while self._pending:
+                    self.__publish_batch()
+
+                self._flush_requested = False
+                self.__condition.notify_all()
+
+                if self._closed:
+                    return
+
+    def __publish_batch(self):
+        """
+        Publish one batch of pending writes. Must be called with the
+        condition held; it is released while the batch is published.
+        """
+
+        count, scoped = self._take_batch()
+
+        self._in_flight += 1
+        self.__condition.release()
+        try:
+            for scope, items in scoped.items():
+                self.cache.publish(items, scope)
+        except Exception:
+            logger.exception("Failed to publish %d write(s)", count)
+        finally:
+            self.__condition.acquire()
+            self._in_flight -= 1
+            self.__condition.notify_all()
+
+
+class AsyncWriteBehindPublisher(_PendingWrites):
+    """
+    The asyncio version of WriteBehindPublisher, for AsyncGeoLRUCache. The
+    writes are published by a task on the event loop rather than by a thread,
+    through the cache's `publish` coroutine. Must be created with the event
+    loop running.
+
+    """
+
+    def __init__(self, cache, flush_interval=0.05, batch_size=1000, max_pending=10000,
+                 overflow=_PendingWrites.BLOCK):
+        """
+        See WriteBehindPublisher. With 'caller_runs', the queued writes are
+        published by the coroutine that queues a write.
+        """
+
+        super().__init__(cache, flush_interval, batch_size, max_pending, overflow)
+
+        import asyncio
+        self.__condition = asyncio.Condition()
+
+        self.__task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def put(self, items, scope=None):
+        """
+        Queue writes to be published
+
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        :param scope: the ReplicationScope of the writes, if not the cache's
+        """
+
+        async with self.__condition:
+            for item in items:
+                while not self._add(item, scope):
+                    await self.__make_room()
+
+            if len(self._pending) >= self.batch_size:
+                self.__condition.notify_all()
+
+        return
+
+    async def __make_room(self):
+        """
+        Make room on the full queue, as the overflow policy says. Must
+        be awaited with the condition held.
+        """
+
+        if self.overflow == WriteBehindPublisher.DROP_OLDEST:
+            self._drop_oldest()
+
+        elif self.overflow == WriteBehindPublisher.CALLER_RUNS:
+            await self.__publish_batch()
+
+        else:
+            self.__condition.notify_all()
+            await self.__condition.wait()
+
+    async def flush(self, timeout=None):
+        """
+        Publish every pending write now, and wait until they are published
+
+        :param timeout: the maximum time, in seconds, to wait
+        :return: True if every write was published, False on timeout
+        """
+
+        import asyncio
+
+        async with self.__condition:
+            self._flush_requested = True
+            self.__condition.notify_all()
+
+            try:
+                await asyncio.wait_for(self.__condition.wait_for(self._flushed), timeout)
+            except asyncio.TimeoutError:
+                return False
+
+        return True
+
+    async def close(self, timeout=None):
+        """
+        Flush the pending writes, then stop the publisher's task. The task
+        is cancelled, and the writes still pending dropped, on timeout.
+
+        :param timeout: the maximum time, in seconds, to wait for the flush
+        """
+
+        import asyncio
+
+        async with self.__condition:
+            if self._closed:
+                return
+
+            self._closed = True
+            self.__condition.notify_all()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self.__task), timeout)
+        except asyncio.TimeoutError:
+            self.__task.cancel()
+            logger.warning("Dropped %d pending write(s) on close", len(self._pending))
+
+        return
+
+    async def __run(self):
+
+        import asyncio
+
+        async with self.__condition:
+            while True:
+                await self.__condition.wait_for(lambda: self._pending or self._closed)
+
+                # Give more writes the chance to join the batch,
+                # unless the batch is full or a flush is waiting
+                if not self._must_publish():
+                    try:
+                        await asyncio.wait_for(self.__condition.wait_for(self._must_publish), self.flush_interval)
+                    except asyncio.TimeoutError:
+                        pass
+
+                while self._pending:
+                    await self.__publish_batch()
+
+                self._flush_requested = False
+                self.__condition.notify_all()
+
+                if self._closed:
+                    return
+
+    async def __publish_batch(self):
+        """
+        Publish one batch of pending writes. Must be awaited with the
+        condition held; it is released while the batch is published.
+        """
+
+        count, scoped = self._take_batch()
+
+        self._in_flight += 1
+        self.__condition.release()
+        try:
+            for scope, items in scoped.items():
+                await self.cache.publish(items, scope)
+        except Exception:
+            logger.exception("Failed to publish %d write(s)", count)
+        finally:
+            await self.__condition.acquire()
+            self._in_flight -= 1
+            self.__condition.notify_all()
+
+
+@atexit.register
+def _close_running_publishers():
+
+    for publisher in list(_running_publishers):
+        publisher.close()
@@ -0,0 +1,131 @@
+
+import bisect
+
+
+class ReplicationScope:
+    """
+    Base class of the policies that decide which of a cache's peers its
+    writes are replicated to. Peers outside of a write's scope never receive
+    it; a neighbour-aware peer can still read it through from its neighbours.
+
+    """
+
+    def select(self, cache, peers):
+        """
+        Choose the targets of a write
+
+        :param cache: the cache that made the write
+        :param peers: the cache's peers, as a list of (coordinates, distance)
+                      tuples, nearest first
+        :return: the coordinates of the targets, nearest first
+        """
+
+        raise NotImplementedError
+
+
+class AllPeers(ReplicationScope):
+    """
+    Replicates every write to every registered cache (the default)
+
+    """
+
+    def select(self, cache, peers):
+
+        return [coordinates for coordinates, _ in peers]
+
+    def __repr__(self):
+
+        return "AllPeers()"
+
+
+class NearestPeers(ReplicationScope):
+    """
+    Replicates writes to the `k` caches nearest to the writer
+
+    """
+
+    def __init__(self, k):
+
+        if k < 0:
+            raise ValueError("k must not be negative")
+
+        self.k = k
+
+    def select(self, cache, peers):
+
+        return [coordinates for coordinates, _ in peers[:self.k]]
+
+    def __repr__(self):
+
+        return f"NearestPeers({self.k})"
+
+
+class PeersWithin(ReplicationScope):
+    """
+    Replicates writes to the caches within `radius` meters of the writer
+
+    """
+
+    def __init__(self, radius):
+
+        self.radius = radius
+
+    def select(self, cache, peers):
+
+        # The peers are sorted by distance
+        end = bisect.bisect_right([distance for _, distance in peers], self.radius)
+        return [coordinates for coordinates, _ in peers[:end]]
+
+    def __repr__(self):
+
+        return f"PeersWithin({self.radius})"
+
+
+class SameRegion(ReplicationScope):
+    """
+    Replicates writes to the caches registered with the same region tag as
+    the writer, or with the given region
+
+    """
+
+    def __init__(self, region=None):
+        """
+        :param region: the region tag of the targets. Defaults to the writer's own.
+        """
+
+        self.region = region
+
+    def select(self, cache, peers):
+
+        region = self.region if self.region is not None else cache.region
+        if region is None:
+            return []
+
+        return [coordinates for coordinates, _ in peers if cache.peer_index.region_of(coordinates) == region]
+
+    def __repr__(self):
+
+        return f"SameRegion({self.region!r})"
+
+
+class PeerGroup(ReplicationScope):
+    """
+    Replicates writes to an explicit group of caches, named by coordinates.
+    Members that aren't registered are ignored.
+
+    """
+
+    def __init__(self, members):
+        """
+        :param members: an iterable of latitude-longitude pairs
+        """
+
+        self.members = frozenset((float(latitude), float(longitude)) for latitude, longitude in members)
+
+    def select(self, cache, peers):
+
+        return [coordinates for coordinates, _ in peers if tuple(coordinates) in self.members]
+
+    def __repr__(self):
+
+        return f"PeerGroup({sorted(self.members)})"
@@ -0,0 +1,272 @@
+
+import json
+import zlib
+import pickle
+
+# msgpack and lz4 are optional. Without them, the
+# 'msgpack' codec and the 'lz4' compression are unavailable.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+class Codec:
+    """
+    Base class of the ways values are turned into bytes before they
+    are replicated. Each codec has a one-byte `tag`, written in front of
+    the bytes it produces, so that a cache can decode the writes of
+    caches configured with any other codec.
+
+    """
+
+    tag = None
+    name = None
+
+    def encode(self, value):
+        """
+        :param value: the value of an item
+        :return: the value, as bytes
+        """
+
+        raise NotImplementedError
+
+    def decode(self, data):
+        """
+        :param data: bytes produced by `encode`
+        :return: the value
+        """
+
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """
+    Encodes any picklable value, and gives it back with its exact type.
+    Only suitable if every cache writing to the datastore is trusted.
+
+    """
+
+    tag = b'p'
+    name = 'pickle'
+
+    def encode(self, value):
+
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    """
+    Encodes values as UTF-8 JSON. Tuples come back as lists,
+    and the keys of dicts as strings.
+
+    """
+
+    tag = b'j'
+    name = 'json'
+
+    def encode(self, value):
+
+        return json.dumps(value, separators=(',', ':')).encode()
+
+    def decode(self, data):
+
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """
+    Encodes values with MessagePack: more compact and faster than JSON,
+    for the same types. Requires the msgpack package.
+
+    """
+
+    tag = b'm'
+    name = 'msgpack'
+
+    def __init__(self):
+
+        if msgpack is None:
+            raise ImportError("The 'msgpack' codec requires the msgpack package")
+
+    def encode(self, value):
+
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+
+        return msgpack.unpackb(data, raw=False)
+
+
+class BytesCodec(Codec):
+    """
+    Stores values that already are bytes as they are. Any other value
+    is refused with a TypeError.
+
+    """
+
+    tag = b'b'
+    name = 'bytes'
+
+    def encode(self, value):
+
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            raise TypeError(f"The 'bytes' codec can't encode a value of type {type(value).__name__}")
+
+        return bytes(value)
+
+    def decode(self, data):
+
+        return bytes(data)
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'json': JSONCodec,
+    'msgpack': MsgpackCodec,
+    'bytes': BytesCodec,
+}
+
+
+# The compression tag written after the codec's tag, and the
+# (compress, decompress) functions of each compression
+_UNCOMPRESSED = b'-'
+COMPRESSIONS = {
+    'zlib': (b'z', zlib.compress, zlib.decompress),
+    'lz4': (b'4', lz4_frame.compress if lz4_frame else None, lz4_frame.decompress if lz4_frame else None),
+}
+
+
+class Serializer:
+    """
+    Turns the values a cache replicates into bytes and back, with a codec,
+    and compresses the values whose encoding is at least `compression_threshold`
+    bytes long.
+
+    The bytes start with a two-byte header naming the codec and the compression.
+    `loads` only decodes the values encoded with the Serializer's own codec, or
+    with one of the codecs it accepts: decoding pickle executes whatever the
+    writer put in, so only caches that trust their peers should accept it.
+
+    """
+
+    def __init__(self, codec='pickle', compression=None, compression_threshold=1024, accept=()):
+        """
+        :param codec: one of 'pickle', 'json', 'msgpack' or 'bytes', or a Codec instance
+        :param compression: None, 'zlib' or 'lz4'
+        :param compression_threshold: the length, in bytes, from which encoded values
+                                      are compressed. Smaller values rarely shrink.
+        :param accept: the other codecs (names, or Codec instances) whose values
+                       `loads` decodes, e.g. those of caches configured differently
+        """
+
+        self.codec = self.__get_codec(codec)
+
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be None, or one of {', '.join(COMPRESSIONS)}")
+
+        if compression == 'lz4' and lz4_frame is None:
+            raise ImportError("The 'lz4' compression requires the lz4 package")
+
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+        # Decoding goes by the header, and only knows the codecs accepted
+        self.__codecs = {self.codec.tag: self.codec}
+        for accepted in accept:
+            accepted = self.__get_codec(accepted)
+            self.__codecs.setdefault(accepted.tag, accepted)
+
+        self.__keys = None
+
+    @staticmethod
+    def __get_codec(codec):
+
+        if isinstance(codec, Codec):
+            return codec
+
+        if codec in CODECS:
+            return CODECS[codec]()
+
+        raise ValueError(f"codec must be a Codec, or one of {', '.join(CODECS)}")
+
+    @property
+    def accepted(self):
+        """
+        The names of the codecs `loads` decodes, the Serializer's own included
+        """
+
+        return [codec.name for codec in self.__codecs.values()]
+
+    @property
+    def keys(self):
+        """
+        The Serializer the keys and tags of items are encoded with when they
+        are sent to another cache, or saved to a snapshot. It uses the same
+        codec, and accepts the same codecs, as this one, except that the 'bytes'
+        codec, which can't encode most keys, is replaced by JSON. JSON keys are
+        always accepted, as decoding them is safe.
+        """
+
+        if self.__keys is None:
+            codecs = list(self.__codecs.values())
+            codec = self.codec if not isinstance(self.codec, BytesCodec) else JSONCodec()
+            self.__keys = Serializer(codec, accept=[JSONCodec()] + codecs)
+
+        return self.__keys
+
+    def dumps(self, value):
+        """
+        :param value: the value of an item
+        :return: the value, as bytes, header included
+        """
+
+        data = self.codec.encode(value)
+
+        if self.compression is not None and len(data) >= self.compression_threshold:
+            tag, compress, _ = COMPRESSIONS[self.compression]
+            compressed = compress(data)
+
+            # Incompressible data is kept as it is
+            if len(compressed) < len(data):
+                return self.codec.tag + tag + compressed
+
+        return self.codec.tag + _UNCOMPRESSED + data
+
+    def loads(self, data):
+        """
+        :param data: bytes produced by `dumps`, on any cache
+        :return: the value
+        :raises ValueError: if the codec of the data isn't accepted, or
+                            if its compression is unknown here
+        """
+
+        data = bytes(data)
+        codec_tag, compression_tag, data = data[:1], data[1:2], data[2:]
+
+        codec = self.__codecs.get(codec_tag)
+        if codec is None:
+            raise ValueError(f"The codec {codec_tag!r} isn't accepted")
+
+        if compression_tag != _UNCOMPRESSED:
+            for tag, _, decompress in COMPRESSIONS.values():
+                if tag == compression_tag and decompress is not None:
+                    data = decompress(data)
+                    break
+            else:
+                raise ValueError(f"Unknown or unavailable compression {compression_tag!r}")
+
+        return codec.decode(data)
+
+    def __repr__(self):
+
+        return f"Serializer({self.codec.name!r}, compression={self.compression!r})"
@@ -0,0 +1,55 @@
+
+import sys
+import json
+import pickle
+
+
+def getsizeof(value):
+    """
+    The size of a value as reported by sys.getsizeof. Cheap, and exact for
+    strings and bytes, but shallow: the items of a container aren't counted.
+
+    """
+    return sys.getsizeof(value)
+
+
+def pickled_size(value):
+    """
+    The length of a value once pickled. Counts nested objects,
+    but costs a serialization of the value on every write.
+
+    """
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def json_size(value):
+    """
+    The length of a value once encoded as JSON, i.e. roughly
+    the size it takes in the datastore table
+
+    """
+    return len(json.dumps(value).encode())
+
+
+SIZERS = {
+    'getsizeof': getsizeof,
+    'pickle': pickled_size,
+    'json': json_size,
+}
+
+
+def get_sizer(sizer):
+    """
+    This function resolves the `sizer` argument of a cache
+
+    :param sizer: one of 'getsizeof', 'pickle' or 'json', or a callable
+                  that takes a value and returns its size in bytes
+    :return: the sizing callable
+    """
+    if callable(sizer):
+        return sizer
+
+    try:
+        return SIZERS[sizer]
+    except (KeyError, TypeError):
+        raise ValueError(f"sizer must be a callable, or one of {', '.join(SIZERS)}") from None
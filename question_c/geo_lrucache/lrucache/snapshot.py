@@ -0,0 +1,270 @@
+
+import io
+import os
+import mmap
+import math
+import time
+import struct
+import tempfile
+
+from .utils import evict, to_ttl
+
+
+# The first bytes of every snapshot file, version included
+MAGIC = b'GEOLRU\x00\x04'
+
+# After the magic bytes, the wall-clock time (UNIX timestamp) the snapshot was taken at
+HEADER = struct.Struct('<d')
+
+# Each record is its deadline (a UNIX timestamp, NaN if the item never
+# expires), its version's timestamp (0 if unversioned) and origin, the
+# lengths of its encoded key, value and tags (0 if it has none), then the
+# key, value and tags. Items sent to a joining cache (see `dump_items`)
+# are records too.
+RECORD = struct.Struct('<dqqIII')
+
+
+def export_items(store, since=None):
+    """
+    This function lists the unexpired items of a store, from the least
+    recently used to the most recently used
+
+    :param store: the cache's store
+    :param since: a UNIX timestamp. If given, only the items set or read
+                  since then are listed.
+    :return: a list of (key, value, deadline, version, tags) tuples, the deadlines being
+             UNIX timestamps, or None
+    """
+
+    # Entries hold monotonic times, which mean nothing to another process
+    now = time.monotonic()
+    offset = time.time() - now
+    since = since - offset if since is not None else -math.inf
+
+    # With one shard and LRU, the entries already are in this order
+    entries = sorted(store, key=lambda entry: entry.accessed_at)
+
+    return [(entry.key, entry.value, entry.expires_at + offset if entry.expires_at is not None else None,
+             entry.version, entry.tags)
+            for entry in entries
+            if entry.accessed_at >= since and (entry.expires_at is None or entry.expires_at > now)]
+
+
+def write_items(file, items, serializer):
+    """
+    This function writes items to a binary file object, as records
+
+    :param file: the file object
+    :param items: an iterable of (key, value, deadline, version, tags) tuples
+    :param serializer: the Serializer to encode the values with. Keys and tags
+                       are encoded with its `keys` Serializer.
+    :return: the number of items written. Items whose key or value
+             can't be encoded are left out.
+    """
+
+    keys = serializer.keys
+    written = 0
+
+    for key, value, deadline, version, tags in items:
+        try:
+            key = keys.dumps(key)
+            value = serializer.dumps(value)
+            tags = keys.dumps(tags) if tags else b''
+        except Exception:
+            continue
+
+        timestamp, origin = version if version is not None else (0, 0)
+        file.write(RECORD.pack(deadline if deadline is not None else math.nan, timestamp, origin,
+                               len(key), len(value), len(tags)))
+        file.write(key)
+        file.write(value)
+        file.write(tags)
+        written += 1
+
+    return written
+
+
+def dump_items(items, serializer):
+    """
+    :param items: an iterable of (key, value, deadline, version, tags) tuples
+    :param serializer: the Serializer to encode the values with
+    :return: the items, as records, in a bytes object
+    """
+
+    buffer = io.BytesIO()
+    write_items(buffer, items, serializer)
+
+    return buffer.getvalue()
+
+
+def read_items(data, serializer, start=0):
+    """
+    This function reads records from a buffer (bytes, or a memory map),
+    in order. Items that have expired are skipped without decoding their
+    value, and so are items that can't be decoded.
+
+    :param data: the buffer
+    :param serializer: the Serializer to decode the values with. Keys and tags
+                       are decoded with its `keys` Serializer, so records whose
+                       key, value or tags use a codec it doesn't accept are skipped.
+    :param start: the offset of the first record in the buffer
+    :return: a generator of (key, value, deadline, version, tags) tuples
+    """
+
+    keys = serializer.keys
+    view = memoryview(data)
+    position, end = start, len(data)
+    now = time.time()
+
+    try:
+        while position + RECORD.size <= end:
+            deadline, timestamp, origin, key_length, value_length, tags_length = RECORD.unpack_from(data, position)
+            key_start = position + RECORD.size
+            value_start = key_start + key_length
+            tags_start = value_start + value_length
+            position = tags_start + tags_length
+
+            # A truncated record
+            if position > end:
+                break
+
+            if math.isnan(deadline):
+                deadline = None
+            elif deadline <= now:
+                continue
+
+            try:
+                key = keys.loads(view[key_start:value_start])
+                value = serializer.loads(view[value_start:tags_start])
+                tags = tuple(keys.loads(view[tags_start:position])) if tags_length else None
+            except Exception:
+                continue
+
+            # JSON gives tuples back as lists, which can't be keys
+            if isinstance(key, list):
+                key = tuple(key)
+
+            yield key, value, deadline, (timestamp, origin) if timestamp else None, tags
+    finally:
+        view.release()
+
+
+def write_snapshot(path, store, serializer):
+    """
+    This function writes the unexpired items of a cache to a snapshot file,
+    from the least recently used to the most recently used. The file is
+    written next to `path`, under a name of its own, then renamed over it,
+    so that a crash never leaves a partial snapshot behind, and snapshots
+    taken at the same time never write to the same file.
+
+    :param path: the path of the snapshot file
+    :param store: the cache's store
+    :param serializer: the Serializer to encode the values with
+    :return: the number of items written
+    """
+
+    handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                              prefix=os.path.basename(path) + '.', suffix='.tmp')
+
+    try:
+        with os.fdopen(handle, 'wb') as snapshot:
+            snapshot.write(MAGIC)
+            snapshot.write(HEADER.pack(time.time()))
+            written = write_items(snapshot, export_items(store), serializer)
+
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    return written
+
+
+def read_snapshot(path, serializer):
+    """
+    This function reads the items of a snapshot file, in the order they
+    were written, through a memory map of the file
+
+    :param path: the path of the snapshot file
+    :param serializer: the Serializer to decode the values with
+    :return: the time the snapshot was taken at, and a generator of
+             (key, value, deadline, version, tags) tuples, see `read_items`. The file
+             stays open until the generator is exhausted or closed.
+    :raises ValueError: if the file isn't a snapshot
+    """
+
+    start = len(MAGIC) + HEADER.size
+
+    snapshot = open(path, 'rb')
+    try:
+        if os.fstat(snapshot.fileno()).st_size < start:
+            raise ValueError(f"{path} is not a cache snapshot")
+
+        data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(MAGIC)] != MAGIC:
+            data.close()
+            raise ValueError(f"{path} is not a cache snapshot")
+    except BaseException:
+        snapshot.close()
+        raise
+
+    taken_at, = HEADER.unpack_from(data, len(MAGIC))
+
+    def items():
+        try:
+            yield from read_items(data, serializer, start)
+        finally:
+            data.close()
+            snapshot.close()
+
+    return taken_at, items()
+
+
+def load_items(cache, items):
+    """
+    This function sets items on a cache the way replicated writes are set:
+    the items aren't propagated, and those the cache has a later write,
+    deletion or invalidation of are skipped. The first items set are the
+    first evicted.
+
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance
+    :param items: an iterable of (key, value, deadline, version, tags) tuples. Items
+                  without a deadline get the cache's own `expires_in`.
+    :return: the number of items set
+    """
+
+    loaded = 0
+
+    for key, value, deadline, version, tags in items:
+        ttl = to_ttl(deadline)
+        if ttl is not None and ttl <= 0:
+            continue
+
+        # Last-writer-wins applies, as for replicated writes
+        if version is not None:
+            cache.clock.update(version)
+
+        if cache._set_local(key, value, ttl=ttl, version=version, tags=tags):
+            loaded += 1
+
+    evict(cache)
+
+    return loaded
+
+
+def load_snapshot(cache, path):
+    """
+    This function sets the items of a snapshot file on a cache, see `load_items`
+
+    :param cache: the GeoLRUCache or AsyncGeoLRUCache instance
+    :param path: the path of the snapshot file
+    :return: the number of items set, and the time the snapshot was taken at
+    """
+
+    taken_at, items = read_snapshot(path, cache.serializer)
+
+    return load_items(cache, items), taken_at
@@ -0,0 +1,182 @@
+
+import math
+import heapq
+
+from .utils import EARTH_RADIUS, rad
+
+
+def to_unit_vector(coordinates):
+    """
+    This function maps a decimal-degree (latitude, longitude) pair to the
+    corresponding point on the unit sphere, in cartesian coordinates.
+
+    """
+    latitude, longitude = rad(float(coordinates[0])), rad(float(coordinates[1]))
+
+    return (math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude))
+
+
+def chord_to_distance(squared_chord):
+    """
+    This function converts the squared straight-line distance between two points
+    on the unit sphere into the great-circle distance, in meters, between the
+    locations they represent (the distance the Haversine Formula gives).
+
+    """
+    chord = math.sqrt(squared_chord)
+
+    return round(EARTH_RADIUS * 2 * math.asin(min(chord / 2, 1)), 5)
+
+
+def distance_to_chord(distance):
+    """
+    The inverse of chord_to_distance, without the squaring
+
+    """
+    angle = distance / EARTH_RADIUS
+
+    if angle >= math.pi:
+        return 2.0
+
+    return 2 * math.sin(angle / 2)
+
+
+class SpatialIndex:
+    """
+    A k-d tree over a set of locations, for nearest-neighbour and radius
+    queries on the globe.
+
+    Every location is mapped to a point on the unit sphere. The straight-line
+    (chord) distance between two such points only grows with the great-circle
+    distance between the locations, so the nearest points in 3D space are the
+    nearest locations on the globe, without any special handling of the poles
+    or of the antimeridian. Queries cost O(log n) on average.
+
+    The index is immutable: build a new one when the locations change.
+
+    """
+
+    def __init__(self, locations):
+        """
+        :param locations: a sequence of (latitude, longitude) pairs
+        """
+
+        nodes = [(to_unit_vector(location), location if isinstance(location, tuple) else tuple(location))
+                 for location in locations]
+
+        self.__build(nodes, 0, len(nodes), 0)
+
+        # The tree is implicit: the node of any range of the list is at the
+        # middle of the range, and splits it on the axis given by its depth
+        self.__points = [point for point, _ in nodes]
+        self.__locations = [location for _, location in nodes]
+
+    def __len__(self):
+
+        return len(self.__points)
+
+    @staticmethod
+    def __build(nodes, lo, hi, depth):
+
+        # Iterative over the ranges, so that large indexes
+        # never hit the recursion limit
+        ranges = [(lo, hi, depth)]
+
+        while ranges:
+            lo, hi, depth = ranges.pop()
+            if hi - lo <= 1:
+                continue
+
+            axis = depth % 3
+            nodes[lo:hi] = sorted(nodes[lo:hi], key=lambda node: node[0][axis])
+
+            mid = (lo + hi) // 2
+            ranges.append((lo, mid, depth + 1))
+            ranges.append((mid + 1, hi, depth + 1))
+
+    def nearest(self, origin, k=1):
+        """
+        Get the k locations nearest to the origin
+
+        :param origin: a (latitude, longitude) pair
+        :param k: the number of locations to get
+        :return: a list of (location, distance) tuples, nearest first.
+                 The distances are in meters.
+        """
+
+        if k <= 0 or not self.__points:
+            return []
+
+        query = to_unit_vector(origin)
+        points = self.__points
+
+        # A max-heap (through negated distances) of the best candidates so far
+        best = []
+        stack = [(0, len(points), 0)]
+
+        while stack:
+            lo, hi, depth = stack.pop()
+            if lo >= hi:
+                continue
+
+            mid = (lo + hi) // 2
+            point = points[mid]
+            squared = (query[0] - point[0]) ** 2 + (query[1] - point[1]) ** 2 + (query[2] - point[2]) ** 2
+
+            if len(best) < k:
+                heapq.heappush(best, (-squared, mid))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, mid))
+
+            axis = depth % 3
+            difference = query[axis] - point[axis]
+            near, far = ((lo, mid, depth + 1), (mid + 1, hi, depth + 1)) if difference < 0 else \
+                        ((mid + 1, hi, depth + 1), (lo, mid, depth + 1))
+
+            # Only visit the far side of the split if it can hold a better
+            # candidate. It is pushed first, so it is visited after the near side.
+            if len(best) < k or difference * difference < -best[0][0]:
+                stack.append(far)
+            stack.append(near)
+
+        return [(self.__locations[i], chord_to_distance(-squared)) for squared, i in sorted(best, reverse=True)]
+
+    def within(self, origin, radius):
+        """
+        Get all the locations within a distance of the origin
+
+        :param origin: a (latitude, longitude) pair
+        :param radius: the distance, in meters
+        :return: a list of (location, distance) tuples, nearest first
+        """
+
+        query = to_unit_vector(origin)
+        points = self.__points
+        limit = distance_to_chord(radius) ** 2
+
+        found = []
+        stack = [(0, len(points), 0)]
+
+        while stack:
+            lo, hi, depth = stack.pop()
+            if lo >= hi:
+                continue
+
+            mid = (lo + hi) // 2
+            point = points[mid]
+            squared = (query[0] - point[0]) ** 2 + (query[1] - point[1]) ** 2 + (query[2] - point[2]) ** 2
+
+            if squared <= limit:
+                found.append((squared, mid))
+
+            axis = depth % 3
+            difference = query[axis] - point[axis]
+
+            if difference < 0 or difference * difference <= limit:
+                stack.append((lo, mid, depth + 1))
+            if difference >= 0 or difference * difference <= limit:
+                stack.append((mid + 1, hi, depth + 1))
+
+        return [(self.__locations[i], chord_to_distance(squared)) for squared, i in sorted(found)]
@@ -0,0 +1,514 @@
+
+import threading
+
+from collections import deque
+
+from .expiry import ExpiryHeap
+from .policies import LRUPolicy, get_policy
+
+
+class CacheEntry:
+    """
+    A single item in the cache. Every piece of data the cache keeps about
+    an item lives in one of these, so that setting, touching, expiring or
+    evicting an item only ever involves one object.
+
+    Entries are also the nodes of the eviction policy's lists (`prev` and
+    `next`, plus the policy's `segment` of choice), and are ordered by deadline
+    so that the expiry heap can hold them directly.
+
+    Items loaded through get_or_set also carry their `freshness`: a
+    (fresh_until, load_time) pair used to refresh them before they expire.
+    Items set or replicated since versioning was introduced carry the
+    (timestamp, origin) `version` of the write, see HybridLogicalClock,
+    and items can be set with `tags`, which tag invalidations go by.
+
+    """
+
+    __slots__ = ('key', 'value', 'accessed_at', 'expires_at', 'size', 'version', 'tags', 'freshness', 'segment',
+                 'prev', 'next')
+
+    def __init__(self, key, value, accessed_at, expires_at=None, size=0, version=None, tags=None):
+        """
+        :param key: the key of the item
+        :param value: the value of the item
+        :param accessed_at: the time the item was last set or read
+        :param expires_at: the time after which the item expires. None
+                           if the item never expires.
+        :param size: the size of the item, in bytes, as measured by the
+                     cache's sizer. 0 if the cache doesn't measure items.
+        :param version: the version of the write that set the item, or None
+        :param tags: a tuple of the tags of the item, or None
+        """
+
+        self.key = key
+        self.value = value
+        self.accessed_at = accessed_at
+        self.expires_at = expires_at
+        self.size = size
+        self.version = version
+        self.tags = tags
+        self.freshness = None
+        self.segment = None
+        self.prev = None
+        self.next = None
+
+    def __lt__(self, other):
+
+        return self.expires_at < other.expires_at
+
+    def __repr__(self):
+
+        return f"CacheEntry({self.key!r}, {self.value!r})"
+
+
+class Store:
+    """
+    The local storage of the cache. Entries are looked up by key in a dict,
+    and ordered for eviction by an EvictionPolicy (by default, from the least
+    recently used to the most recently used). Entries that expire are also
+    indexed by deadline in an ExpiryHeap.
+
+    Keys deleted by versioned deletions leave a tombstone behind for a
+    while, so that writes older than the deletion that arrive after it
+    don't set the key again.
+
+    The store does not decide when to expire or evict items; the cache's
+    clean_up decorator does. It isn't thread-safe: the cache uses it
+    through a ShardedStore.
+
+    """
+
+    def __init__(self, policy=None):
+        """
+        :param policy: the EvictionPolicy instance of the store.
+                       Defaults to an LRUPolicy.
+        """
+
+        self.__entries = dict()
+        self.__expiry_index = ExpiryHeap(self.__entries)
+        self.__total_bytes = 0
+        self.__policy = policy if policy is not None else LRUPolicy()
+
+        # key -> (version, expires_at) of the deleted keys, and the
+        # (expires_at, key) of each tombstone in the order they were made
+        self.__tombstones = dict()
+        self.__tombstone_queue = deque()
+
+    def __len__(self):
+
+        return len(self.__entries)
+
+    def __contains__(self, key):
+
+        return key in self.__entries
+
+    @property
+    def policy(self):
+
+        return self.__policy
+
+    @property
+    def total_bytes(self):
+        """
+        The sum of the sizes of the entries
+        """
+
+        return self.__total_bytes
+
+    @property
+    def tombstones(self):
+        """
+        The key -> (version, expires_at) dict of the tombstones of the
+        store, some of which may have expired. Must not be modified.
+        """
+
+        return self.__tombstones
+
+    @property
+    def entries(self):
+        """
+        The key -> CacheEntry dict of the store. Must not be modified.
+        """
+
+        return self.__entries
+
+    def __iter__(self):
+        """
+        Iterates over the entries in the policy's order, roughly from the
+        next to be evicted (with LRU, from the least recently used to the
+        most recently used)
+        """
+
+        return iter(self.__policy)
+
+    def peek(self, key):
+        """
+        Get an item's entry without marking it as used
+
+        :param key: the key of the item
+        :return: the CacheEntry of the item, or None if it is absent
+        """
+
+        return self.__entries.get(key)
+
+    def get(self, key, now):
+        """
+        Get an item's entry and mark it as used
+
+        :param key: the key of the item
+        :param now: the current time
+        :return: the CacheEntry of the item, or None if it is absent
+        """
+
+        entry = self.__entries.get(key)
+
+        if entry is not None:
+            entry.accessed_at = now
+            self.__policy.access(entry)
+
+        return entry
+
+    def set(self, key, value, now, expires_at=None, size=0, version=None, tags=None):
+        """
+        Create or overwrite an item. Overwriting an item counts as using it.
+        Versioned writes only overwrite items with an earlier version
+        (last-writer-wins), and only recreate deleted items if they are
+        later than the deletion; unversioned writes always do both.
+
+        :param key: the key of the item
+        :param value: the value of the item
+        :param now: the current time
+        :param expires_at: the time after which the item expires, if ever
+        :param size: the size of the item, in bytes
+        :param version: the (timestamp, origin) version of the write, or None
+        :param tags: a tuple of the tags of the item, or None
+        :return: the new CacheEntry of the item, or None if the item has
+                 a later version, or was deleted later, than the write
+        """
+
+        old = self.__entries.get(key)
+
+        if version is not None:
+            if old is not None and old.version is not None and old.version > version:
+                return None
+
+            tombstone = self.__tombstones.get(key)
+            if tombstone is not None and tombstone[0] > version and tombstone[1] > now:
+                return None
+
+        entry = CacheEntry(key, value, now, expires_at, size, version, tags)
+        self.__entries[key] = entry
+        self.__total_bytes += size
+
+        if old is None:
+            self.__policy.insert(entry)
+        else:
+            self.__total_bytes -= old.size
+            self.__policy.replace(old, entry)
+
+        if expires_at is not None:
+            self.__expiry_index.push(entry)
+
+        return entry
+
+    def delete(self, key, version=None):
+        """
+        Delete an item
+
+        :param key: the key of the item
+        :param version: the version of the deletion, or None. A versioned
+                        deletion doesn't delete an item written after it.
+        :return: the deleted CacheEntry, or None if the item was absent
+                 (or written after the deletion)
+        """
+
+        if version is not None:
+            old = self.__entries.get(key)
+            if old is not None and old.version is not None and old.version > version:
+                return None
+
+        entry = self.__entries.pop(key, None)
+
+        if entry is not None:
+            self.__policy.remove(entry)
+            self.__total_bytes -= entry.size
+
+        return entry
+
+    def bury(self, key, version, now, expires_at):
+        """
+        Leave a tombstone for a deleted key, which refuses the writes
+        earlier than the deletion until `expires_at`. The tombstones that
+        have expired are forgotten along the way.
+
+        :param key: the key of the deleted item
+        :param version: the version of the deletion
+        :param now: the current time
+        :param expires_at: the time after which the tombstone is forgotten
+        """
+
+        tombstone = self.__tombstones.get(key)
+        if tombstone is None or tombstone[0] < version:
+            self.__tombstones[key] = (version, expires_at)
+
+        self.__tombstone_queue.append((expires_at, key))
+
+        # Tombstones all live as long, so the oldest are always the first to expire
+        queue = self.__tombstone_queue
+        while queue and queue[0][0] <= now:
+            _, buried_key = queue.popleft()
+            tombstone = self.__tombstones.get(buried_key)
+            if tombstone is not None and tombstone[1] <= now:
+                del self.__tombstones[buried_key]
+
+        return
+
+    def expire(self, now):
+        """
+        Delete all the items whose deadline is earlier than `now`
+
+        :param now: the current time
+        :return: a list of the expired entries
+        """
+
+        expired = self.__expiry_index.pop_expired(now)
+
+        for entry in expired:
+            self.delete(entry.key)
+
+        return expired
+
+    @property
+    def next_deadline(self):
+        """
+        The earliest deadline in the expiry index, or None. It may be the
+        deadline of an item that has since been overwritten, so it is only
+        ever too early, never too late.
+        """
+
+        return self.__expiry_index.next_deadline
+
+    def oldest(self):
+        """
+        :return: the entry the policy would evict next (with LRU, the least
+                 recently used item), or None if the store is empty
+        """
+
+        return self.__policy.victim()
+
+    def pop_oldest(self):
+        """
+        Evict the item the policy chooses
+
+        :return: the evicted CacheEntry, or None if the store is empty
+        """
+
+        entry = self.__policy.evict()
+
+        if entry is not None:
+            del self.__entries[entry.key]
+            self.__total_bytes -= entry.size
+
+        return entry
+
+    def clear(self):
+
+        self.__policy.clear()
+        self.__entries.clear()
+        self.__expiry_index.clear()
+        self.__total_bytes = 0
+        self.__tombstones.clear()
+        self.__tombstone_queue.clear()
+
+        return
+
+
+# Kept for compatibility: the store used to only ever evict the least recently used item
+LRUStore = Store
+
+
+class ShardedStore:
+    """
+    A thread-safe store, made of `shards` Stores that each have their
+    own lock. Every key belongs to one shard, picked by its hash, so threads
+    working on keys in different shards never wait for one another.
+
+    Each shard keeps its own eviction policy and expiry index. The item the
+    whole store evicts is taken from the shard whose own next victim was used
+    the longest ago, which is exact with one shard and approximate with several.
+
+    """
+
+    def __init__(self, shards=1, policy='lru', capacity=None):
+        """
+        :param shards: the number of shards. One shard makes every
+                       operation take the same, single lock.
+        :param policy: the eviction policy of the shards, see get_policy
+        :param capacity: the number of items the store is expected to hold.
+                         Each shard's policy is sized for its share of it.
+        """
+
+        if shards < 1:
+            raise ValueError("A store must have at least one shard")
+
+        shard_capacity = -(-capacity // shards) if capacity else None
+        self.__shards = [Store(get_policy(policy, shard_capacity)) for _ in range(shards)]
+        self.__locks = [threading.Lock() for _ in range(shards)]
+
+        # The shards' own key -> entry dicts, so that counting the items
+        # in the store takes no more than one builtin len() per shard
+        self.__entry_maps = [shard.entries for shard in self.__shards]
+
+        # The earliest deadline of any shard, so that most operations can
+        # tell that nothing has expired without looking at every shard. It
+        # is only lowered, or recomputed, with its lock held.
+        self.__next_deadline = None
+        self.__deadline_lock = threading.Lock()
+
+    @property
+    def shards(self):
+
+        return len(self.__shards)
+
+    def __shard(self, key):
+
+        index = hash(key) % len(self.__shards)
+        return self.__shards[index], self.__locks[index]
+
+    def __len__(self):
+
+        return sum(map(len, self.__entry_maps))
+
+    @property
+    def total_bytes(self):
+
+        return sum(shard.total_bytes for shard in self.__shards)
+
+    def __contains__(self, key):
+
+        shard, lock = self.__shard(key)
+        with lock:
+            return key in shard
+
+    def __iter__(self):
+        """
+        Iterates over a snapshot of the entries, shard by shard, each
+        shard from the least recently used to the most recently used
+        """
+
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                entries = list(shard)
+
+            yield from entries
+
+    def peek(self, key):
+
+        shard, lock = self.__shard(key)
+        with lock:
+            return shard.peek(key)
+
+    def get(self, key, now):
+
+        shard, lock = self.__shard(key)
+        with lock:
+            return shard.get(key, now)
+
+    def set(self, key, value, now, expires_at=None, size=0, version=None, tags=None):
+
+        shard, lock = self.__shard(key)
+        with lock:
+            entry = shard.set(key, value, now, expires_at, size, version, tags)
+
+        if entry is not None and expires_at is not None and (self.__next_deadline is None or expires_at < self.__next_deadline):
+            with self.__deadline_lock:
+                if self.__next_deadline is None or expires_at < self.__next_deadline:
+                    self.__next_deadline = expires_at
+
+        return entry
+
+    @property
+    def tombstones(self):
+        """
+        A snapshot of the key -> (version, expires_at) tombstones of every shard
+        """
+
+        tombstones = dict()
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                tombstones.update(shard.tombstones)
+
+        return tombstones
+
+    def delete(self, key, version=None, now=None, tombstone_until=None):
+        """
+        Delete an item, see Store.delete, and leave a tombstone for it
+        until `tombstone_until` if the deletion is versioned
+        """
+
+        shard, lock = self.__shard(key)
+        with lock:
+            if version is not None and tombstone_until is not None:
+                shard.bury(key, version, now, tombstone_until)
+
+            return shard.delete(key, version)
+
+    def expire(self, now):
+
+        if self.__next_deadline is None or self.__next_deadline >= now:
+            return []
+
+        expired = []
+        for shard, lock in zip(self.__shards, self.__locks):
+            # Only lock the shards that have something to expire
+            deadline = shard.next_deadline
+            if deadline is None or deadline >= now:
+                continue
+
+            with lock:
+                expired.extend(shard.expire(now))
+
+        with self.__deadline_lock:
+            deadlines = [deadline for deadline in (shard.next_deadline for shard in self.__shards)
+                         if deadline is not None]
+            self.__next_deadline = min(deadlines, default=None)
+
+        return expired
+
+    def oldest(self):
+
+        oldest = None
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                entry = shard.oldest()
+
+            if entry is not None and (oldest is None or entry.accessed_at < oldest.accessed_at):
+                oldest = entry
+
+        return oldest
+
+    def pop_oldest(self):
+
+        if len(self.__shards) == 1:
+            with self.__locks[0]:
+                return self.__shards[0].pop_oldest()
+
+        # The shard whose head is the oldest may have changed by the time
+        # its lock is taken. That only makes the choice more approximate.
+        oldest = self.oldest()
+
+        if oldest is None:
+            return None
+
+        shard, lock = self.__shard(oldest.key)
+        with lock:
+            return shard.pop_oldest()
+
+    def clear(self):
+
+        for shard, lock in zip(self.__shards, self.__locks):
+            with lock:
+                shard.clear()
+
+        return
@@ -0,0 +1,746 @@
+
+import time
+import json
+import queue
+import hashlib
+import random
+import select
+import logging
+import threading
+
+from functools import partial
+
+from sqlalchemy import text
+
+from .models import CacheDataStore, CacheGeolocation
+from .database import with_retries
+from .invalidation import Invalidation, INVALIDATIONS
+from .neighbours import NeighbourServer, first_hit, request_item, request_items
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicationTransport:
+    """
+    Base class of the channels through which caches replicate their
+    writes to one another. The cache registry (the caches_geolocation
+    table) decides who the writes go to; a transport decides how they
+    get there.
+
+    A transport may be shared by several caches in the same process.
+    Caches are addressed by their node ids.
+
+    Transports also carry the lookups that neighbour-aware caches make to
+    their neighbours on a miss. By default, every cache answers lookups on
+    its own NeighbourServer, whose address it registers along with its
+    coordinates.
+
+    """
+
+    def __init__(self):
+
+        self._servers = dict()
+
+    def subscribe(self, cache):
+        """
+        Start accepting writes addressed to `cache`. Called from the
+        cache's constructor, before the cache registers itself, so that
+        no write addressed to it can be missed.
+
+        :param cache: the GeoLRUCache instance
+        """
+
+        return
+
+    def listen(self, cache):
+        """
+        Deliver the writes addressed to `cache` to its `receive` method,
+        until `unsubscribe` is called. Runs on, and blocks, the cache's
+        listener thread.
+
+        :param cache: the GeoLRUCache instance
+        """
+
+        raise NotImplementedError
+
+    def publish(self, cache, targets, items):
+        """
+        Send writes made on `cache` to other caches
+
+        :param cache: the GeoLRUCache instance that made the writes
+        :param targets: the coordinates of the caches to send the writes
+                        to, nearest first
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        """
+
+        raise NotImplementedError
+
+    def unsubscribe(self, cache):
+        """
+        Stop delivering writes to `cache`, which makes `listen` return,
+        and stop answering its neighbours' lookups
+
+        :param cache: the GeoLRUCache instance
+        """
+
+        server = self._servers.pop(cache, None)
+        if server is not None:
+            server.close()
+
+        return
+
+    def serve(self, cache, address):
+        """
+        Start answering the lookups of `cache`'s neighbours
+
+        :param cache: the GeoLRUCache instance
+        :param address: the (host, port) pair to answer lookups on
+        :return: the address to register the cache with, if any
+        """
+
+        server = NeighbourServer(cache, address)
+        self._servers[cache] = server
+
+        return server.address
+
+    def fetch(self, cache, targets, key, timeout, count=1):
+        """
+        Ask the nearest `count` targets that answer lookups for an item,
+        in parallel. A target that can't be reached (e.g. a cache that crashed
+        without deregistering) is replaced by the next nearest one.
+
+        :param cache: the GeoLRUCache instance that missed the item
+        :param targets: the coordinates of the caches to ask, nearest first
+        :param key: the key of the item
+        :param timeout: the maximum time, in seconds, to wait for an answer
+        :param count: the number of targets to get an answer from
+        :return: the first (key, value, deadline, version, tags) item found, or None
+        """
+
+        addresses = [cache.peer_index.address_of(coordinates) for coordinates in targets]
+        addresses = [address for address in addresses if address is not None]
+
+        return first_hit([partial(request_item, address, key, timeout, cache.serializer) for address in addresses],
+                         timeout, count)
+
+    def fetch_items(self, cache, targets, since, timeout, count=3):
+        """
+        Get the unexpired items of the nearest target that answers lookups
+        and has any, for `cache` to catch up with. Up to `count` targets are
+        asked, one after the other, so that no more than one copy of the
+        items is transferred at once.
+
+        :param cache: the GeoLRUCache instance that is catching up
+        :param targets: the coordinates of the caches to ask, nearest first
+        :param since: a UNIX timestamp. If given, only the items set or read
+                      since then are fetched.
+        :param timeout: the maximum time, in seconds, any step of a request may take
+        :param count: the number of targets to ask, at most
+        :return: a list of (key, value, deadline, version, tags) tuples, oldest first
+        """
+
+        addresses = [cache.peer_index.address_of(coordinates) for coordinates in targets]
+        addresses = [address for address in addresses if address is not None][:count]
+
+        for address in addresses:
+            try:
+                items = request_items(address, since, timeout, cache.serializer)
+            except Exception:
+                logger.debug("Failed to fetch the items of %s", address, exc_info=True)
+                continue
+
+            if items:
+                return items
+
+        return []
+
+
+class DatabaseTransport(ReplicationTransport):
+    """
+    Replicates writes through the datastore table of the database. Every
+    write is saved as one row per target cache, addressed to its node id,
+    and each cache polls the table for the rows addressed to it, every
+    `poll_interval` seconds.
+
+    Each cache keeps a cursor: the id of the last row it has consumed. A
+    poll only reads the rows past it, through the (target_node, id) index,
+    so it costs the same however many rows the table holds. Consumed rows
+    aren't deleted one batch at a time, but in bulk, by a compaction that
+    every cache runs every `compaction_interval` seconds.
+
+    Works with any database, but costs one query per cache per interval,
+    even when nothing is written.
+
+    """
+
+    # The maximum number of values bound to one statement by
+    # the deletion of superseded rows, see `delete_superseded`
+    PARAMETERS_PER_STATEMENT = 500
+
+    # The key of the PostgreSQL advisory lock writers take, see `lock_writes`
+    WRITE_LOCK = 0x67656f6c7275
+
+    def __init__(self, poll_interval=0.5, batch_size=5000, compaction_interval=60):
+        """
+        :param poll_interval: time, in seconds, that a cache waits between
+                              polls of the datastore table, once it has
+                              consumed every row addressed to it.
+        :param batch_size: the maximum number of rows a cache fetches and
+                           applies at once
+        :param compaction_interval: time, in seconds, between two compactions
+                                    of the rows addressed to a cache (see
+                                    `compact`). None never compacts.
+        """
+
+        super().__init__()
+
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.compaction_interval = compaction_interval
+        self._stopped = dict()
+        self._cursors = dict()
+
+    def subscribe(self, cache):
+
+        self._stopped[cache] = threading.Event()
+        return
+
+    def unsubscribe(self, cache):
+
+        super().unsubscribe(cache)
+
+        stopped = self._stopped.get(cache)
+        if stopped is not None:
+            stopped.set()
+
+        return
+
+    def listen(self, cache):
+
+        session = cache.Session()
+        stopped = self._stopped[cache]
+
+        # Caches started together don't compact together
+        compact_at = self.next_compaction(first=True)
+
+        try:
+            while not stopped.is_set():
+                # A poll that keeps failing is given up on, and tried again at the next one
+                try:
+                    with_retries(session, partial(self.consume, cache))
+                except Exception:
+                    logger.exception("Failed to consume the datastore table")
+
+                if compact_at is not None and time.monotonic() >= compact_at:
+                    try:
+                        with_retries(session, partial(self.compact, cache))
+                    except Exception:
+                        logger.exception("Failed to compact the datastore table")
+                    compact_at = self.next_compaction()
+
+                # Be nice on the CPU
+                self.wait(cache, stopped)
+        finally:
+            self._cursors.pop(cache, None)
+            session.close()
+
+        return
+
+    def next_compaction(self, first=False):
+        """
+        :param first: Boolean. If True, the first compaction is scheduled at
+                      random within the interval, rather than a whole interval away.
+        :return: the time (by the monotonic clock) at which to compact next, or None
+        """
+
+        if self.compaction_interval is None:
+            return None
+
+        return time.monotonic() + self.compaction_interval * (random.random() if first else 1)
+
+    def wait(self, cache, stopped):
+        """
+        Block until there may be new rows addressed to `cache`
+
+        """
+
+        stopped.wait(self.poll_interval)
+        return
+
+    def consume(self, cache, session):
+        """
+        Apply every row addressed to `cache` past its cursor, and move
+        the cursor past them
+
+        :param cache: the GeoLRUCache instance
+        :param session: the listener thread's database session
+        """
+
+        cursor = self._cursors.get(cache)
+        if cursor is None:
+            # A cache restarted with the same node id resumes where it stopped
+            cursor = session.query(CacheGeolocation.last_consumed_id).\
+                             filter(CacheGeolocation.node_id == cache.node_id).scalar() or 0
+
+        while True:
+            # Fetch the pending rows in the order they were written, so
+            # that a later write to a key is always applied last
+            rows = session.query(CacheDataStore.id, CacheDataStore.key, CacheDataStore.value,
+                                 CacheDataStore.expires_at, CacheDataStore.version, CacheDataStore.origin,
+                                 CacheDataStore.tags, CacheDataStore.operation).\
+                           filter(CacheDataStore.target_node == cache.node_id).\
+                           filter(CacheDataStore.id > cursor).\
+                           order_by(CacheDataStore.id).limit(self.batch_size).all()
+
+            if not rows:
+                session.commit()
+                break
+
+            # Save the items just recently propagated to the cache
+            cache.receive(self.decode(cache, rows))
+            cursor = rows[-1].id
+
+            # Kept as the rows are applied, so that a poll that fails
+            # halfway doesn't apply the same rows again when retried
+            self._cursors[cache] = cursor
+
+            # Save the cursor in the registry, for compactions to know which rows were consumed.
+            # If that fails, the cursor is saved again with the next rows consumed.
+            try:
+                session.query(CacheGeolocation).filter(CacheGeolocation.node_id == cache.node_id).\
+                        update({CacheGeolocation.last_consumed_id: cursor}, synchronize_session=False)
+                session.commit()
+            except:
+                session.rollback()
+                break
+
+            if len(rows) < self.batch_size:
+                break
+
+        self._cursors[cache] = cursor
+
+        return
+
+    def compact(self, cache, session):
+        """
+        Delete, in bulk, the rows that `cache` has consumed, through the
+        (target_node, id) index, and the rows no cache would apply: those
+        of items that have expired, and those addressed to caches that
+        are no longer registered (e.g. closed while rows were on their way)
+
+        :param cache: the GeoLRUCache instance
+        :param session: the listener thread's database session
+        :return: the number of rows deleted
+        """
+
+        cursor = self._cursors.get(cache, 0)
+
+        try:
+            deleted = session.query(CacheDataStore).filter(CacheDataStore.target_node == cache.node_id).\
+                              filter(CacheDataStore.id <= cursor).delete(synchronize_session=False)
+            deleted += session.query(CacheDataStore).filter(CacheDataStore.expires_at < time.time()).\
+                               delete(synchronize_session=False)
+            deleted += session.query(CacheDataStore).\
+                               filter(~CacheDataStore.target_node.in_(session.query(CacheGeolocation.node_id))).\
+                               delete(synchronize_session=False)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+
+        return deleted
+
+    def publish(self, cache, targets, items):
+
+        if not targets:
+            return
+
+        # For each target, save the keys and values to the database.
+        # This will trigger the other caches (who are by default listening on the database) to read the
+        # keys and values and save them on themselves.
+        # The rows are written nearest target first, so ids increase with the distance of the target.
+        self.write(cache.session, targets, self.encode(cache, items))
+
+        return
+
+    @staticmethod
+    def encode(cache, items):
+        """
+        Encode the keys and values of writes with the cache's Serializer, once
+        per write however many targets the write has. Keys are encoded with its
+        `keys` Serializer, as they are for snapshots, so that they come back with
+        their type. The values of invalidations are left as they are.
+
+        :param cache: the cache that made the writes
+        :param items: a list of (key, value, deadline, version, tags) tuples
+        :return: a list of (encoded key, encoded value, deadline, version, tags) tuples
+        """
+
+        dumps, dump_key = cache.serializer.dumps, cache.serializer.keys.dumps
+        encoded = []
+
+        for key, value, *meta in items:
+            if not isinstance(value, Invalidation):
+                value = dumps(value)
+
+            encoded.append((dump_key(key), value, meta[0] if meta else None, meta[1] if len(meta) > 1 else None,
+                            meta[2] if len(meta) > 2 else None))
+
+        return encoded
+
+    @staticmethod
+    def decode(cache, rows):
+        """
+        Decode the keys and values of consumed rows with the cache's Serializer. Rows
+        that can't be decoded here (e.g. written with a codec whose package
+        isn't installed on this machine) are dropped.
+
+        :param cache: the consuming cache
+        :param rows: the rows, with their key, value, expires_at, version, origin, tags and operation
+        :return: a list of (key, value, deadline, version, tags) tuples
+        """
+
+        loads, load_key = cache.serializer.loads, cache.serializer.keys.loads
+        items = []
+
+        for row in rows:
+            try:
+                key = load_key(row.key)
+                value = INVALIDATIONS[row.operation] if row.operation is not None else loads(row.value)
+                version = (row.version, row.origin) if row.version is not None else None
+                tags = tuple(json.loads(row.tags)) if row.tags else None
+
+                # JSON gives tuples back as lists, which can't be keys
+                if isinstance(key, list):
+                    key = tuple(key)
+
+                items.append((key, value, row.expires_at, version, tags))
+            except Exception:
+                continue
+
+        return items
+
+    def write(self, session, targets, items):
+        """
+        Save writes as rows addressed to the targets, with `session`
+
+        :param session: the database session to write the rows with
+        :param targets: the Peers (see PeerIndex) to address the rows to
+        :param items: a list of (encoded key, encoded value, deadline, version, tags) tuples, see `encode`
+        """
+
+        columns = []
+        for key, value, deadline, version, tags in items:
+            invalidation = isinstance(value, Invalidation)
+            columns.append({'key': key, 'key_hash': self.hash_key(key), 'value': None if invalidation else value, 'expires_at': deadline,
+                            'version': version[0] if version else None, 'origin': version[1] if version else None,
+                            'tags': json.dumps(list(tags)) if tags else None,
+                            'operation': value.kind if invalidation else None})
+
+        rows = [dict(row, target_node=target.node_id, latitude=target[0], longitude=target[1])
+                for target in targets for row in columns]
+
+        if not rows:
+            return
+
+        # The rows still pending for the targets that an earlier write to the same key left
+        # behind, which the targets would only apply to overwrite them right after. Deleting
+        # them, rather than updating them in place, keeps the rows immutable, so that a target
+        # consuming a row never deletes a newer write along with it. A deletion supersedes
+        # the writes before it too, but prefix and tag invalidations supersede nothing.
+        versions = dict()
+        for key, value, _, version, _ in items:
+            if version is not None and (not isinstance(value, Invalidation) or value.kind == Invalidation.KEY):
+                versions[key] = max(versions.get(key, version), version)
+
+        # Delete the superseded rows, and write every row with one multi-row INSERT, in a single
+        # transaction, tried again if the database was busy or the connection was lost
+        def transaction(session):
+            self.lock_writes(session)
+            if versions:
+                self.delete_superseded(session, targets, versions)
+            session.execute(CacheDataStore.__table__.insert(), rows)
+            self.notify(session, targets)
+            session.commit()
+
+        try:
+            with_retries(session, transaction)
+        except Exception:
+            logger.exception("Failed to write %d row(s) to the datastore table", len(rows))
+
+        return
+
+    @staticmethod
+    def lock_writes(session):
+        """
+        Make the writers of the datastore table commit their rows in the
+        order of the rows' ids, so that a cache's cursor never moves past a
+        row that is yet to be committed. SQLite only ever has one writer at
+        a time already. On PostgreSQL, writers take an advisory lock, held
+        until they commit.
+
+        :param session: the session about to write rows
+        """
+
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': DatabaseTransport.WRITE_LOCK})
+
+        return
+
+    @staticmethod
+    def hash_key(key):
+        """
+        :param key: an encoded key, see `encode`
+        :return: a 64-bit hash of the key, as a signed integer
+        """
+
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big', signed=True)
+
+    @staticmethod
+    def delete_superseded(session, targets, versions):
+        """
+        Delete the rows pending for the targets that are earlier writes
+        to keys about to be written again
+
+        :param session: the session writing the new rows
+        :param targets: the Peers the new rows are for
+        :param versions: an encoded key -> version dict of the new writes
+        """
+
+        hashes = list(set(DatabaseTransport.hash_key(key) for key in versions))
+        targets = set(target.node_id for target in targets)
+        chunk_size = DatabaseTransport.PARAMETERS_PER_STATEMENT
+        superseded = []
+
+        # There is at most one pending row per key and cache, so the rows are looked
+        # up by the hash of the key alone, and picked out here rather than by comparing
+        # each target, each key (in case two keys share a hash) and each key's version in SQL
+        for start in range(0, len(hashes), chunk_size):
+            rows = session.query(CacheDataStore.id, CacheDataStore.target_node, CacheDataStore.key,
+                                 CacheDataStore.version, CacheDataStore.origin, CacheDataStore.operation).\
+                           filter(CacheDataStore.key_hash.in_(hashes[start:start + chunk_size])).all()
+
+            for row in rows:
+                if row.target_node not in targets:
+                    continue
+
+                # The key of a prefix or tag invalidation isn't a key
+                if row.operation is not None and row.operation != Invalidation.KEY:
+                    continue
+
+                # Keys are compared encoded, as the writers encoded them
+                version = versions.get(bytes(row.key))
+
+                if version is not None and (row.version is None or (row.version, row.origin) < version):
+                    superseded.append(row.id)
+
+        for start in range(0, len(superseded), chunk_size):
+            session.query(CacheDataStore).filter(CacheDataStore.id.in_(superseded[start:start + chunk_size])).\
+                    delete(synchronize_session=False)
+
+        return
+
+    def notify(self, session, targets):
+        """
+        Hook to tell the targets that rows were written for them, within the
+        transaction that wrote the rows. Polling caches need no telling.
+
+        :param session: the session that wrote the rows
+        :param targets: the Peers the rows were written for
+        """
+
+        return
+
+
+class PostgresNotifyTransport(DatabaseTransport):
+    """
+    Replicates writes through the datastore table, like DatabaseTransport,
+    but uses PostgreSQL's LISTEN/NOTIFY to wake caches up as soon as rows are
+    addressed to them, instead of polling. Requires the psycopg2 driver.
+
+    Caches still sweep the table every `poll_interval` seconds, which is only
+    a safety net for notifications lost to dropped connections.
+
+    """
+
+    CHANNEL = 'geo_lrucache'
+
+    def __init__(self, poll_interval=30, compaction_interval=60):
+
+        super().__init__(poll_interval=poll_interval, compaction_interval=compaction_interval)
+        self._connections = dict()
+
+    @staticmethod
+    def payload(node_id):
+
+        return str(node_id)
+
+    def subscribe(self, cache):
+
+        super().subscribe(cache)
+
+        # LISTEN must be issued on a connection that is not in a transaction,
+        # and that connection must be kept open for as long as the cache listens
+        connection = cache.engine.raw_connection()
+
+        # Caches share their engine's pool, which a connection held for
+        # good would drain: it is taken out of the pool altogether
+        connection.detach()
+        dbapi_connection = getattr(connection, 'dbapi_connection', None) or connection.connection
+        dbapi_connection.autocommit = True
+
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"LISTEN {PostgresNotifyTransport.CHANNEL}")
+        cursor.close()
+
+        self._connections[cache] = (connection, dbapi_connection)
+        return
+
+    def listen(self, cache):
+
+        try:
+            super().listen(cache)
+        finally:
+            connection, _ = self._connections.pop(cache)
+            connection.close()
+
+        return
+
+    def wait(self, cache, stopped):
+
+        _, dbapi_connection = self._connections[cache]
+        own_payload = self.payload(cache.node_id)
+        sweep_at = time.monotonic() + self.poll_interval
+
+        # Wait until a notification addressed to this cache arrives,
+        # or until it is time for the safety-net sweep. Wake up every
+        # second to check whether the cache has unsubscribed.
+        while not stopped.is_set():
+            timeout = min(1, sweep_at - time.monotonic())
+            if timeout <= 0:
+                return
+
+            readable, _, _ = select.select([dbapi_connection], [], [], timeout)
+            if not readable:
+                continue
+
+            dbapi_connection.poll()
+            notifications, dbapi_connection.notifies[:] = list(dbapi_connection.notifies), []
+
+            if any(notification.payload == own_payload for notification in notifications):
+                return
+
+        return
+
+    def notify(self, session, targets):
+
+        # NOTIFY is transactional, so the targets are only woken up
+        # once their rows have been committed
+        session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                        [{'channel': PostgresNotifyTransport.CHANNEL, 'payload': self.payload(target.node_id)}
+                         for target in targets])
+
+        return
+
+
+class InProcessTransport(ReplicationTransport):
+    """
+    Replicates writes directly between caches that live in the same process,
+    through one in-memory queue per cache. Writes are delivered as soon as
+    they are published, and nothing is written to the database.
+
+    All the caches that should see each other's writes must be given the
+    same InProcessTransport instance. Writes addressed to caches that are
+    not subscribed to the transport (e.g. caches in other processes) are
+    dropped. Neighbours' lookups are answered by calling the caches directly.
+
+    """
+
+    # Put on a cache's queue to make its listener return
+    _STOP = object()
+
+    def __init__(self):
+
+        super().__init__()
+
+        self._queues = dict()
+        self._caches = dict()
+        self._lock = threading.Lock()
+
+    def subscribe(self, cache):
+
+        with self._lock:
+            self._queues[cache.node_id] = queue.Queue()
+            self._caches[cache.node_id] = cache
+
+        return
+
+    def unsubscribe(self, cache):
+
+        with self._lock:
+            messages = self._queues.pop(cache.node_id, None)
+            self._caches.pop(cache.node_id, None)
+
+        if messages is not None:
+            messages.put(InProcessTransport._STOP)
+
+        return
+
+    def listen(self, cache):
+
+        with self._lock:
+            messages = self._queues.get(cache.node_id)
+
+        # The cache was closed before its listener started
+        if messages is None:
+            return
+
+        while True:
+            items = messages.get()
+
+            if items is InProcessTransport._STOP:
+                break
+
+            cache.receive(items)
+
+        return
+
+    def publish(self, cache, targets, items):
+
+        items = list(items)
+
+        for coordinates in targets:
+            with self._lock:
+                messages = self._queues.get(cache.peer_index.node_id_of(coordinates))
+
+            if messages is not None:
+                messages.put(items)
+
+        return
+
+    def serve(self, cache, address):
+
+        # Subscribed caches can already be reached directly
+        return None
+
+    def fetch(self, cache, targets, key, timeout, count=1):
+
+        with self._lock:
+            peers = [self._caches.get(cache.peer_index.node_id_of(coordinates)) for coordinates in targets]
+        peers = [peer for peer in peers if peer is not None][:count]
+
+        return first_hit([partial(peer.lookup_item, key) for peer in peers], timeout)
+
+    def fetch_items(self, cache, targets, since, timeout, count=3):
+
+        with self._lock:
+            peers = [self._caches.get(cache.peer_index.node_id_of(coordinates)) for coordinates in targets]
+        peers = [peer for peer in peers if peer is not None][:count]
+
+        for peer in peers:
+            items = peer.export(since)
+            if items:
+                return items
+
+        return []
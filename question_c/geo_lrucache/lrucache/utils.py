@@ -4,9 +4,39 @@ import time
 
 from functools import wraps
 
+# NumPy is optional. Without it, distances to many
+# locations are computed one at a time, in pure Python.
+# It is only imported once distances are first computed
+# (see `load_numpy`), as it takes long to import.
+_NOT_IMPORTED = object()
+numpy = _NOT_IMPORTED
+
+# The name of the default SQLite database file
+DB_NAME = 'ormuco'
+
 
 EARTH_RADIUS = 6378137 
 
+def load_numpy():
+     """
+     This function imports NumPy the first time it is called
+
+     :return: the numpy module, or None if NumPy isn't installed
+     """
+
+     global numpy
+
+     if numpy is _NOT_IMPORTED:
+          try:
+               import numpy as module
+          except ImportError:
+               module = None
+
+          numpy = module
+
+     return numpy
+
+
 def rad(coordinate):
     return (math.pi * coordinate) / 180
 
@@ -38,6 +68,62 @@ def get_distance(location_1, location_2):
      return round(distance, 5)
 
 
+def get_distances(origin, locations):
+     """
+
+     Haversine Formula, over many coordinates at once.
+
+     This function returns the distances between an origin and each of a sequence
+     of decimal-degree coordinates, as a list. If the origin is itself a sequence
+     of coordinates (as long as `locations`), it returns the distance between each
+     pair of coordinates instead. With NumPy installed, every distance is computed
+     in one vectorized operation.
+
+     """
+
+     if len(locations) == 0:
+          return []
+
+     numpy = load_numpy()
+
+     if numpy is None:
+          if isinstance(origin[0], (int, float, str)):
+               return [get_distance(origin, location) for location in locations]
+          return [get_distance(location_1, location_2) for location_1, location_2 in zip(origin, locations)]
+
+     origin = numpy.radians(numpy.asarray(origin, dtype=float))
+     locations = numpy.radians(numpy.asarray(locations, dtype=float))
+
+     lat_1, long_1 = origin[..., 0], origin[..., 1]
+     lat_2, long_2 = locations[..., 0], locations[..., 1]
+
+     a = numpy.sin((lat_2 - lat_1) / 2) ** 2 + numpy.cos(lat_1) * numpy.cos(lat_2) * \
+          numpy.sin((long_2 - long_1) / 2) ** 2
+
+     c = 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+     return numpy.round(EARTH_RADIUS * c, 5).tolist()
+
+
+def sort_by_distance(origin, locations):
+     """
+     This function returns each of a sequence of decimal-degree coordinates
+     with its distance to the origin, as a list of (coordinates, distance)
+     tuples sorted from the closest to the furthest.
+
+     """
+
+     distances = get_distances(origin, locations)
+     numpy = load_numpy()
+
+     if numpy is None:
+          return sorted(zip(locations, distances), key=lambda i: i[1])
+
+     # Rank every location in one array operation. A stable sort keeps
+     # equally distant locations in their original order.
+     return [(locations[i], distances[i]) for i in numpy.argsort(distances, kind='stable').tolist()]
+
+
 def validate_coordinates(coordinates):
      """
      This function helps to validate the inputed coordinates
@@ -59,6 +145,75 @@ def validate_coordinates(coordinates):
           return False
 
 
+def to_deadline(ttl):
+     """
+     This function turns a time-to-live into the wall-clock time at which
+     the item expires, which is how deadlines travel between caches: unlike
+     the monotonic clock the caches expire items by, the wall clock means the
+     same thing on every machine (given that their clocks are synchronized).
+
+     :param ttl: the time-to-live, in seconds, or None if the item never expires
+     :return: a UNIX timestamp, or None
+     """
+     if ttl is None:
+          return None
+
+     return time.time() + ttl
+
+
+def to_ttl(deadline):
+     """
+     The inverse of to_deadline: the time left, in seconds, until a
+     wall-clock deadline. It is negative once the deadline has passed.
+
+     """
+     if deadline is None:
+          return None
+
+     return deadline - time.time()
+
+
+async def run_in_thread(func, *args):
+     """
+     This function runs a blocking function on the event loop's default
+     executor, and waits for it without blocking the loop. It does what
+     `asyncio.to_thread` does, which only Python 3.9 and later have.
+
+     :param func: the function
+     :param args: the arguments to call it with
+     :return: what the function returns
+     """
+     import asyncio
+
+     return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+def evict(cache):
+     """
+     This function deletes the least recently used items of a cache until
+     it holds no more than `max_size` items and, if it has a `max_bytes`
+     budget, no more than `max_bytes` bytes of items. The store keeps its
+     entries ordered from the least to the most recently used. Leverage on that
+
+     :param cache: the cache instance
+     :return: the number of items deleted
+     """
+     store = cache.store
+     evicted = 0
+
+     while len(store) > cache.max_size or (cache.max_bytes is not None and store.total_bytes > cache.max_bytes):
+          oldest_entry = store.pop_oldest()
+          if oldest_entry is None:
+               break
+
+          # Keep a copy of the oldest item in the cache, just in case
+          # of a future API requirement
+          cache.set_oldest_item = (oldest_entry.key, oldest_entry.accessed_at)
+          evicted += 1
+
+     return evicted
+
+
 def clean_up(func):
      """
      Decorator function that 'cleans up' the cache before every
@@ -69,50 +224,27 @@ def clean_up(func):
      """
      @wraps(func)
      def wrapper(self, *args, **kwargs):
-          # If the items in the cache do expire
-          if self.expires_in is not None:
-
-               # Get the current time
-               now = int(time.time())
-
-               # A list of all the keys to delete 
-               # once they have been identified
-               keys_to_delete = []
-
-               # Check the times to live of all the items in the cache,
-               # and delete the items that have expired. To prevent
-               # deleting while iterating, add the expired keys to a list.
-               for key in self.times_to_live:
-                    if self.times_to_live[key] < now:
-                         keys_to_delete.append(key)
-               
-               # Then, delete the items using their keys 
-               for key in keys_to_delete:    
-                    self.__delitem__(key)
+          # Get the current time. Items expire by the monotonic clock, to
+          # the fraction of a second, so that they expire on time even
+          # if the system clock is set back or forward.
+          now = time.monotonic()
 
-          # Check if the maximum size of the cache has been reached,
-          # delete the oldest one. Ordered dicts retain item insertion
-          # order. Leverage on that
-          if (len(self.values) > self.max_size):
-               oldest_datum = self.access_times.popitem(last=False)
-               self.__delitem__(oldest_datum[0])
+          # Pop the items whose deadlines have passed off the expiry index,
+          # whether or not the cache has a default `expires_in`: items can
+          # have a ttl of their own. Unlike scanning every item in the cache,
+          # this only touches the items that have actually expired.
+          self.store.expire(now)
 
-               # Keep a copy of the oldest item in the cache, just in case
-               # of a future API requirement
-               self.set_oldest_item = oldest_datum
+          # Check if the maximum size of the cache has been reached,
+          # delete the oldest items
+          evicted = evict(self)
 
           # If the size of the cache is still less than the cache's maximum size,
-          # still save the first item in the cache as the oldest item
-          else:
-               try:
-                    # try to get the first item that was saved in the cache
-                    first_item = next(iter(self.access_times.items()))
-                    # Save the item as the oldest item in the cache
-                    self.set_oldest_item = (first_item[0], self.values.get(first_item[0]))
-
-               # if no item has ever been saved, use the default settings (None)
-               except StopIteration:
-                    self.set_oldest_item
+          # the oldest item is the first item in the cache. Finding it takes a look
+          # at every shard, so it is only looked up when oldest_item is read.
+          # if no item has ever been saved, keep the default settings (None)
+          if not evicted and len(self.store):
+               self.set_oldest_item = None
              
           return func(self, *args, **kwargs)
      return wrapper
@@ -122,8 +254,8 @@ def clean_up(func):
 def propagate_write(func):
      """
      This function propagates every write operation across all caches 
-     registered with the application. The database is the interaction
-     layer between each cache and the other caches. 
+     registered with the application, through the cache's transport
+     (by default, the database). 
 
      The function propagates the writes linearly, in a closest-to-furthest
      manner, meaning that the closest cache to this cache will be written
@@ -151,30 +283,19 @@ def propagate_write(func):
           # if the operation of item setting (i.e. __setitem__) came from the main
           # cache's thread and not a background thread.
           if kwargs.get("from_thread") is None:
-               
-               # Get a list of all the caches registered in the environment, 
-               # arranged according to their distance to this cache 
-               prioritized_distance_index = self.sort_distances()
-
-               # For each coordinate-distance tuple in the above list, save the key and value to the database.
-               # This will trigger the other caches (who are by default listening on the database) to read the
-               # key and value and save it on themselves.
-               # The first item in the list is the cache closest to this cache, the next item is the cache 
-               # second-closest to this cache, and so on. That way, data will always first be available from
-               # the cache closest to this cache (locality of reference).
-               for i in prioritized_distance_index:
-                    new_set = CacheDataStore(latitude=i[0][0], longitude=i[0][1], key=key, value=value)
-                    try:
-                         self.session.add(new_set)
-                         self.session.commit()
-                         # To test which location first receives the data being propagated,
-                         # uncomment the sleep() call below.
-                         # time.sleep(5)
-                    except:
-                         self.session.rollback()
+
+               # The item travels with its deadline, so that every cache
+               # expires it at the same time as this one does
+               ttl = kwargs.get("ttl")
+               if ttl is None:
+                    ttl = self.expires_in
+
+               # and with its version, so that every cache keeps the
+               # latest write to the key, whatever order they arrive in
+               kwargs["version"] = self.clock.now()
+
+               self.propagate([(key, value, to_deadline(ttl), kwargs["version"], kwargs.get("tags"))],
+                              kwargs.get("scope"))
 
           return func(self, key, value, *args, **kwargs)
      return wrapper
-          
-
-from .models import CacheGeolocation, CacheDataStore
\ No newline at end of file
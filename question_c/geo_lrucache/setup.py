@@ -9,6 +9,7 @@ setuptools.setup(
      description="A coordinates-based distributed LRU cache with optional time epiration",
      url="https://github.com/oluminous/geo_lrucache",
      packages=setuptools.find_packages(),
+     python_requires='>=3.7',
      classifiers=[
          "Programming Language :: Python :: 3",
          "License :: OSI Approved :: MIT License",
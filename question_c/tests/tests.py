@@ -0,0 +1,1559 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import unittest
+import threading
+import subprocess
+
+from types import SimpleNamespace
+from random import Random
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from lrucache.geo_lrucache import GeoLRUCache
+from lrucache import utils, sizing, serialization, snapshot
+from lrucache.store import LRUStore, Store
+from lrucache.policies import POLICIES, get_policy
+from lrucache.spatial import SpatialIndex
+from lrucache.scopes import NearestPeers, PeersWithin, SameRegion, PeerGroup
+from lrucache.invalidation import DELETE, INVALIDATE_PREFIX, INVALIDATE_TAG
+from lrucache.models import CacheGeolocation, CacheDataStore
+from lrucache.database import with_retries, is_transient
+from lrucache.peers import register
+from lrucache.transports import InProcessTransport, DatabaseTransport
+from lrucache.publisher import WriteBehindPublisher, AsyncWriteBehindPublisher
+from lrucache.async_geo_lrucache import AsyncGeoLRUCache
+from lrucache.async_transports import AsyncInProcessTransport, AsyncDatabaseTransport
+
+
+def make_db_url():
+    """
+    Every test case gets its own SQLite database, so
+    that caches from different tests never see each other
+    """
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+    return 'sqlite:///' + path
+
+
+def wait_for(condition, timeout=5):
+    """
+    Wait for a condition that is met by a background thread
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+async def async_wait_for(condition, timeout=5):
+    """
+    Wait for a condition that is met by a background task
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+
+    return True
+
+
+class TestDistances(unittest.TestCase):
+
+    montreal = (45.5016889, -73.567256)
+    locations = [(49.2827291, -123.1207375), (43.653226, -79.3831843), (45.5016889, -73.567256)]
+
+    def check_distances(self):
+        expected = [utils.get_distance(self.montreal, location) for location in self.locations]
+
+        for distance, expected_distance in zip(utils.get_distances(self.montreal, self.locations), expected):
+            self.assertAlmostEqual(distance, expected_distance, places=3)
+
+        pairwise = utils.get_distances([self.montreal] * 3, self.locations)
+        for distance, expected_distance in zip(pairwise, expected):
+            self.assertAlmostEqual(distance, expected_distance, places=3)
+
+        ranked = utils.sort_by_distance(self.montreal, self.locations)
+        self.assertEqual([location for location, _ in ranked],
+                         [self.locations[2], self.locations[1], self.locations[0]])
+
+    def test_distances(self):
+        self.check_distances()
+
+    def test_distances_without_numpy(self):
+        numpy, utils.numpy = utils.numpy, None
+        try:
+            self.check_distances()
+        finally:
+            utils.numpy = numpy
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        random = Random(0)
+        self.locations = [(random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(500)]
+        self.origins = [(random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(20)]
+        self.index = SpatialIndex(self.locations)
+
+    def test_nearest(self):
+        for origin in self.origins:
+            expected = utils.sort_by_distance(origin, self.locations)[:5]
+
+            self.assertEqual([location for location, _ in self.index.nearest(origin, 5)],
+                             [location for location, _ in expected])
+
+    def test_within(self):
+        for origin in self.origins:
+            expected = [location for location, distance in utils.sort_by_distance(origin, self.locations)
+                        if distance <= 2000000]
+
+            self.assertEqual([location for location, _ in self.index.within(origin, 2000000)], expected)
+
+    def test_antimeridian(self):
+        index = SpatialIndex([(0, 179.9), (0, 170), (0, -175)])
+
+        self.assertEqual([location for location, _ in index.nearest((0, -179.9), 2)], [(0, 179.9), (0, -175)])
+
+
+class TestLRUStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = LRUStore()
+
+    def test_expire(self):
+        for key, deadline in (('a', 3), ('b', 1), ('c', 2)):
+            self.store.set(key, key, 0, deadline)
+
+        self.assertEqual([entry.key for entry in self.store.expire(2.5)], ['b', 'c'])
+        self.assertEqual(self.store.expire(2.5), [])
+        self.assertEqual(len(self.store), 1)
+
+    def test_overwritten_entries_do_not_expire_early(self):
+        self.store.set('a', 1, 0, 1)
+
+        # Overwrite the item with a later deadline
+        self.store.set('a', 2, 0, 10)
+
+        self.assertEqual(self.store.expire(5), [])
+        self.assertEqual([entry.value for entry in self.store.expire(11)], [2])
+
+    def test_expiry_index_compaction(self):
+        for deadline in range(1000):
+            self.store.set('a', deadline, 0, deadline)
+
+        self.assertEqual(len(self.store.expire(1000)), 1)
+
+    def test_lru_order(self):
+        for key in ('a', 'b', 'c'):
+            self.store.set(key, key, 0)
+
+        self.store.get('a', 1)
+
+        self.assertEqual(self.store.pop_oldest().key, 'b')
+        self.assertEqual([entry.key for entry in self.store], ['c', 'a'])
+
+    def test_tombstones(self):
+        self.store.set('a', 1, 0, version=(10, 1))
+        self.store.bury('a', (20, 1), 0, 5)
+        self.assertIsNotNone(self.store.delete('a', (20, 1)))
+
+        # Writes earlier than the deletion are refused until the tombstone expires
+        self.assertIsNone(self.store.set('a', 1, 1, version=(15, 1)))
+        self.assertIsNotNone(self.store.set('a', 1, 6, version=(15, 2)))
+
+        # and a deletion doesn't delete a later write
+        self.assertIsNone(self.store.delete('a', (10, 1)))
+        self.assertEqual(self.store.peek('a').value, 1)
+
+        self.store.bury('b', (30, 1), 7, 10)
+        self.assertEqual(list(self.store.tombstones), ['b'])
+
+
+class TestPolicies(unittest.TestCase):
+
+    CAPACITY = 100
+
+    def fill(self, policy):
+        store = Store(get_policy(policy, self.CAPACITY))
+
+        def access(key):
+            if store.get(key, 0) is None:
+                store.set(key, key, 0)
+                while len(store) > self.CAPACITY:
+                    store.pop_oldest()
+
+        return store, access
+
+    def test_invariants(self):
+        for policy in POLICIES:
+            with self.subTest(policy=policy):
+                store, access = self.fill(policy)
+                random = Random(0)
+
+                for _ in range(5000):
+                    key = int(random.paretovariate(1)) % 300
+                    operation = random.random()
+                    if operation < 0.1:
+                        store.delete(key)
+                    elif operation < 0.2:
+                        store.set(key, -key, 0)
+                    else:
+                        access(key)
+
+                    if len(store) > self.CAPACITY:
+                        store.pop_oldest()
+
+                self.assertLessEqual(len(store), self.CAPACITY + 1)
+                self.assertEqual(sorted(entry.key for entry in store), sorted(store.entries))
+
+                while len(store):
+                    self.assertIn(store.oldest().key, store.entries)
+                    store.pop_oldest()
+                self.assertEqual(list(store), [])
+
+    def test_scan_resistance(self):
+        hits = dict()
+
+        for policy in POLICIES:
+            store, access = self.fill(policy)
+
+            # A hot set, read many times, then a scan of one-off keys
+            for _ in range(10):
+                for key in range(50):
+                    access(key)
+            for key in range(1000, 1500):
+                access(key)
+
+            hits[policy] = sum(1 for key in range(50) if key in store)
+
+        self.assertEqual(hits['lru'], 0)
+        for policy in ('sieve', 'arc', 'tinylfu'):
+            self.assertGreaterEqual(hits[policy], 45, policy)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            get_policy('mru')
+
+
+class TestGeoLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GeoLRUCache((45.5016889, -73.567256), max_size=3, expires_in=1, db_url=make_db_url())
+
+    def test_set_and_get(self):
+        self.cache.set('key', 'value')
+
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertTrue('key' in self.cache)
+
+    def test_expiry(self):
+        self.cache.set('key', 'value')
+        time.sleep(1.1)
+
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.size(), 0)
+
+    def test_per_item_ttl(self):
+        self.cache.set('short', 'value', ttl=0.1)
+        self.cache.set_many({'long': 'value'}, ttl=60)
+        time.sleep(0.15)
+
+        self.assertIsNone(self.cache.get('short'))
+        self.assertEqual(self.cache.get('long'), 'value')
+
+    def test_per_item_ttl_without_default_expiry(self):
+        cache = GeoLRUCache((45.5016889, -73.567256), expires_in=None, db_url=False)
+
+        cache.set('short', 'value', ttl=0.1)
+        cache.set('forever', 'value')
+        time.sleep(0.15)
+
+        # The expired item is removed, not only hidden
+        self.assertEqual(cache.size(), 1)
+        self.assertFalse('short' in cache)
+        self.assertEqual(cache.get('forever'), 'value')
+
+    def test_expired_writes_are_not_received(self):
+        self.cache.receive([('key', 'value', time.time() - 1), ('other', 'value', None)])
+
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.get('other'), 'value')
+
+    def test_last_writer_wins(self):
+        self.cache.receive([('key', 'newer', None, (20, 1)), ('key', 'older', None, (10, 2))])
+        self.assertEqual(self.cache.get('key'), 'newer')
+
+        # Unversioned writes are always applied
+        self.cache.receive([('key', 'unversioned')])
+        self.assertEqual(self.cache.get('key'), 'unversioned')
+
+    def test_writes_are_versioned_after_received_ones(self):
+        ahead = (self.cache.clock.now()[0] + (60000 << 16), 1)
+        self.cache.receive([('key', 'remote', None, ahead)])
+
+        # A local write made after a remote one is later, even if the remote clock is ahead
+        self.cache.set('key', 'local')
+        self.assertEqual(self.cache.get('key'), 'local')
+        self.assertGreater(self.cache.store.peek('key').version, ahead)
+
+    def test_deletions_refuse_earlier_writes(self):
+        self.cache.receive([('key', 'value', None, (10, 1)), ('key', DELETE, None, (20, 1), None)])
+        self.assertFalse('key' in self.cache)
+
+        # A write made before the deletion, arriving after it
+        self.cache.receive([('key', 'stale', None, (15, 2))])
+        self.assertIsNone(self.cache.get('key'))
+
+        self.cache.set('key', 'new')
+        self.assertEqual(self.cache.get('key'), 'new')
+
+    def test_invalidations_refuse_earlier_writes(self):
+        self.cache.receive([('user:1', 'a', None, (10, 1)), ('post:1', 'b', None, (10, 1), ('user:2',)),
+                            ('post:2', 'c', None, (30, 1), ('user:2',))])
+        self.cache.receive([('user:', INVALIDATE_PREFIX, None, (20, 1)), ('user:2', INVALIDATE_TAG, None, (20, 1))])
+
+        # The later write to post:2 is kept
+        self.assertEqual(self.cache.size(), 1)
+        self.assertEqual(self.cache.get('post:2'), 'c')
+
+        self.cache.receive([('user:3', 'stale', None, (15, 2)), ('post:3', 'stale', None, (15, 2), ('user:2',)),
+                            ('other', 'value', None, (15, 2), ('user:1',))])
+        self.assertIsNone(self.cache.get('user:3'))
+        self.assertIsNone(self.cache.get('post:3'))
+        self.assertEqual(self.cache.get('other'), 'value')
+
+    def test_eviction(self):
+        for i in range(4):
+            self.cache.set(f'key{i}', i)
+
+        self.assertFalse('key0' in self.cache)
+        self.assertEqual(self.cache.size(), 3)
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def test_no_database(self):
+        cache = GeoLRUCache((45.5016889, -73.567256), db_url=False)
+
+        cache.set('a', 1)
+        cache.set_many({'b': 2, 'c': 3})
+        cache.delete('b')
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.size(), 2)
+        self.assertEqual(cache.sort_distances(refresh=True), [])
+        self.assertIsNone(cache.session)
+        self.assertIsNone(cache.listener_thread)
+        cache.close()
+
+    def test_replicating_needs_a_database(self):
+        for options in ({'transport': InProcessTransport()}, {'write_behind': True}, {'neighbour_aware': True}):
+            with self.assertRaises(ValueError):
+                GeoLRUCache((45.5016889, -73.567256), db_url=False, **options)
+
+    def test_sqlalchemy_is_not_imported(self):
+        code = ("import sys\n"
+                "from lrucache.geo_lrucache import GeoLRUCache\n"
+                "GeoLRUCache((45.5, -73.5), db_url=False).set('key', 'value')\n"
+                "print(sorted(module for module in ('sqlalchemy', 'numpy', 'asyncio') if module in sys.modules))")
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+
+        self.assertEqual(output.strip(), '[]')
+
+        # nor by a local async cache
+        code = ("import sys, asyncio\n"
+                "from lrucache.async_geo_lrucache import AsyncGeoLRUCache\n"
+                "asyncio.run(AsyncGeoLRUCache((45.5, -73.5), db_url=False).aset('key', 'value'))\n"
+                "print('sqlalchemy' in sys.modules)")
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+
+        self.assertEqual(output.strip(), 'False')
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.db_url = make_db_url()
+        self.path = self.db_url[len('sqlite:///'):] + '.snapshot'
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def make_cache(self, coordinates=(45.5016889, -73.567256), **options):
+        cache = GeoLRUCache(coordinates, db_url=self.db_url, transport=InProcessTransport(), **options)
+        self.caches.append(cache)
+        return cache
+
+    def test_snapshot_and_load(self):
+        cache = self.make_cache(expires_in=None)
+        cache.set('a', {'nested': [1, 2]})
+        cache.set('b', b'bytes', ttl=30, tags=['binary'])
+        cache.set('c', 'short-lived', ttl=0.05)
+        cache.get('a')
+
+        self.assertEqual(cache.snapshot(self.path), 3)
+        time.sleep(0.1)
+
+        restarted = self.make_cache((43.653226, -79.3831843), expires_in=None)
+        self.assertEqual(restarted.load(self.path), 2)
+
+        # The expired item is dropped, the recency order and deadlines are kept
+        self.assertEqual([entry.key for entry in restarted.store], ['b', 'a'])
+        self.assertEqual(restarted.get('a'), {'nested': [1, 2]})
+        self.assertEqual(restarted.store.peek('b').tags, ('binary',))
+        self.assertIsNone(restarted.store.peek('a').expires_at)
+        self.assertAlmostEqual(restarted.store.peek('b').expires_at - time.monotonic(), 30, delta=2)
+
+    def test_warm_start(self):
+        cache = self.make_cache(snapshot_path=self.path)
+        cache.set('key', 'value')
+        cache.close()
+
+        restarted = self.make_cache((43.653226, -79.3831843), snapshot_path=self.path)
+        self.assertEqual(restarted.get('key'), 'value')
+
+    def test_periodic_snapshot(self):
+        cache = self.make_cache(snapshot_path=self.path, snapshot_interval=0.05)
+        cache.set('key', 'value')
+
+        self.assertTrue(wait_for(lambda: os.path.exists(self.path)))
+
+    def test_concurrent_snapshots(self):
+        cache = self.make_cache()
+        cache.set_many({i: 'x' * 1000 for i in range(1000)})
+
+        threads = [threading.Thread(target=cache.snapshot, args=(self.path,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every snapshot wrote a file of its own, then renamed it
+        directory, name = os.path.split(self.path)
+        self.assertEqual([leftover for leftover in os.listdir(directory) if leftover.startswith(name + '.')], [])
+        self.assertEqual(self.make_cache((43.653226, -79.3831843)).load(self.path), 1000)
+
+    def test_loaded_items_yield_to_later_deletions(self):
+        cache = self.make_cache()
+        cache.set_many({'user:1': 1, 'user:2': 2, 'post:1': 3})
+        cache.snapshot(self.path)
+
+        restarted = self.make_cache((43.653226, -79.3831843))
+        restarted.delete('post:1')
+        restarted.invalidate_prefix('user:')
+
+        self.assertEqual(restarted.load(self.path), 0)
+        self.assertEqual(restarted.size(), 0)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as invalid:
+            invalid.write(b'not a snapshot')
+
+        self.assertRaises(ValueError, self.make_cache().load, self.path)
+
+
+class TestByteBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url(), transport=InProcessTransport(),
+                                 max_bytes=100, sizer=len)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_eviction_by_size(self):
+        for key in 'abcd':
+            self.cache.set(key, 'x' * 30)
+        self.assertEqual(self.cache.bytes_used(), 90)
+        self.assertIsNone(self.cache.get('a'))
+
+        # One large item can evict several small ones
+        self.cache.set('large', 'x' * 70)
+        self.assertEqual(self.cache.bytes_used(), 100)
+        self.assertEqual(self.cache.size(), 2)
+        self.assertIsNone(self.cache.get('c'))
+
+    def test_overwrites_and_deletes(self):
+        self.cache.set('key', 'x' * 50)
+        self.cache.set('key', 'x' * 10)
+        self.assertEqual(self.cache.bytes_used(), 10)
+
+        del self.cache['key']
+        self.assertEqual(self.cache.bytes_used(), 0)
+
+    def test_items_over_budget_are_not_kept(self):
+        self.cache.set('a', 'x')
+        self.cache.set('b', 'y')
+        self.cache.set('key', 'small')
+
+        self.cache.set('key', 'x' * 200)
+
+        # The other items survive, and the value replaced isn't served anymore
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.cache.get('a'), 'x')
+        self.assertEqual(self.cache.get('b'), 'y')
+        self.assertEqual(self.cache.bytes_used(), 2)
+
+    def test_sizers(self):
+        self.assertGreater(sizing.get_sizer('pickle')({'key': 'x' * 100}), 100)
+        self.assertEqual(sizing.get_sizer('json')('abc'), 5)
+        with self.assertRaises(ValueError):
+            sizing.get_sizer('unknown')
+
+
+class TestReplication(unittest.TestCase):
+
+    def setUp(self):
+        db_url = make_db_url()
+        transport = InProcessTransport()
+
+        self.montreal = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport)
+        self.toronto = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport)
+        self.vancouver = GeoLRUCache((49.2827291, -123.1207375), db_url=db_url, transport=transport)
+
+        # Wait for every cache to register itself, and to know of the others
+        for cache in (self.montreal, self.toronto, self.vancouver):
+            self.assertTrue(wait_for(lambda: len(cache.sort_distances(refresh=True)) == 2))
+
+    def tearDown(self):
+        for cache in (self.montreal, self.toronto, self.vancouver):
+            cache.close()
+
+    def test_in_process_replication(self):
+        self.montreal.set('key', 'value')
+
+        self.assertTrue(wait_for(lambda: self.toronto.get('key') == 'value', timeout=0.1))
+        self.assertTrue(wait_for(lambda: self.vancouver.get('key') == 'value', timeout=0.1))
+
+    def test_deadlines_are_replicated(self):
+        self.montreal.set('key', 'value', ttl=0.2)
+        self.assertTrue(wait_for(lambda: self.toronto.lookup('key') == 'value', timeout=0.1))
+
+        # Toronto expires the item with Montreal, not a minute later
+        time.sleep(0.25)
+        self.assertIsNone(self.toronto.get('key'))
+
+    def test_deletions_are_replicated(self):
+        self.montreal.set_many({'a': 1, 'b': 2, 'c': 3})
+        self.assertTrue(wait_for(lambda: self.vancouver.size() == 3))
+
+        self.toronto.delete('a')
+        self.toronto.delete_many(['b', 'missing'])
+
+        self.assertTrue(wait_for(lambda: self.montreal.size() == 1 and self.vancouver.size() == 1))
+        self.assertEqual(self.vancouver.get('c'), 3)
+
+    def test_invalidations_are_replicated(self):
+        self.montreal.set('user:1', 'a')
+        self.montreal.set('user:2', 'b', tags=['team:1'])
+        self.montreal.set('post:1', 'c', tags=['team:1', 'public'])
+        self.montreal.set('post:2', 'd', tags=['public'])
+        self.assertTrue(wait_for(lambda: self.vancouver.size() == 4))
+
+        self.assertEqual(self.toronto.invalidate_prefix('user:'), 2)
+        self.assertTrue(wait_for(lambda: self.vancouver.size() == 2))
+
+        self.assertEqual(self.vancouver.invalidate_tag('team:1'), 1)
+        self.assertTrue(wait_for(lambda: self.montreal.size() == 1 and self.toronto.size() == 1))
+        self.assertEqual(self.montreal.get('post:2'), 'd')
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        db_url = make_db_url()
+        transport = InProcessTransport()
+
+        # A flush interval long enough to never elapse during a test
+        self.montreal = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport,
+                                    write_behind=True, flush_interval=60)
+        self.toronto = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport)
+
+        self.assertTrue(wait_for(lambda: len(self.montreal.sort_distances(refresh=True)) == 1))
+
+    def tearDown(self):
+        for cache in (self.montreal, self.toronto):
+            cache.close()
+
+    def test_flush(self):
+        for i in range(10):
+            self.montreal.set('key', i)
+        self.montreal.set('other', 'value')
+
+        # The local writes happen right away, and the
+        # pending writes to the same key are coalesced
+        self.assertEqual(self.montreal.get('key'), 9)
+        self.assertEqual(self.montreal.publisher.pending, 2)
+        self.assertIsNone(self.toronto.get('key'))
+
+        self.assertTrue(self.montreal.flush(timeout=5))
+        self.assertTrue(wait_for(lambda: self.toronto.get('key') == 9 and self.toronto.get('other') == 'value'))
+
+    def test_invalidations_are_not_coalesced_with_writes(self):
+        self.montreal.set('user:', 'value')
+        self.montreal.invalidate_prefix('user:')
+        self.montreal.delete('user:')
+
+        # The deletion replaces the pending write, but not the invalidation
+        self.assertEqual(self.montreal.publisher.pending, 2)
+
+    def test_close_flushes(self):
+        self.montreal.set('key', 'value')
+        self.montreal.close()
+
+        self.assertTrue(wait_for(lambda: self.toronto.get('key') == 'value'))
+
+    def test_overflow_policies(self):
+        published = []
+        cache = SimpleNamespace(publish=lambda items, scope: published.extend(key for key, *_ in items))
+        writes = [(key, 1, None, None, None) for key in 'abc']
+
+        dropping = WriteBehindPublisher(cache, flush_interval=60, max_pending=2,
+                                        overflow=WriteBehindPublisher.DROP_OLDEST)
+        dropping.put(writes)
+        self.assertEqual(dropping.pending, 2)
+        dropping.close()
+        self.assertEqual(published, ['b', 'c'])
+
+        # The caller publishes the pending writes to make room for its own
+        del published[:]
+        running = WriteBehindPublisher(cache, flush_interval=60, max_pending=2,
+                                       overflow=WriteBehindPublisher.CALLER_RUNS)
+        running.put(writes)
+        self.assertEqual((published, running.pending), (['a', 'b'], 1))
+        running.close()
+
+        # The caller waits for the publisher's thread to make room
+        del published[:]
+        blocking = WriteBehindPublisher(cache, flush_interval=60, max_pending=2)
+        blocking.put(writes[:2])
+        thread = threading.Thread(target=blocking.put, args=(writes[2:],))
+        thread.start()
+        thread.join(5)
+        self.assertEqual((published, blocking.pending), (['a', 'b'], 1))
+        blocking.close()
+
+
+class TestDatabaseReplication(unittest.TestCase):
+
+    def setUp(self):
+        db_url = make_db_url()
+
+        self.montreal = GeoLRUCache((45.5016889, -73.567256), db_url=db_url,
+                                    transport=DatabaseTransport(poll_interval=0.05))
+        self.toronto = GeoLRUCache((43.653226, -79.3831843), db_url=db_url,
+                                   transport=DatabaseTransport(poll_interval=0.05))
+
+        self.assertTrue(wait_for(lambda: len(self.montreal.sort_distances(refresh=True)) == 1))
+
+    def tearDown(self):
+        for cache in (self.montreal, self.toronto):
+            cache.close()
+
+    def test_writes_are_applied_in_order(self):
+        for i in range(50):
+            self.montreal.set('key', i)
+
+        # Values keep their type through the datastore table
+        self.assertTrue(wait_for(lambda: self.toronto.get('key') == 49))
+
+    def test_deadlines_are_replicated(self):
+        self.montreal.set('key', 'value', ttl=30)
+        self.assertTrue(wait_for(lambda: self.toronto.get('key') == 'value'))
+
+        entry = self.toronto.store.peek('key')
+        self.assertAlmostEqual(entry.expires_at - time.monotonic(), 30, delta=2)
+
+    def test_set_many(self):
+        self.montreal.set_many({'a': 'x', 'b': 'y'})
+
+        self.assertEqual(self.montreal.get('b'), 'y')
+        self.assertTrue(wait_for(lambda: self.toronto.get('a') == 'x' and self.toronto.get('b') == 'y'))
+
+    def test_structured_values(self):
+        value = {'name': 'x' * 5000, 'points': [(45.5, -73.5)] * 100, 'tags': {'a', 'b'}}
+        self.montreal.set('key', value)
+
+        self.assertTrue(wait_for(lambda: self.toronto.get('key') == value))
+
+    def test_keys_keep_their_type(self):
+        keys = [5, ('tuple', 1), 'x' * 500]
+        for key in keys:
+            self.montreal.set(key, 'value')
+            self.montreal.set(key, 'latest')
+
+        self.assertTrue(wait_for(lambda: all(self.toronto.get(key) == 'latest' for key in keys)))
+        self.assertIsNone(self.toronto.get('5'))
+
+        self.montreal.delete(5)
+        self.assertTrue(wait_for(lambda: self.toronto.get(5) is None))
+
+    def test_caches_at_the_same_coordinates(self):
+        twin = GeoLRUCache(self.toronto.coordinates, db_url=self.montreal.db_url,
+                           transport=DatabaseTransport(poll_interval=0.05))
+        try:
+            self.assertTrue(wait_for(lambda: len(self.montreal.sort_distances(refresh=True)) == 2))
+
+            self.montreal.set('key', 'value')
+            self.assertTrue(wait_for(lambda: self.toronto.get('key') == 'value' and twin.get('key') == 'value'))
+        finally:
+            twin.close()
+
+    def test_consumed_rows_are_compacted(self):
+        self.montreal.set_many({'a': 1, 'b': 2})
+        self.assertTrue(wait_for(lambda: self.toronto.get('b') == 2))
+
+        def consumed():
+            session = self.montreal.Session()
+            try:
+                return session.query(CacheGeolocation.last_consumed_id).\
+                               filter(CacheGeolocation.node_id == self.toronto.node_id).scalar()
+            finally:
+                session.close()
+
+        # The rows are kept, behind Toronto's cursor, until they are compacted
+        self.assertTrue(wait_for(lambda: consumed() > 0))
+        self.assertEqual(self.montreal.session.query(CacheDataStore).count(), 2)
+
+        session = self.toronto.Session()
+        try:
+            self.assertEqual(self.toronto.transport.compact(self.toronto, session), 2)
+        finally:
+            session.close()
+
+        self.montreal.session.commit()
+        self.assertEqual(self.montreal.session.query(CacheDataStore).count(), 0)
+
+    def test_restarted_cache_resumes(self):
+        quebec = GeoLRUCache((46.8138783, -71.2079809), db_url=self.montreal.db_url, node_id=7,
+                             transport=DatabaseTransport(poll_interval=0.05))
+        self.assertTrue(quebec.bootstrapped.wait(5))
+
+        # A cache given its node id keeps its registration once closed
+        quebec.close()
+        quebec.listener_thread.join()
+        self.assertEqual(len(self.montreal.refresh_peers()), 2)
+        self.montreal.set('key', 'value')
+
+        # The same node id takes the registration, and the rows addressed to it, back
+        restarted = GeoLRUCache(quebec.coordinates, db_url=self.montreal.db_url, node_id=7,
+                                transport=DatabaseTransport(poll_interval=0.05))
+        try:
+            self.assertTrue(wait_for(lambda: restarted.get('key') == 'value'))
+            self.assertEqual(restarted.session.query(CacheGeolocation).count(), 3)
+        finally:
+            restarted.close(deregister=True)
+
+    def test_closed_caches_deregister(self):
+        self.montreal.set('key', 'value')
+        self.toronto.close()
+        self.toronto.listener_thread.join()
+
+        # Toronto's registration is gone, along with the rows addressed to it
+        self.assertEqual(self.montreal.refresh_peers(), [])
+        self.assertEqual(self.montreal.session.query(CacheDataStore).count(), 0)
+
+    def test_closed_caches_stop_replicating(self):
+        self.montreal.set('before', 1)
+        rows = self.toronto.session.query(CacheDataStore).count()
+
+        self.montreal.close()
+        self.montreal.set('after', 2)
+
+        # The write stays on Montreal
+        self.assertEqual(self.montreal.get('after'), 2)
+        self.assertEqual(self.toronto.session.query(CacheDataStore).count(), rows)
+
+    def test_rows_of_unregistered_caches_are_compacted(self):
+        self.montreal.session.add(CacheDataStore(target_node=12345, key=b'key', value=b'', expires_at=None))
+        self.montreal.session.commit()
+
+        session = self.montreal.Session()
+        try:
+            self.assertEqual(self.montreal.transport.compact(self.montreal, session), 1)
+        finally:
+            session.close()
+
+    def test_deletions_and_invalidations(self):
+        self.montreal.set_many({'a': 1, 'b': 2}, tags=['group'])
+        self.montreal.set('c', 3)
+        self.assertTrue(wait_for(lambda: self.toronto.size() == 3))
+        self.assertEqual(self.toronto.store.peek('a').tags, ('group',))
+
+        self.montreal.delete('c')
+        self.montreal.invalidate_tag('group')
+
+        self.assertTrue(wait_for(lambda: self.toronto.size() == 0))
+        self.assertIn('c', self.toronto.store.tombstones)
+
+
+class TestConnections(unittest.TestCase):
+
+    def setUp(self):
+        self.db_url = make_db_url()
+        self.caches = [GeoLRUCache((45.5016889 + i, -73.567256), db_url=self.db_url, transport=InProcessTransport())
+                       for i in range(2)]
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+    def test_caches_share_their_engine(self):
+        first, second = self.caches
+        self.assertIs(first.engine, second.engine)
+
+        # Other pool options get an engine of their own
+        other = GeoLRUCache((40, -80), db_url=self.db_url, transport=InProcessTransport(), pool_size=2)
+        try:
+            self.assertIsNot(other.engine, first.engine)
+        finally:
+            other.close()
+
+    def test_unusable_database_fails_the_constructor(self):
+        db_url = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'no_such_directory', 'cache.db')
+
+        listeners = threading.active_count()
+        with self.assertRaises(OperationalError):
+            GeoLRUCache((40, -80), db_url=db_url, neighbour_address=('127.0.0.1', 0))
+
+        # Neither a listener nor a neighbour server was left running
+        self.assertEqual(threading.active_count(), listeners)
+
+    def test_sqlite_write_ahead_logging(self):
+        self.assertEqual(self.caches[0].session.execute(text("PRAGMA journal_mode")).scalar(), 'wal')
+
+    def test_session_per_thread(self):
+        cache = self.caches[0]
+        sessions = []
+
+        thread = threading.Thread(target=lambda: sessions.append(cache.session))
+        thread.start()
+        thread.join()
+
+        self.assertIs(cache.session, cache.session)
+        self.assertIsNot(sessions[0], cache.session)
+
+    def test_retries(self):
+        session = self.caches[0].session
+        attempts = []
+
+        def locked_once(session):
+            attempts.append(session)
+            if len(attempts) == 1:
+                raise OperationalError("INSERT", {}, Exception("database is locked"))
+            return 'done'
+
+        self.assertEqual(with_retries(session, locked_once, backoff=0.001), 'done')
+        self.assertEqual(len(attempts), 2)
+
+        # Errors that aren't transient are raised at once
+        def conflicting(session):
+            attempts.append(session)
+            raise IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed"))
+
+        del attempts[:]
+        with self.assertRaises(IntegrityError):
+            with_retries(session, conflicting, backoff=0.001)
+        self.assertEqual(len(attempts), 1)
+
+    def test_transient_errors(self):
+        class SerializationFailure(Exception):
+            pgcode = '40001'
+
+        self.assertTrue(is_transient(OperationalError("UPDATE", {}, Exception("database is locked"))))
+        self.assertTrue(is_transient(OperationalError("UPDATE", {}, SerializationFailure("could not serialize"))))
+
+        # Operational errors that fail again if retried
+        self.assertFalse(is_transient(OperationalError("SELECT", {}, Exception("no such table: datastore"))))
+        self.assertFalse(is_transient(OperationalError("", {}, Exception("unable to open database file"))))
+        self.assertFalse(is_transient(ValueError("not a database error")))
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_codecs(self):
+        values = {
+            'pickle': {'key': (1, 2.5, None), 'set': {1, 2}},
+            'json': {'key': [1, 2.5, None], 'text': 'é'},
+            'bytes': b'\x00\xff' * 10,
+        }
+
+        for codec, value in values.items():
+            with self.subTest(codec=codec):
+                serializer = serialization.Serializer(codec)
+                self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+
+        self.assertRaises(TypeError, serialization.Serializer('bytes').dumps, 'text')
+        self.assertRaises(ValueError, serialization.Serializer, 'xml')
+
+    def test_compression_threshold(self):
+        serializer = serialization.Serializer('json', compression='zlib', compression_threshold=100)
+
+        small, large = 'x' * 10, 'x' * 10000
+        self.assertEqual(serializer.dumps(small)[1:2], b'-')
+        self.assertLess(len(serializer.dumps(large)), 100)
+        self.assertEqual(serializer.loads(serializer.dumps(large)), large)
+
+    def test_only_accepted_codecs_are_decoded(self):
+        writer = serialization.Serializer('json', compression='zlib', compression_threshold=0)
+        reader = serialization.Serializer('pickle', accept=['json'])
+
+        self.assertEqual(reader.loads(writer.dumps(['a', 1])), ['a', 1])
+        self.assertRaises(ValueError, reader.loads, b'?-data')
+
+        # Pickle is only decoded if opted into
+        self.assertRaises(ValueError, writer.loads, reader.dumps(['a', 1]))
+
+    def test_keys_are_encoded_with_the_cache_codec(self):
+        items = [(('tuple', 1), 'a', None, None, ('tag',)), ('text', 'b', None, None, None)]
+
+        json_serializer = serialization.Serializer('json')
+        self.assertEqual(list(snapshot.read_items(snapshot.dump_items(items, json_serializer), json_serializer)),
+                         items)
+
+        # Keys 'bytes' can't encode are encoded with JSON
+        bytes_serializer = serialization.Serializer('bytes')
+        data = snapshot.dump_items([('text', b'value', None, None, None)], bytes_serializer)
+        self.assertEqual(list(snapshot.read_items(data, bytes_serializer)), [('text', b'value', None, None, None)])
+
+        # Items whose keys are pickled aren't read by a cache that doesn't accept pickle
+        data = snapshot.dump_items(items, serialization.Serializer('pickle', accept=['json']))
+        self.assertEqual(list(snapshot.read_items(data, json_serializer)), [])
+
+    def test_encoded_once_per_write(self):
+        class CountingCodec(serialization.PickleCodec):
+            encoded = 0
+
+            def encode(self, value):
+                CountingCodec.encoded += 1
+                return super().encode(value)
+
+        cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url(), codec=CountingCodec())
+        try:
+            for latitude, longitude in ((49.2827291, -123.1207375), (43.653226, -79.3831843)):
+                cache.session.add(CacheGeolocation(latitude=latitude, longitude=longitude))
+            cache.session.commit()
+            cache.refresh_peers()
+
+            cache.set('key', 'value')
+
+            # The key and the value, once each
+            self.assertEqual(cache.session.query(CacheDataStore).count(), 2)
+            self.assertEqual(CountingCodec.encoded, 2)
+        finally:
+            cache.close()
+
+
+class TestPropagation(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url())
+
+        # Register peers that never consume their rows
+        self.peers = [(49.2827291, -123.1207375), (43.653226, -79.3831843)]
+        for latitude, longitude in self.peers:
+            self.cache.session.add(CacheGeolocation(latitude=latitude, longitude=longitude))
+        self.cache.session.commit()
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_nearest_peer_first(self):
+        self.cache.set_many([('a', 'x'), ('b', 'y')])
+
+        rows = self.cache.session.query(CacheDataStore).order_by(CacheDataStore.id).all()
+        load_key = self.cache.serializer.keys.loads
+
+        # Toronto is nearer to Montreal than Vancouver is
+        self.assertEqual([((row.latitude, row.longitude), load_key(row.key)) for row in rows],
+                         [(self.peers[1], 'a'), (self.peers[1], 'b'), (self.peers[0], 'a'), (self.peers[0], 'b')])
+
+    def test_superseded_writes_are_coalesced(self):
+        for key in ('key', 5, ('tuple', 1), 'x' * 500):
+            for i in range(10):
+                self.cache.set(key, i)
+        self.cache.set('other', 'value')
+
+        # One pending row per peer and key, holding the latest write
+        rows = self.cache.session.query(CacheDataStore).\
+                      filter(CacheDataStore.key == self.cache.serializer.keys.dumps('key')).all()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({self.cache.serializer.loads(row.value) for row in rows}, {9})
+        self.assertEqual(self.cache.session.query(CacheDataStore).count(), 10)
+
+
+class TestReplicationScopes(unittest.TestCase):
+
+    def setUp(self):
+        # Montreal, in region 'east', with peers that never consume their rows
+        self.cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url(), region='east')
+
+        self.quebec = (46.8138783, -71.2079809)
+        self.toronto = (43.653226, -79.3831843)
+        self.vancouver = (49.2827291, -123.1207375)
+        for (latitude, longitude), region in ((self.quebec, 'east'), (self.toronto, 'east'),
+                                              (self.vancouver, 'west')):
+            self.cache.session.add(CacheGeolocation(latitude=latitude, longitude=longitude, region=region))
+        self.cache.session.commit()
+        self.cache.refresh_peers()
+
+    def tearDown(self):
+        self.cache.close()
+
+    def targets(self):
+        rows = self.cache.session.query(CacheDataStore).order_by(CacheDataStore.id).all()
+        self.cache.session.query(CacheDataStore).delete()
+        self.cache.session.commit()
+
+        return [(row.latitude, row.longitude) for row in rows]
+
+    def test_scopes(self):
+        scopes = [
+            (NearestPeers(2), [self.quebec, self.toronto]),
+            (PeersWithin(300000), [self.quebec]),
+            (SameRegion(), [self.quebec, self.toronto]),
+            (SameRegion('west'), [self.vancouver]),
+            (PeerGroup([self.vancouver, self.quebec]), [self.quebec, self.vancouver]),
+        ]
+
+        for scope, expected in scopes:
+            with self.subTest(scope=scope):
+                self.cache.set('key', 'value', scope=scope)
+                self.assertEqual(self.targets(), expected)
+
+    def test_default_scope(self):
+        self.cache.replication_scope = NearestPeers(1)
+
+        self.cache.set('key', 'value')
+        self.assertEqual(self.targets(), [self.quebec])
+
+        # Overridden for a single write
+        self.cache.set_many({'a': 1, 'b': 2}, scope=SameRegion('west'))
+        self.assertEqual(self.targets(), [self.vancouver, self.vancouver])
+
+    def test_write_behind_keeps_scopes(self):
+        cache = GeoLRUCache((45.5016889, -73.567256), db_url=self.cache.db_url, write_behind=True,
+                            flush_interval=60)
+        try:
+            cache.refresh_peers()
+            cache.set('a', 1, scope=NearestPeers(1))
+            cache.set('b', 2, scope=SameRegion('west'))
+            self.assertTrue(cache.flush(timeout=5))
+
+            # The other cache at the same coordinates is the nearest peer
+            rows = cache.session.query(CacheDataStore).all()
+            self.assertEqual(sorted((cache.serializer.keys.loads(row.key), (row.latitude, row.longitude))
+                                    for row in rows),
+                             [('a', self.cache.coordinates), ('b', self.vancouver)])
+        finally:
+            cache.close()
+
+
+class TestPeerIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url(), peer_refresh_interval=60)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_peers_are_memoized(self):
+        self.assertEqual(self.cache.sort_distances(), [])
+
+        self.cache.session.add(CacheGeolocation(latitude=43.653226, longitude=-79.3831843))
+        self.cache.session.commit()
+
+        # The registry isn't checked again within the refresh interval...
+        self.assertEqual(self.cache.sort_distances(), [])
+
+        # ...unless explicitly asked to
+        peers = self.cache.refresh_peers()
+        self.assertEqual([coordinates for coordinates, _ in peers], [(43.653226, -79.3831843)])
+        self.assertIs(self.cache.sort_distances(), peers)
+
+    def test_nearest_and_within(self):
+        for latitude, longitude in ((43.653226, -79.3831843), (49.2827291, -123.1207375), (46.8138783, -71.2079809)):
+            self.cache.session.add(CacheGeolocation(latitude=latitude, longitude=longitude))
+        self.cache.session.commit()
+
+        # Quebec City, then Toronto
+        self.assertEqual([coordinates for coordinates, _ in self.cache.nearest(2, refresh=True)],
+                         [(46.8138783, -71.2079809), (43.653226, -79.3831843)])
+        self.assertEqual([coordinates for coordinates, _ in self.cache.within(300000)], [(46.8138783, -71.2079809)])
+
+    def test_registrations_updated_in_place(self):
+        peer = SimpleNamespace(node_id=42, coordinates=(43.653226, -79.3831843), address='127.0.0.1:1000',
+                               region='east')
+        register(self.cache.session, peer)
+
+        toronto, = [coordinates for coordinates, _ in self.cache.refresh_peers()]
+        self.assertEqual(self.cache.peer_index.address_of(toronto), '127.0.0.1:1000')
+
+        # The peer restarts with the same node id, at another address
+        peer.address, peer.region = '127.0.0.1:2000', 'west'
+        register(self.cache.session, peer)
+
+        self.cache.sort_distances(refresh=True)
+        self.assertEqual(self.cache.peer_index.address_of(toronto), '127.0.0.1:2000')
+        self.assertEqual(self.cache.peer_index.region_of(toronto), 'west')
+
+
+class TestNeighbourAware(unittest.TestCase):
+
+    def make_caches(self, transport_class, **montreal_options):
+        db_url = make_db_url()
+
+        self.montreal = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport_class(),
+                                    **montreal_options)
+        self.toronto = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport_class(),
+                                   neighbour_aware=True)
+
+        self.assertTrue(wait_for(lambda: len(self.toronto.sort_distances(refresh=True)) == 1))
+
+        # Save the item on Montreal's cache alone
+        self.montreal.receive([('key', 'value')])
+
+    def tearDown(self):
+        for cache in (self.montreal, self.toronto):
+            cache.close()
+
+    def test_in_process(self):
+        transport = InProcessTransport()
+        self.make_caches(lambda: transport)
+
+        self.assertEqual(self.toronto.get('key'), 'value')
+        self.assertIsNone(self.toronto.get('other'))
+
+        # The item is now saved on Toronto's cache
+        self.assertTrue('key' in self.toronto)
+
+    def test_over_sockets(self):
+        self.make_caches(DatabaseTransport, neighbour_address=('127.0.0.1', 0))
+
+        self.assertEqual(self.toronto.get('key'), 'value')
+        self.assertIsNone(self.toronto.get('other'))
+        self.assertTrue('key' in self.toronto)
+
+    def test_unreachable_neighbours_are_skipped(self):
+        self.make_caches(DatabaseTransport, neighbour_address=('127.0.0.1', 0))
+
+        # Hamilton, nearer to Toronto than Montreal is, stops answering but stays registered
+        hamilton = GeoLRUCache((43.2557206, -79.8711024), db_url=self.montreal.db_url, transport=DatabaseTransport(),
+                               neighbour_address=('127.0.0.1', 0))
+        hamilton.close(deregister=False)
+        self.assertEqual(self.toronto.nearest(refresh=True)[0][0], hamilton.coordinates)
+
+        self.assertEqual(self.toronto.get('key'), 'value')
+
+    def test_copies_keep_the_version_and_deadline(self):
+        self.make_caches(DatabaseTransport, neighbour_address=('127.0.0.1', 0))
+
+        version = self.montreal.clock.now()
+        self.montreal.receive([('versioned', 'value', time.time() + 30, version, ('tag',))])
+
+        self.assertEqual(self.toronto.get('versioned'), 'value')
+
+        copy, original = self.toronto.store.peek('versioned'), self.montreal.store.peek('versioned')
+        self.assertEqual(copy.version, version)
+        self.assertEqual(copy.tags, ('tag',))
+        self.assertAlmostEqual(copy.expires_at, original.expires_at, delta=0.5)
+
+    def test_values_keep_their_type_over_sockets(self):
+        self.make_caches(DatabaseTransport, neighbour_address=('127.0.0.1', 0))
+
+        self.montreal.receive([('bytes', b'\x00\xff'), ('tuple', (1, 'a')), ('set', {1, 2})])
+
+        self.assertEqual(self.toronto.get('bytes'), b'\x00\xff')
+        self.assertEqual(self.toronto.get('tuple'), (1, 'a'))
+        self.assertEqual(self.toronto.get('set'), {1, 2})
+
+    def test_deleted_items_are_not_read_through_again(self):
+        transport = InProcessTransport()
+        self.make_caches(lambda: transport)
+
+        written, deleted = self.montreal.clock.now(), self.montreal.clock.now()
+        self.montreal.receive([('deleted', 'stale', None, written, None)])
+
+        # The deletion reaches Toronto, but not yet Montreal
+        self.toronto.receive([('deleted', DELETE, None, deleted, None)])
+
+        self.assertIsNone(self.toronto.get('deleted'))
+        self.assertFalse('deleted' in self.toronto)
+
+
+class TestBootstrap(unittest.TestCase):
+
+    def setUp(self):
+        self.db_url = make_db_url()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+
+    def make_cache(self, coordinates, **options):
+        cache = GeoLRUCache(coordinates, db_url=self.db_url, **options)
+        self.caches.append(cache)
+        return cache
+
+    def fill(self, cache):
+        cache.set('a', {'nested': [1, 2]})
+        cache.set('b', 'y', ttl=30)
+        cache.set('expired', 'z', ttl=0.01)
+        time.sleep(0.05)
+
+    def assert_caught_up(self, montreal, toronto):
+        self.assertTrue(toronto.bootstrapped.wait(5))
+
+        self.assertEqual(toronto.lookup('a'), {'nested': [1, 2]})
+        self.assertAlmostEqual(toronto.store.peek('b').expires_at - time.monotonic(), 30, delta=2)
+        self.assertIsNone(toronto.lookup('expired'))
+
+        # Then the new writes are received as usual
+        montreal.refresh_peers()
+        montreal.set('c', 'new')
+        self.assertTrue(wait_for(lambda: toronto.lookup('c') == 'new'))
+
+    def test_in_process(self):
+        transport = InProcessTransport()
+        montreal = self.make_cache((45.5016889, -73.567256), transport=transport)
+        self.fill(montreal)
+
+        toronto = self.make_cache((43.653226, -79.3831843), transport=transport, bootstrap=True)
+        self.assert_caught_up(montreal, toronto)
+
+    def test_over_sockets(self):
+        montreal = self.make_cache((45.5016889, -73.567256), transport=DatabaseTransport(poll_interval=0.05),
+                                   neighbour_address=('127.0.0.1', 0))
+        self.fill(montreal)
+
+        toronto = self.make_cache((43.653226, -79.3831843), transport=DatabaseTransport(poll_interval=0.05),
+                                  bootstrap=True)
+        self.assert_caught_up(montreal, toronto)
+
+    def test_export_since(self):
+        montreal = self.make_cache((45.5016889, -73.567256), transport=InProcessTransport())
+        montreal.set('old', 1)
+        time.sleep(0.01)
+        since = time.time()
+        time.sleep(0.01)
+        montreal.set('new', 2)
+
+        self.assertEqual([key for key, *_ in montreal.export(since)], ['new'])
+
+        # Reading an item counts too
+        montreal.get('old')
+        self.assertEqual([key for key, *_ in montreal.export(since)], ['new', 'old'])
+
+
+class TestConcurrency(unittest.TestCase):
+
+    THREADS = 8
+    OPERATIONS = 2000
+
+    def setUp(self):
+        db_url = make_db_url()
+        transport = InProcessTransport()
+
+        self.montreal = GeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport,
+                                    max_size=100, shards=8)
+        self.toronto = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport,
+                                   max_size=100, shards=8)
+
+        self.assertTrue(wait_for(lambda: len(self.montreal.sort_distances(refresh=True)) == 1))
+
+    def tearDown(self):
+        for cache in (self.montreal, self.toronto):
+            cache.close()
+
+    def test_stress(self):
+        errors = []
+
+        def work(seed):
+            random = Random(seed)
+            try:
+                for _ in range(self.OPERATIONS):
+                    key = random.randrange(500)
+                    # Montreal's writes also reach Toronto through its listener thread,
+                    # while Toronto's own threads read and write
+                    cache = random.choice((self.montreal, self.toronto))
+                    if random.random() < 0.3:
+                        cache.set(key, key)
+                    else:
+                        value = cache.get(key)
+                        if value is not None and value != key:
+                            errors.append(f"{key} -> {value}")
+                    repr(cache)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=work, args=(seed,)) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for cache in (self.montreal, self.toronto):
+            # Concurrent writers can each overshoot the capacity by one item
+            self.assertLessEqual(cache.size(), 100 + self.THREADS)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestGetOrSet(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = GeoLRUCache((45.5016889, -73.567256), db_url=make_db_url(), transport=InProcessTransport())
+        self.calls = 0
+
+    def tearDown(self):
+        self.cache.close()
+
+    def slow_loader(self, value, delay=0.1):
+        def load():
+            self.calls += 1
+            time.sleep(delay)
+            return value
+
+        return load
+
+    def test_concurrent_misses_load_once(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_set('key', self.slow_loader(1))))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [1] * 20)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.get('key'), 1)
+
+    def test_errors_reach_every_caller(self):
+        def fail():
+            raise ValueError("origin is down")
+
+        with self.assertRaises(ValueError):
+            self.cache.get_or_set('key', fail)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_stale_while_revalidate(self):
+        self.cache.get_or_set('key', self.slow_loader(1, delay=0), ttl=0, stale_while_revalidate=60)
+
+        # The item outlived its ttl: the stale value is served while it reloads
+        self.assertEqual(self.cache.get_or_set('key', self.slow_loader(2, delay=0.1), ttl=60), 1)
+        self.assertTrue(wait_for(lambda: self.cache.get('key') == 2))
+        self.assertEqual(self.calls, 2)
+
+    def test_peers_only_keep_fresh_items(self):
+        toronto = GeoLRUCache((43.653226, -79.3831843), db_url=self.cache.db_url, transport=self.cache.transport)
+        try:
+            self.assertTrue(wait_for(lambda: len(self.cache.sort_distances(refresh=True)) == 1))
+            self.cache.get_or_set('key', self.slow_loader(1, delay=0), ttl=30, stale_while_revalidate=600)
+            self.assertTrue(wait_for(lambda: toronto.lookup('key') == 1))
+
+            # Toronto can't tell when the item goes stale, so it expires it then
+            now = time.monotonic()
+            self.assertAlmostEqual(toronto.store.peek('key').expires_at - now, 30, delta=2)
+            self.assertAlmostEqual(self.cache.store.peek('key').expires_at - now, 630, delta=2)
+        finally:
+            toronto.close()
+
+    def test_early_refresh(self):
+        self.cache.get_or_set('key', self.slow_loader(1, delay=0.01), ttl=60)
+
+        # A beta this large makes any item that took time to load refresh right away
+        self.assertEqual(self.cache.get_or_set('key', self.slow_loader(2, delay=0), early_refresh=1e6), 1)
+        self.assertTrue(wait_for(lambda: self.cache.get('key') == 2))
+
+
+class TestAsyncGeoLRUCache(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        db_url = make_db_url()
+        transport = self.transport = AsyncInProcessTransport()
+
+        self.montreal = await AsyncGeoLRUCache((45.5016889, -73.567256), db_url=db_url, transport=transport,
+                                               write_behind=True, flush_interval=60).start()
+        self.toronto = await AsyncGeoLRUCache((43.653226, -79.3831843), db_url=db_url, transport=transport,
+                                              neighbour_aware=True).start()
+        await self.montreal.refresh_peers()
+
+    async def asyncTearDown(self):
+        for cache in (self.montreal, self.toronto):
+            await cache.close()
+
+    async def test_replication(self):
+        await self.toronto.aset_many({'a': 'x', 'b': 'y'})
+
+        self.assertEqual(await self.toronto.aget('a'), 'x')
+        self.assertTrue(await async_wait_for(lambda: self.montreal.lookup('b') == 'y'))
+
+    async def test_snapshot(self):
+        path = make_db_url()[len('sqlite:///'):]
+
+        await self.toronto.aset_many({'a': 1, 'b': 2})
+        self.assertEqual(await self.toronto.snapshot(path), 2)
+
+        async with AsyncGeoLRUCache((49.2827291, -123.1207375), db_url=make_db_url(),
+                                    transport=AsyncInProcessTransport(), snapshot_path=path) as vancouver:
+            self.assertEqual(await vancouver.aget('b'), 2)
+
+        os.remove(path)
+
+    async def test_write_behind_overflow(self):
+        published = []
+
+        async def publish(items, scope):
+            published.extend(key for key, *_ in items)
+
+        writes = [(key, 1, None, None, None) for key in 'abc']
+
+        dropping = AsyncWriteBehindPublisher(SimpleNamespace(publish=publish), flush_interval=60, max_pending=2,
+                                             overflow=AsyncWriteBehindPublisher.DROP_OLDEST)
+        await dropping.put(writes)
+        await dropping.close()
+        self.assertEqual(published, ['b', 'c'])
+
+        del published[:]
+        running = AsyncWriteBehindPublisher(SimpleNamespace(publish=publish), flush_interval=60, max_pending=2,
+                                            overflow=AsyncWriteBehindPublisher.CALLER_RUNS)
+        await running.put(writes)
+        self.assertEqual((published, running.pending), (['a', 'b'], 1))
+        await running.close()
+
+    async def test_local_cache(self):
+        async with AsyncGeoLRUCache((49.2827291, -123.1207375), db_url=False) as vancouver:
+            await vancouver.aset_many({'a': 1, 'b': 2})
+            await vancouver.adelete('a')
+
+            self.assertIsNone(await vancouver.aget('a'))
+            self.assertEqual(await vancouver.aget('b'), 2)
+            self.assertEqual(await vancouver.refresh_peers(), [])
+            self.assertIsNone(vancouver.engine)
+
+        with self.assertRaises(ValueError):
+            AsyncGeoLRUCache((49.2827291, -123.1207375), db_url=False, transport=self.transport)
+
+    async def test_bootstrap(self):
+        await self.toronto.aset_many({'a': 1, 'b': 2})
+
+        async with AsyncGeoLRUCache((49.2827291, -123.1207375), db_url=self.toronto.db_url,
+                                    transport=self.transport, bootstrap=True) as vancouver:
+            # Toronto is nearer to Vancouver than Montreal is, and has the items
+            self.assertEqual(vancouver.lookup('a'), 1)
+            self.assertEqual(vancouver.lookup('b'), 2)
+
+    async def test_write_behind(self):
+        for i in range(10):
+            await self.montreal.aset('key', i)
+
+        self.assertEqual(self.montreal.publisher.pending, 1)
+        self.assertIsNone(self.toronto.lookup('key'))
+
+        self.assertTrue(await self.montreal.flush(timeout=5))
+        self.assertTrue(await async_wait_for(lambda: self.toronto.lookup('key') == 9))
+
+    async def test_neighbour_aware(self):
+        self.montreal.receive([('key', 'value')])
+
+        self.assertEqual(await self.toronto.aget('key'), 'value')
+        self.assertIsNone(await self.toronto.aget('other'))
+        self.assertTrue('key' in self.toronto)
+
+    async def test_get_or_set(self):
+        calls = []
+
+        async def load():
+            calls.append(None)
+            await asyncio.sleep(0.05)
+            return 'value'
+
+        values = await asyncio.gather(*[self.toronto.aget_or_set('key', load) for _ in range(20)])
+
+        self.assertEqual(values, ['value'] * 20)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(await async_wait_for(lambda: self.montreal.lookup('key') == 'value'))
+
+    async def test_deletions_and_invalidations(self):
+        await self.toronto.aset_many({'a': 1, 'b': 2, 'c': 3}, tags=['group'])
+        await self.toronto.aset('d', 4)
+        self.assertTrue(await async_wait_for(lambda: self.montreal.size() == 4))
+
+        await self.toronto.adelete('d')
+        self.assertEqual(await self.toronto.ainvalidate_tag('group'), 3)
+
+        self.assertTrue(await async_wait_for(lambda: self.montreal.size() == 0))
+        self.assertEqual(self.toronto.size(), 0)
+
+    async def test_close_stops_the_tasks(self):
+        await self.toronto.close()
+        await self.montreal.aset('key', 'value')
+        await self.montreal.flush(timeout=5)
+        await asyncio.sleep(0.05)
+
+        self.assertIsNone(self.toronto.lookup('key'))
+
+
+class TestAsyncDatabaseReplication(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        db_url = make_db_url()
+
+        # An async cache and a threaded cache, sharing a database
+        self.montreal = await AsyncGeoLRUCache((45.5016889, -73.567256), db_url=db_url, neighbour_aware=True,
+                                               transport=AsyncDatabaseTransport(poll_interval=0.05)).start()
+        self.toronto = GeoLRUCache((43.653226, -79.3831843), db_url=db_url, neighbour_address=('127.0.0.1', 0),
+                                   transport=DatabaseTransport(poll_interval=0.05))
+
+        self.assertTrue(await async_wait_for(lambda: len(self.toronto.sort_distances(refresh=True)) == 1))
+
+        # Toronto registered itself in its constructor
+        self.assertEqual(len(await self.montreal.refresh_peers()), 1)
+
+    async def asyncTearDown(self):
+        await self.montreal.close()
+        self.toronto.close()
+
+    async def test_replication(self):
+        await self.montreal.aset('a', 'x')
+        self.assertTrue(await async_wait_for(lambda: self.toronto.lookup('a') == 'x'))
+
+        self.toronto.set('b', 'y')
+        self.assertTrue(await async_wait_for(lambda: self.montreal.lookup('b') == 'y'))
+
+    async def test_neighbour_aware(self):
+        self.toronto.receive([('key', 'value')])
+
+        self.assertEqual(await self.montreal.aget('key'), 'value')
+        self.assertIsNone(await self.montreal.aget('other'))
+
+    async def test_unreachable_neighbours_are_skipped(self):
+        self.toronto.receive([('key', 'value')])
+
+        # Quebec, nearer to Montreal than Toronto is, stops answering but stays registered
+        quebec = GeoLRUCache((46.8138783, -71.2079809), db_url=self.toronto.db_url, transport=DatabaseTransport(),
+                             neighbour_address=('127.0.0.1', 0))
+        quebec.close(deregister=False)
+        self.assertEqual((await self.montreal.refresh_peers())[0][0], quebec.coordinates)
+
+        self.assertEqual(await self.montreal.aget('key'), 'value')